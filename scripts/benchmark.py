@@ -0,0 +1,371 @@
+''' Benchmarks of the preprocessing and inference stages on synthetic data, with a JSON report.
+
+The fixtures are generated offline for every scale (random FASTA, PAT files of two cell types, BAM files,
+BigWig files of two groups with planted DMRs, a bulk data.csv and a tiny randomly initialized MethylBERT)
+and kept in the work directory, so later runs only time the stages. Every stage runs in its own process
+and reports wall time, peak RSS (of the stage and of its worker processes) and throughput:
+
+- extract_methylation_sites: bases/s
+- pat_to_sam: reads/s
+- generate_bulk_sample: reads/s
+- dmr_calling: sites/s (native backend)
+- deconvolution: reads/s (memmap conversion, classification and proportion estimation, fast_deconvolution.py)
+
+With --baseline, the throughput of every stage and scale is compared with an earlier report, and the run
+fails if it dropped by more than --max-drop.
+
+python benchmark.py --scales small medium -o tmp/benchmark.json
+python benchmark.py --scales small --baseline tmp/benchmark.json --max-drop 0.2
+'''
+
+import argparse
+import gzip
+import json
+import multiprocessing as mp
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import traceback
+
+import numpy as np
+
+WORK_DIR = "tmp/benchmark/"
+REPORT = "tmp/benchmark.json"
+# Multiplier of the fixture sizes
+SCALES = {"small": 1, "medium": 10, "large": 100}
+STAGES = ("extract_methylation_sites", "pat_to_sam", "generate_bulk_sample", "dmr_calling", "deconvolution")
+
+# Fixture sizes at scale 1
+N_CHROMS = 2
+CHROM_LEN = 200_000
+PAT_LINES = 2_000  # per cell type
+N_BIGWIGS = 4  # two per group
+DMR_EVERY = 200  # one planted DMR per DMR_EVERY CpG sites
+DMR_SITES = 15
+BULK_READS = 2_000
+N_DMRS = 20
+SEQ_LEN = 100
+N_MERS = 3
+CELL_TYPES = {"T": 0.8, "N": 0.2}  # methylation rate of the PAT reads
+
+class Fixture:
+    """Paths of the synthetic input files of one scale."""
+
+    def __init__(self, work_dir, scale):
+        self.scale = scale
+        self.multiplier = SCALES[scale]
+        self.dir = os.path.join(work_dir, scale)
+        self.fasta = os.path.join(self.dir, "ref.fa")
+        self.cpg_index = os.path.join(self.dir, "cpg_sites")
+        self.pat = {ctype: os.path.join(self.dir, f"{ctype}.pat.gz") for ctype in CELL_TYPES}
+        self.bam = {ctype: os.path.join(self.dir, f"{ctype}.bam") for ctype in CELL_TYPES}
+        self.bigwigs = [os.path.join(self.dir, "bigwig", f"s{i}.bw") for i in range(N_BIGWIGS)]
+        self.groups = [i * 2 // N_BIGWIGS for i in range(N_BIGWIGS)]
+        self.data = os.path.join(self.dir, "data.csv")
+        self.train = os.path.join(self.dir, "train_ctypes.csv")
+        self.model = os.path.join(self.dir, "model")
+        self.out = os.path.join(self.dir, "out")
+
+    @property
+    def complete(self):
+        return os.path.exists(os.path.join(self.dir, "fixture.json"))
+
+def write_fasta(path, n_chroms, length, rng):
+    bases = np.frombuffer(b"ACGT", dtype=np.uint8)
+    with open(path, "w") as f:
+        for c in range(n_chroms):
+            seq = bases[rng.integers(0, 4, length)].tobytes().decode()
+            f.write(f">chr{c + 1}\n")
+            f.writelines(seq[i:i + 60] + "\n" for i in range(0, length, 60))
+
+def write_pat(path, cpg, n_lines, methyl_rate, rng):
+    """PAT file with n_lines random patterns (1-8 CpGs, counts 1-5) spread over all chromosomes, sorted by position."""
+    counts = np.array([cpg.count(chrom) for chrom in cpg.chroms])
+    lines_per_chrom = rng.multinomial(n_lines, counts / counts.sum())
+    with gzip.open(path, "wt") as f:
+        for chrom, count, n in zip(cpg.chroms, counts, lines_per_chrom):
+            idx = np.sort(rng.integers(0, count - 8, n))
+            lengths = rng.integers(1, 9, n)
+            cnts = rng.integers(1, 6, n)
+            for i, length, cnt in zip(idx, lengths, cnts):
+                calls = np.where(rng.random(length) < methyl_rate, "C", "T")
+                calls[rng.random(length) < 0.05] = "."
+                f.write(f"{chrom}\t{i}\t{''.join(calls)}\t{cnt}\n")
+
+def write_bigwigs(fixture, cpg, rng):
+    """Methylation levels at every CpG site, group 1 differs from group 0 in planted blocks of DMR_SITES sites."""
+    import pyBigWig
+
+    os.makedirs(os.path.dirname(fixture.bigwigs[0]), exist_ok=True)
+    lengths = [(chrom, CHROM_LEN * fixture.multiplier) for chrom in cpg.chroms]
+    for path, group in zip(fixture.bigwigs, fixture.groups):
+        bw = pyBigWig.open(path, "w")
+        bw.addHeader(lengths)
+        for chrom in cpg.chroms:
+            starts = np.asarray(cpg.positions(chrom), dtype=np.int64)
+            values = rng.beta(2, 5, len(starts))
+            if group == 1:
+                in_dmr = np.arange(len(starts)) % DMR_EVERY < DMR_SITES
+                values[in_dmr] = np.minimum(values[in_dmr] + 0.5, 1.0)
+            bw.addEntries([chrom] * len(starts), starts.tolist(), ends=(starts + 1).tolist(), values=values.tolist())
+        bw.close()
+
+def write_data_csv(path, n_reads, rng):
+    """Bulk reads in the finetune_data_generate format (random k-mers, methylation states and DMR labels)."""
+    bases = np.array(list("ACGT"))
+    with open(path, "w") as f:
+        f.write("name\tflag\tref_name\tref_pos\tdna_seq\tmethyl_seq\tdmr_ctype\tdmr_label\tctype\n")
+        for i in range(n_reads):
+            n_kmers = int(rng.integers(20, SEQ_LEN + 1))
+            seq = "".join(bases[rng.integers(0, 4, n_kmers + N_MERS - 1)])
+            kmers = " ".join(seq[j:j + N_MERS] for j in range(n_kmers))
+            methyl = "".join(np.where(rng.random(n_kmers) < 0.2, rng.integers(0, 2, n_kmers).astype(str), "2"))
+            f.write(f"r{i}\t0\tchr1\t{i}\t{kmers}\t{methyl}\tT\t{rng.integers(0, N_DMRS)}\tNA\n")
+
+def write_model(path, seed):
+    """Tiny randomly initialized MethylBERT (one encoder block) for N_DMRS DMRs."""
+    import torch
+    from methylbert.config import MethylBERTConfig
+    from methylbert.data.vocab import MethylVocab
+    from methylbert.network import MethylBertEmbeddedDMR
+
+    torch.manual_seed(seed)
+    # The read classifier takes hidden_size + 1 features per position, with the DMR encoding of 768
+    config = MethylBERTConfig(vocab_size=len(MethylVocab(N_MERS)), hidden_size=768, num_hidden_layers=1,
+                              num_attention_heads=4, intermediate_size=256, max_position_embeddings=SEQ_LEN + 28,
+                              num_labels=N_DMRS, type_vocab_size=3)
+    MethylBertEmbeddedDMR(config, seq_len=SEQ_LEN).save_pretrained(path)
+
+def make_fixture(fixture, seed=0):
+    """Generate the input files of a scale (skipped if they already exist)."""
+    if fixture.complete:
+        return
+    import pysam
+    from cpg_index import CpGIndex
+    from extract_methylation_sites import extract_cpg_from_fasta
+    from pat_to_sam import pat_to_sam
+
+    print(f"Generating the {fixture.scale} fixture in {fixture.dir}")
+    os.makedirs(fixture.dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    write_fasta(fixture.fasta, N_CHROMS, CHROM_LEN * fixture.multiplier, rng)
+    pysam.faidx(fixture.fasta)
+    extract_cpg_from_fasta(fixture.fasta, fixture.cpg_index)
+    cpg = CpGIndex(fixture.cpg_index)
+    for ctype, rate in CELL_TYPES.items():
+        write_pat(fixture.pat[ctype], cpg, PAT_LINES * fixture.multiplier, rate, rng)
+        pat_to_sam(fixture.pat[ctype], fixture.cpg_index, fixture.fasta, fixture.bam[ctype], seed)
+    write_bigwigs(fixture, cpg, rng)
+    write_data_csv(fixture.data, BULK_READS * fixture.multiplier, rng)
+    with open(fixture.train, "w") as f:
+        f.write("ctype\n" + "".join(f"{ctype}\n" for ctype in rng.choice(list(CELL_TYPES), 1000)))
+    write_model(fixture.model, seed)
+    with open(os.path.join(fixture.dir, "fixture.json"), "w") as f:
+        json.dump({"scale": fixture.scale, "multiplier": fixture.multiplier, "seed": seed}, f)
+
+# Stages: run on a fixture, return the number of processed items
+
+def run_extract_methylation_sites(fixture, jobs):
+    from extract_methylation_sites import extract_cpg_from_fasta
+    extract_cpg_from_fasta(fixture.fasta, os.path.join(fixture.out, "cpg_sites"))
+    return N_CHROMS * CHROM_LEN * fixture.multiplier
+
+def run_pat_to_sam(fixture, jobs):
+    from pat_to_sam import pat_to_sam
+    return pat_to_sam(fixture.pat["T"], fixture.cpg_index, fixture.fasta, os.path.join(fixture.out, "T.bam"), seed=0)
+
+def run_generate_bulk_sample(fixture, jobs):
+    import pysam
+    from generate_bulk_sample import combine_bam_files
+    n_reads = sum(pysam.AlignmentFile(bam).count(until_eof=True) for bam in fixture.bam.values()) // 2
+    n_selected = combine_bam_files(list(fixture.bam.values()), [0.3, 0.7], n_reads,
+                                   os.path.join(fixture.out, "bulk.bam"), seed=0)
+    return sum(n_selected)
+
+def run_dmr_calling(fixture, jobs):
+    from dmr_calling import extract_common_cpgs, extract_methylation_matrix, run_native
+    sites = extract_common_cpgs(fixture.bigwigs, max_sites=sys.maxsize, n_jobs=jobs)
+    matrix = extract_methylation_matrix(fixture.bigwigs, sites, fixture.groups, jobs)
+    run_native(matrix, os.path.join(fixture.out, "dmrs.tsv"), jobs)
+    return len(matrix)
+
+def run_deconvolution(fixture, jobs):
+    import fast_deconvolution as fd
+    from memmap_dataset import MemmapFinetuneDataset, convert_finetune_csv
+    fd.set_threads(jobs)
+    dataset = MemmapFinetuneDataset(convert_finetune_csv(fixture.data, os.path.join(fixture.out, "data.csv.mm"),
+                                                         SEQ_LEN, N_MERS))
+    model = fd.load_model(fixture.model, SEQ_LEN)
+    res = fd.read_results(dataset, fd.classify_reads(model, dataset))
+    fd.estimate_proportions(res, fd.read_train_ctypes(fixture.train), os.path.join(fixture.out, "deconvolution"))
+    return len(dataset)
+
+STAGE_FUNCS = {
+    "extract_methylation_sites": (run_extract_methylation_sites, "bases"),
+    "pat_to_sam": (run_pat_to_sam, "reads"),
+    "generate_bulk_sample": (run_generate_bulk_sample, "reads"),
+    "dmr_calling": (run_dmr_calling, "sites"),
+    "deconvolution": (run_deconvolution, "reads"),
+}
+
+def stage_process(stage, fixture, jobs, conn):
+    """Run one stage in a fresh process and send the number of items, wall time and peak RSS back."""
+    # The worker pools of the stage start as in the scripts (fork on Linux), not with spawn like this process
+    mp.set_start_method(None, force=True)
+    os.makedirs(fixture.out, exist_ok=True)
+    start = time.perf_counter()
+    try:
+        items = STAGE_FUNCS[stage][0](fixture, jobs)
+        error = None
+    except BaseException:
+        items, error = None, traceback.format_exc()
+    wall_time = time.perf_counter() - start
+    # ru_maxrss is in KiB on Linux; the worker pools of a stage count as children
+    conn.send({"items": items, "wall_time_s": wall_time,
+               "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+               "peak_rss_children_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+               "error": error})
+    conn.close()
+
+def measure(stage, fixture, jobs):
+    """
+    Run a stage in a spawned process. The peak RSS of a process starts at that of its parent (Linux keeps
+    ru_maxrss over fork and exec), so this process only imports numpy before.
+    """
+    ctx = mp.get_context("spawn")
+    parent_conn, child_conn = ctx.Pipe(duplex=False)
+    process = ctx.Process(target=stage_process, args=(stage, fixture, jobs, child_conn), name=stage)
+    process.start()
+    child_conn.close()
+    result = parent_conn.recv() if parent_conn.poll(None) else None
+    process.join()
+    if result is None:
+        result = {"items": None, "error": f"Process exited with code {process.exitcode}"}
+    return result
+
+def benchmark(stages, scales, work_dir=WORK_DIR, repeat=1, jobs=None, seed=0):
+    """
+    Run the stages at the given scales.
+
+    Parameters:
+    stages (list): Stage names (see STAGES).
+    scales (list): Scale names (see SCALES).
+    work_dir (str): Directory of the fixtures and the stage outputs.
+    repeat (int): Runs per stage and scale, the fastest one is reported.
+    jobs (int): Worker processes / threads of the stages that use them (None: all cores).
+    seed (int): Random seed of the fixtures.
+
+    Returns:
+    dict: The report, with one result per stage and scale.
+    """
+    jobs = jobs or os.cpu_count()
+    results = []
+    for scale in scales:
+        fixture = Fixture(work_dir, scale)
+        if not fixture.complete:
+            # In a child process as well, this process would otherwise pass its peak RSS on to the stages
+            process = mp.get_context("spawn").Process(target=make_fixture, args=(fixture, seed))
+            process.start()
+            process.join()
+            if process.exitcode != 0:
+                raise RuntimeError(f"Generating the {scale} fixture failed")
+        for stage in stages:
+            unit = STAGE_FUNCS[stage][1]
+            runs = [measure(stage, fixture, jobs) for _ in range(repeat)]
+            failed = [run for run in runs if run["error"]]
+            if failed:
+                print(f"[{scale}] {stage} failed:\n{failed[0]['error']}", file=sys.stderr)
+                results.append({"stage": stage, "scale": scale, "status": "failed", "error": failed[0]["error"]})
+                continue
+            best = min(runs, key=lambda run: run["wall_time_s"])
+            throughput = best["items"] / max(best["wall_time_s"], 1e-9)
+            results.append({
+                "stage": stage, "scale": scale, "status": "done",
+                "items": best["items"], "unit": unit,
+                "wall_time_s": round(best["wall_time_s"], 4),
+                "wall_times_s": [round(run["wall_time_s"], 4) for run in runs],
+                "throughput": round(throughput, 2), "throughput_unit": f"{unit}/s",
+                "peak_rss_mb": best["peak_rss_mb"],
+                "peak_rss_children_mb": best["peak_rss_children_mb"],
+            })
+            print(f"[{scale}] {stage}: {best['items']} {unit} in {best['wall_time_s']:.2f}s "
+                  f"({throughput:,.0f} {unit}/s), peak RSS {best['peak_rss_mb']:.0f} MB")
+    return {
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "environment": environment(jobs),
+        "results": results,
+    }
+
+def environment(jobs):
+    import torch
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"platform": platform.platform(), "python": platform.python_version(), "numpy": np.__version__,
+            "torch": torch.__version__, "cpu_count": os.cpu_count(), "jobs": jobs, "commit": commit}
+
+def compare(report, baseline, max_drop):
+    """
+    Throughput regressions against a baseline report.
+
+    Returns:
+    list: (stage, scale, baseline throughput, throughput) of every result that is more than max_drop
+          (fraction) slower than the baseline, or failed.
+    """
+    previous = {(r["stage"], r["scale"]): r for r in baseline["results"] if r["status"] == "done"}
+    regressions = []
+    for result in report["results"]:
+        base = previous.get((result["stage"], result["scale"]))
+        if base is None:
+            continue
+        throughput = result.get("throughput", 0.0)
+        change = throughput / base["throughput"] - 1
+        result["baseline_throughput"] = base["throughput"]
+        result["change"] = round(change, 4)
+        print(f"[{result['scale']}] {result['stage']}: {change:+.1%} against the baseline")
+        if result["status"] != "done" or change < -max_drop:
+            regressions.append((result["stage"], result["scale"], base["throughput"], throughput))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the preprocessing and inference stages on synthetic data.")
+    parser.add_argument("--scales", nargs="+", choices=list(SCALES), default=["small"], help="Fixture scales (default: small)")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=list(STAGES), help="Stages to run (default: all)")
+    parser.add_argument("-o", "--output", default=REPORT, help=f"JSON report (default: {REPORT})")
+    parser.add_argument("--work-dir", default=WORK_DIR, help=f"Directory of the fixtures and outputs (default: {WORK_DIR})")
+    parser.add_argument("-r", "--repeat", type=int, default=1, help="Runs per stage, the fastest one counts (default: 1)")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="Worker processes / threads of the stages (default: all cores)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed of the fixtures (default: 0)")
+    parser.add_argument("--baseline", help="Earlier JSON report to compare the throughput with")
+    parser.add_argument("--max-drop", type=float, default=0.2, help="Maximum throughput drop against the baseline (default: 0.2 = 20%%)")
+    args = parser.parse_args()
+
+    # Read the baseline first, the output may overwrite it
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    report = benchmark(args.stages, args.scales, args.work_dir, args.repeat, args.jobs, args.seed)
+    regressions = compare(report, baseline, args.max_drop) if baseline else []
+    if baseline:
+        report["baseline"] = {"path": os.path.abspath(args.baseline), "started": baseline.get("started"), "max_drop": args.max_drop}
+
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=1)
+    print(f"Report written to {args.output}")
+
+    failed = [r for r in report["results"] if r["status"] != "done"]
+    if regressions:
+        for stage, scale, before, after in regressions:
+            print(f"Regression: {stage} ({scale}) {before:,.0f} -> {after:,.0f}/s", file=sys.stderr)
+    if failed or regressions:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
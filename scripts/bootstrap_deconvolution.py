@@ -0,0 +1,296 @@
+''' Bootstrap confidence intervals of the deconvolution from the cached read probabilities.
+
+The read classification (res.csv or res.parquet of deconvolute, fast_deconvolution.py or
+sharded_classification.py merge) already has the cell-type probability of every read, so the model does
+not have to run again. The reads used by the estimation (n_cpg > 0) are cached once as NumPy arrays in
+<deconvolution dir>/read_probs/ (rebuilt when the read classification changes). Every bootstrap replicate
+resamples the reads with a row of a multinomial weight matrix (collapsed reads are drawn in proportion to
+their XC count) and estimates the proportions again:
+- two cell types (T and N): the maximum likelihood tumour fraction of purity_estimation, found with batched
+  Newton steps for all replicates of a chunk at once and snapped to the same grid (--n-grid);
+- more cell types: the constrained maximum likelihood of optimise_nll_deconvolute, per replicate.
+The chunks of replicates run in a process pool, each with its own seed derived from --seed, so the result
+does not depend on --jobs. The percentile intervals and the bootstrap standard error are added as columns
+to deconvolution.csv, the replicate estimates are written to bootstrap.csv. The estimation adjustment
+(--adjustment) is not bootstrapped.
+
+python bootstrap_deconvolution.py tmp/deconvolution/ --train tmp/train_seq.csv -n 2000 -j 8
+'''
+
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy.optimize import minimize
+
+from columnar import is_parquet, iter_chunks, parquet_columns
+import fast_deconvolution as fd
+from memmap_dataset import WEIGHT_COLUMN
+
+CACHE_DIR = "read_probs"
+N_BOOTSTRAP = 1000
+CONFIDENCE = 0.95
+N_GRID = 10000
+SEED = 42
+CHUNK_REPLICATES = 64  # replicates per task
+MAX_WEIGHT_ELEMENTS = 5_000_000  # entries of the weight matrix of one task (fewer replicates for many reads)
+MAX_ITERATIONS = 100
+BOUND = 1e-10  # bounds of the proportions in optimise_nll_deconvolute
+CI_COLUMNS = ["ci_level", "ci_lower", "ci_upper", "bootstrap_se"]
+
+# Reads and margins of a worker process, set by init_worker
+worker_state = {}
+
+def res_file(deconvolution_dir):
+    """The read classification table of a deconvolution directory (res.parquet or res.csv)."""
+    for name in ("res.parquet", "res.csv"):
+        path = os.path.join(deconvolution_dir, name)
+        if os.path.exists(path):
+            return path
+    raise FileNotFoundError(f"No res.csv or res.parquet in {deconvolution_dir}, run the deconvolution first")
+
+def read_res_chunks(res_path, chunksize=1_000_000):
+    """The columns needed for the estimation, in chunks."""
+    columns = parquet_columns(res_path) if is_parquet(res_path) else pd.read_csv(res_path, sep="\t", nrows=0).columns
+    usecols = [c for c in ("n_cpg", "P_ctype", "dmr_ctype", WEIGHT_COLUMN) if c in columns]
+    if is_parquet(res_path):
+        return iter_chunks(res_path, usecols)
+    return pd.read_csv(res_path, sep="\t", usecols=usecols, dtype={"dmr_ctype": str}, chunksize=chunksize)
+
+def build_cache(res_path, cache_dir):
+    """Write the probabilities, cell types and counts of the reads with CpGs to cache_dir."""
+    probs, ctypes, counts = [], [], []
+    for chunk in read_res_chunks(res_path):
+        chunk = chunk[chunk["n_cpg"] > 0]
+        probs.append(chunk["P_ctype"].to_numpy(dtype=np.float32))
+        ctypes.append(chunk["dmr_ctype"].astype(str).to_numpy() if "dmr_ctype" in chunk else np.full(len(chunk), ""))
+        if WEIGHT_COLUMN in chunk:
+            counts.append(pd.to_numeric(chunk[WEIGHT_COLUMN], errors="coerce").fillna(1).to_numpy(dtype=np.float32))
+        else:
+            counts.append(np.ones(len(chunk), dtype=np.float32))
+    codes, names = pd.factorize(np.concatenate(ctypes) if ctypes else np.empty(0, dtype=str), sort=True)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    np.save(os.path.join(cache_dir, "p_ctype.npy"), np.concatenate(probs) if probs else np.empty(0, dtype=np.float32))
+    np.save(os.path.join(cache_dir, "dmr_ctype.npy"), codes.astype(np.int32))
+    np.save(os.path.join(cache_dir, "count.npy"), np.concatenate(counts) if counts else np.empty(0, dtype=np.float32))
+    # Written last, an interrupted build is rebuilt
+    stat = os.stat(res_path)
+    with open(os.path.join(cache_dir, "meta.json"), "w") as f:
+        json.dump({"source": os.path.abspath(res_path), "size": stat.st_size, "mtime": stat.st_mtime,
+                   "dmr_ctypes": [str(name) for name in names]}, f)
+
+def cached_read_probs(deconvolution_dir):
+    """Directory with the cached read probabilities of a deconvolution, built if missing or outdated."""
+    res_path = res_file(deconvolution_dir)
+    cache_dir = os.path.join(deconvolution_dir, CACHE_DIR)
+    stat = os.stat(res_path)
+    try:
+        with open(os.path.join(cache_dir, "meta.json")) as f:
+            meta = json.load(f)
+        current = (meta["source"], meta["size"], meta["mtime"]) == (os.path.abspath(res_path), stat.st_size, stat.st_mtime)
+    except (OSError, ValueError, KeyError):
+        current = False
+    if not current:
+        print(f"Caching the read probabilities of {res_path} in {cache_dir}")
+        build_cache(res_path, cache_dir)
+    return cache_dir
+
+def load_reads(cache_dir, margins):
+    """
+    The terms of the likelihood of the cached reads.
+
+    Parameters:
+    cache_dir (str): Directory written by build_cache.
+    margins (pandas.Series): Fractions of the cell types in the training data.
+
+    Returns:
+    dict: a and d (likelihood of a read a + theta * d), the cell-type index of every read
+    (multi cell types only), the read counts, and the cell types of the estimate.
+    """
+    with open(os.path.join(cache_dir, "meta.json")) as f:
+        meta = json.load(f)
+    p = np.load(os.path.join(cache_dir, "p_ctype.npy")).astype(np.float64)
+    counts = np.load(os.path.join(cache_dir, "count.npy")).astype(np.float64)
+
+    if len(margins) == 2:
+        # purity_estimation: theta is the tumour fraction, the read likelihood is (1-theta) P_N/m_N + theta P_T/m_T
+        m_n, m_t = margins[["N", "T"]].tolist()
+        a = (1 - p) / m_n
+        return {"a": a, "d": p / m_t - a, "ctype": None, "counts": counts, "cell_types": ["T", "N"]}
+    if len(margins) < 2:
+        raise RuntimeError(f"There are less than two cell types in the training data set. {margins.keys()}")
+
+    # optimise_nll_deconvolute: theta_k for the reads of the DMRs of cell type k, reads of other cell types are not used
+    cell_types = [str(c) for c in margins.keys()]
+    code_to_ctype = np.array([cell_types.index(name) if name in cell_types else -1 for name in meta["dmr_ctypes"]] + [-1])
+    ctype = code_to_ctype[np.load(os.path.join(cache_dir, "dmr_ctype.npy"))]
+    used = ctype >= 0
+    m = margins.to_numpy(dtype=np.float64)[ctype[used]]
+    a = (1 - p[used]) / (1 - m)
+    return {"a": a, "d": p[used] / m - a, "ctype": ctype[used], "counts": counts[used], "cell_types": cell_types,
+            "margins": margins.to_numpy(dtype=np.float64)}
+
+def log_likelihood(weights, a, d, theta):
+    with np.errstate(divide="ignore"):
+        return (weights * np.log(a + theta[:, None] * d)).sum(axis=1)
+
+def purity_mle(weights, a, d, n_grid=N_GRID):
+    """
+    Tumour fraction of grid_search for every row of weights (replicates x reads), without evaluating the grid.
+
+    The log-likelihood is concave in theta, so its maximum on the grid is next to the continuous maximum:
+    that is found with safeguarded Newton steps (bisection when a step leaves the bracket), for all
+    replicates at once, and then compared with its two neighbours on the grid.
+
+    Returns:
+    numpy.ndarray: Tumour fraction of every replicate.
+    """
+    n_replicates = len(weights)
+    theta_max = (n_grid - 1) * (1 / n_grid)
+
+    def gradient(rows, theta):
+        ratio = d / (a + theta[:, None] * d)
+        w = weights[rows]
+        return (w * ratio).sum(axis=1), -(w * ratio ** 2).sum(axis=1)
+
+    all_rows = np.arange(n_replicates)
+    lo, hi = np.zeros(n_replicates), np.full(n_replicates, theta_max)
+    g_lo, _ = gradient(all_rows, lo)
+    g_hi, _ = gradient(all_rows, hi)
+    # Maximum at a bound if the likelihood falls (rises) over the whole range
+    theta = np.where(g_lo <= 0, 0.0, np.where(g_hi >= 0, theta_max, theta_max / 2))
+    active = np.flatnonzero((g_lo > 0) & (g_hi < 0))
+    tolerance = 0.01 / n_grid
+    for _ in range(MAX_ITERATIONS):
+        if not len(active):
+            break
+        t = theta[active]
+        g, h = gradient(active, t)
+        lo[active] = np.where(g > 0, t, lo[active])
+        hi[active] = np.where(g > 0, hi[active], t)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            step = t - g / h
+        inside = (step > lo[active]) & (step < hi[active])
+        new = np.where(inside, step, (lo[active] + hi[active]) / 2)
+        theta[active] = new
+        active = active[(np.abs(new - t) > tolerance) & (hi[active] - lo[active] > tolerance)]
+
+    # The better of the two neighbouring grid points (the lower one on ties, like argmax)
+    k = np.clip(np.floor(theta * n_grid), 0, n_grid - 1)
+    lower, upper = k * (1 / n_grid), np.minimum(k + 1, n_grid - 1) * (1 / n_grid)
+    return np.where(log_likelihood(weights, a, d, upper) > log_likelihood(weights, a, d, lower), upper, lower)
+
+def multi_mle(weights, a, d, ctype, margins):
+    """Proportions of optimise_nll_deconvolute for every row of weights (replicates x reads)."""
+    n_ctypes = len(margins)
+    estimates = np.empty((len(weights), n_ctypes))
+    for i, w in enumerate(weights):
+        def nll(theta):
+            x = a + theta[ctype] * d
+            with np.errstate(divide="ignore"):
+                return -np.dot(w, np.log(x)), -np.bincount(ctype, weights=w * d / x, minlength=n_ctypes)
+        estimates[i] = minimize(nll, margins, jac=True, method="SLSQP",
+                                bounds=[(BOUND, 1 - BOUND)] * n_ctypes,
+                                constraints={"type": "eq", "fun": lambda x: np.sum(x) - 1}).x
+    return estimates
+
+def estimate(weights, reads, n_grid=N_GRID):
+    """Proportions of the cell types (in the order of reads["cell_types"]) for every row of weights."""
+    if reads["ctype"] is None:
+        theta = purity_mle(weights, reads["a"], reads["d"], n_grid)
+        return np.column_stack([theta, 1 - theta])
+    return multi_mle(weights, reads["a"], reads["d"], reads["ctype"], reads["margins"])
+
+def init_worker(cache_dir, margins, n_grid):
+    worker_state.update(load_reads(cache_dir, margins), n_grid=n_grid)
+
+def run_replicates(seed, n_replicates):
+    """Estimates of n_replicates bootstrap replicates, drawn with the seed (a numpy SeedSequence)."""
+    counts = worker_state["counts"]
+    total = counts.sum()
+    # A multinomial draw of all reads: every row gives how often each (collapsed) read is in the replicate
+    weights = np.random.default_rng(seed).multinomial(int(round(total)), counts / total, size=n_replicates)
+    return estimate(weights.astype(np.float64), worker_state, worker_state["n_grid"])
+
+def replicate_chunks(n_bootstrap, n_reads):
+    """Numbers of replicates per task, fixed by the number of reads (not by the number of processes)."""
+    size = max(1, min(CHUNK_REPLICATES, MAX_WEIGHT_ELEMENTS // max(n_reads, 1)))
+    return [min(size, n_bootstrap - start) for start in range(0, n_bootstrap, size)]
+
+def bootstrap_deconvolution(deconvolution_dir, train_file, n_bootstrap=N_BOOTSTRAP, confidence=CONFIDENCE,
+                            jobs=1, seed=SEED, n_grid=N_GRID):
+    """
+    Bootstrap the proportion estimate of a deconvolution and add the confidence intervals to deconvolution.csv.
+
+    Parameters:
+    deconvolution_dir (str): Output directory of the deconvolution (res.csv or res.parquet, deconvolution.csv).
+    train_file (str): Training data (CSV or Parquet) for the cell-type margins, as in the deconvolution.
+    n_bootstrap (int): Number of bootstrap replicates.
+    confidence (float): Level of the percentile intervals.
+    jobs (int): Worker processes.
+    seed (int): Random seed.
+    n_grid (int): Grid size of the purity estimation (two cell types).
+
+    Returns:
+    pandas.DataFrame: deconvolution.csv with the columns ci_level, ci_lower, ci_upper and bootstrap_se.
+    """
+    deconvolution_file = os.path.join(deconvolution_dir, "deconvolution.csv")
+    if not os.path.exists(deconvolution_file):
+        raise FileNotFoundError(f"{deconvolution_file} is missing, run the deconvolution first")
+    cache_dir = cached_read_probs(deconvolution_dir)
+    margins = fd.train_margins(fd.read_train_ctypes(train_file))
+    reads = load_reads(cache_dir, margins)
+    if not len(reads["a"]):
+        raise ValueError("There are no reads selected for deconvolution. It may mean all of the reads do not have CpG methylation.")
+
+    point = pd.Series(estimate(reads["counts"][None, :], reads, n_grid)[0], index=reads["cell_types"])
+    chunks = replicate_chunks(n_bootstrap, len(reads["a"]))
+    seeds = np.random.SeedSequence(seed).spawn(len(chunks))
+    print(f"{n_bootstrap} bootstrap replicates of {len(reads['a'])} reads in {len(chunks)} tasks")
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=(cache_dir, margins, n_grid)) as pool:
+        estimates = np.concatenate(list(pool.map(run_replicates, seeds, chunks)))
+
+    replicates = pd.DataFrame(estimates, columns=reads["cell_types"])
+    replicates.to_csv(os.path.join(deconvolution_dir, "bootstrap.csv"), sep="\t", header=True, index=False)
+
+    alpha = (1 - confidence) / 2
+    ci = pd.DataFrame({"cell_type": reads["cell_types"], "ci_level": confidence,
+                       "ci_lower": np.quantile(estimates, alpha, axis=0),
+                       "ci_upper": np.quantile(estimates, 1 - alpha, axis=0),
+                       "bootstrap_se": estimates.std(axis=0, ddof=1) if n_bootstrap > 1 else np.nan})
+    deconv_res = pd.read_csv(deconvolution_file, sep="\t")
+    deconv_res["cell_type"] = deconv_res["cell_type"].astype(str)
+    differs = (deconv_res.set_index("cell_type")["pred"] - point).abs() > 1 / n_grid + 1e-9
+    if differs.any():
+        print(f"Warning: the estimate of the cached reads ({point.round(4).to_dict()}) differs from {deconvolution_file}, "
+              "e.g. after the estimation adjustment; the intervals are those of the unadjusted estimate")
+    deconv_res = deconv_res.drop(columns=[c for c in CI_COLUMNS if c in deconv_res.columns]).merge(ci, on="cell_type", how="left")
+    tmp_file = deconvolution_file + ".tmp"
+    deconv_res.to_csv(tmp_file, sep="\t", header=True, index=False)
+    os.replace(tmp_file, deconvolution_file)
+    return deconv_res
+
+def main():
+    parser = argparse.ArgumentParser(description="Bootstrap confidence intervals of the deconvolution from the cached read probabilities.")
+    parser.add_argument("deconvolution", nargs="?", default=fd.OUTPUT_DIR, help=f"Deconvolution output directory (default: {fd.OUTPUT_DIR})")
+    parser.add_argument("--train", default=fd.TRAIN_FILE, help=f"Training data (CSV or Parquet) for the cell-type margins (default: {fd.TRAIN_FILE})")
+    parser.add_argument("-n", "--n-bootstrap", type=int, default=N_BOOTSTRAP, help=f"Number of bootstrap replicates (default: {N_BOOTSTRAP})")
+    parser.add_argument("--confidence", type=float, default=CONFIDENCE, help=f"Confidence level of the intervals (default: {CONFIDENCE})")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="Worker processes (default: all cores)")
+    parser.add_argument("--seed", type=int, default=SEED, help=f"Random seed (default: {SEED})")
+    parser.add_argument("--n-grid", type=int, default=N_GRID, help=f"Grid size of the purity estimation, as in the deconvolution (default: {N_GRID})")
+    args = parser.parse_args()
+    if not 0 < args.confidence < 1:
+        parser.error("--confidence must be between 0 and 1")
+
+    deconv_res = bootstrap_deconvolution(args.deconvolution, args.train, args.n_bootstrap, args.confidence,
+                                         args.jobs, args.seed, args.n_grid)
+    print(deconv_res.to_string(index=False))
+    print(f"Confidence intervals added to {os.path.join(args.deconvolution, 'deconvolution.csv')}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+''' Length-bucketed dynamic batching for the fine-tuning and deconvolution DataLoaders.
+
+LengthBucketBatchSampler groups reads of similar token length into the same batch, and limits the
+batches by the number of tokens (reads x longest read of the batch) instead of the number of reads.
+BucketCollator pads the batch only up to its longest read.
+
+MethylBERT's read classifier (MethylBertEmbeddedDMR) is a Linear layer over all seq_len+1 positions, so
+for this model the batches must keep the full length: use BucketCollator(trim=False) and
+pad_len=seq_len+1 in the sampler. Trimming only works for models that take any sequence length.
+For MethylBERT the padding can instead be reduced with a smaller seq_len at fine-tuning time, see
+max_read_length.
+
+sampler = LengthBucketBatchSampler(read_lengths(train_dataset), max_tokens=8192, pad_len=seq_len+1)
+DataLoader(train_dataset, batch_sampler=sampler, collate_fn=BucketCollator(trim=False))
+'''
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+from torch.utils.data.dataloader import default_collate
+
+SEQUENCE_KEYS = ("dna_seq", "methyl_seq")
+
+def read_lengths(dataset):
+    """
+    Number of used token positions of every read (SOS, k-mers and EOS).
+
+    Parameters:
+    dataset: MemmapFinetuneDataset or MethylBertFinetuneDataset.
+
+    Returns:
+    numpy.ndarray: Token lengths, at most seq_len+1.
+    """
+    if hasattr(dataset, "arrays"):
+        # Memory-mapped dataset: the EOS token marks the end of the read
+        dna = dataset.arrays["dna_seq"]
+        lengths = np.empty(len(dataset), dtype=np.int64)
+        for start in range(0, len(dataset), 100_000):
+            rows = np.asarray(dna[start:start + 100_000])
+            lengths[start:start + len(rows)] = np.argmax(rows == dataset.vocab.eos_index, axis=1) + 1
+        return lengths
+    n_kmers = np.array([len(line["dna_seq"].split(" ")) for line in dataset.lines])
+    return np.minimum(n_kmers + 2, dataset.seq_len + 1)
+
+def max_read_length(dataset, quantile=1.0):
+    """Number of k-mers of the longest read (or the given quantile), a lower bound for seq_len that truncates no read."""
+    return int(np.ceil(np.quantile(read_lengths(dataset), quantile))) - 2
+
+class LengthBucketBatchSampler(Sampler):
+    """
+    Batch sampler that puts reads of similar length into the same batch.
+
+    Parameters:
+    lengths (array): Token length of every read (see read_lengths).
+    max_tokens (int): Maximum number of tokens per batch (reads x padded length).
+    pad_len (int): Padded length of every read if the batches are not trimmed (None: longest read of the batch).
+    max_batch_size (int): Maximum number of reads per batch (None: only limited by max_tokens).
+    shuffle (bool): Shuffle the reads within the same length and the order of the batches, new for every epoch.
+    seed (int): Random seed of the shuffling.
+    """
+
+    def __init__(self, lengths, max_tokens, pad_len=None, max_batch_size=None, shuffle=True, seed=0):
+        self.lengths = np.asarray(lengths)
+        self.max_tokens = max_tokens
+        self.pad_len = pad_len
+        self.max_batch_size = max_batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        if self.lengths.size and (pad_len or self.lengths.max()) > max_tokens:
+            raise ValueError(f"max_tokens ({max_tokens}) is smaller than the longest read")
+        self._n_batches = len(self._batches(np.random.default_rng(seed)))
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _batches(self, rng):
+        if self.shuffle:
+            # Sort by length, random order within the same length
+            order = np.lexsort((rng.random(len(self.lengths)), self.lengths))
+        else:
+            order = np.argsort(self.lengths, kind="stable")
+
+        batches, batch, batch_len = [], [], 0
+        for index in order:
+            # The reads come in increasing length, so the current read is the longest of the batch
+            length = self.pad_len or self.lengths[index]
+            full = (len(batch) + 1) * max(batch_len, length) > self.max_tokens
+            if batch and (full or len(batch) == self.max_batch_size):
+                batches.append(batch)
+                batch, batch_len = [], 0
+            batch.append(int(index))
+            batch_len = max(batch_len, length)
+        if batch:
+            batches.append(batch)
+
+        if self.shuffle:
+            rng.shuffle(batches)
+        return batches
+
+    def __iter__(self):
+        rng = np.random.default_rng([self.seed, self.epoch])
+        self.epoch += 1
+        return iter(self._batches(rng))
+
+    def __len__(self):
+        return self._n_batches
+
+class BucketCollator:
+    """
+    Collate function for LengthBucketBatchSampler batches.
+
+    Parameters:
+    trim (bool): Cut dna_seq and methyl_seq after the longest read of the batch. Must be False for MethylBERT,
+                 whose read classifier needs all seq_len+1 positions.
+    pad_index (int): Padding token of dna_seq.
+    """
+
+    def __init__(self, trim=True, pad_index=0):
+        self.trim = trim
+        self.pad_index = pad_index
+
+    def __call__(self, items):
+        batch = default_collate(items)
+        if self.trim:
+            used = (batch["dna_seq"] != self.pad_index).any(dim=0)
+            length = int(torch.nonzero(used).max()) + 1
+            for key in SEQUENCE_KEYS:
+                batch[key] = batch[key][:, :length]
+        return batch
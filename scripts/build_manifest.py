@@ -0,0 +1,188 @@
+''' Builds the manifest of the atlas samples and writes fine_tune_data.txt from it.
+
+Scans the BAM directory (and the PAT directory) in parallel. The read counts come from the BAM index
+(mapped and unmapped reads per contig, no reads are decoded); BAM files without an index (e.g. the
+unsorted output of process_pat_files.py) are counted with samtools view -c, or skipped with --index-only.
+Files of the same sample (the part of the file name before the first ".", e.g. both
+GSM5652176_Adipocytes-Z000000T7.bam and GSM5652176_Adipocytes-Z000000T7.hg38.bam) are duplicates: only
+one of them is used, preferably the conversion of the current PAT file, otherwise the one with most reads.
+The cell type is taken from the file name as in extract_cell_types.py and mapped to its class label with
+cell_types.tsv; samples of unknown cell types are left out. --max-per-class keeps only the samples with
+most reads of every class.
+
+The stats table has one row per file (sample, cell type, label, reads, size, duplicate_of, selected),
+--class-stats one row per class with the reads and the fraction every class would be downsampled to
+for balanced classes.
+
+python build_manifest.py --bam-dir ../data/bam_for_fine_tuning --pat-dir ../data/pat -o ../fine_tune_data.txt --stats ../data/atlas_stats.tsv -j 8
+'''
+
+import argparse
+import os
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import pysam
+
+BAM_DIR = "../data/bam_for_fine_tuning"
+PAT_DIR = "../data/pat"
+CELL_TYPES = "../cell_types.tsv"
+FILE_LIST = "../fine_tune_data.txt"
+STATS = "../data/atlas_stats.tsv"
+# Cell type in the file name, the same pattern as extract_cell_types.py
+CELL_TYPE_PATTERN = re.compile(r'^GSM\d+_([^-]+)-')
+
+def sample_name(filename):
+    """Sample of a BAM or PAT file: the file name up to the first "." (without the genome build and extension)."""
+    return filename.split(".")[0]
+
+def bam_stats(bam_file, index_only=False):
+    """
+    Read counts of a BAM file, from its index if it has one.
+
+    Returns:
+    dict: n_reads, n_mapped (None if unknown), count_source (index, scan or none), size and modification time.
+    """
+    stats = {"bytes": os.path.getsize(bam_file), "mtime": os.path.getmtime(bam_file)}
+    with pysam.AlignmentFile(bam_file) as bam:
+        if bam.has_index():
+            # mapped and unmapped are stored in the index, no reads are read
+            return {**stats, "n_reads": bam.mapped + bam.unmapped, "n_mapped": bam.mapped, "count_source": "index"}
+    if index_only:
+        return {**stats, "n_reads": None, "n_mapped": None, "count_source": "none"}
+    # Counted by htslib without creating Python objects for the reads
+    n_reads = int(pysam.view("-c", bam_file).strip())
+    n_unmapped = int(pysam.view("-c", "-f", "4", bam_file).strip())
+    return {**stats, "n_reads": n_reads, "n_mapped": n_reads - n_unmapped, "count_source": "scan"}
+
+def read_cell_types(cell_types_file):
+    """Class label of every cell type (cell_types.tsv with the columns "Cell type" and "Class")."""
+    mapping = pd.read_csv(cell_types_file, sep="\t", dtype=str)
+    return dict(zip(mapping["Cell type"].str.strip(), mapping["Class"].str.strip()))
+
+def scan_files(bam_dir, pat_dir=None, jobs=1, index_only=False):
+    """
+    One row per BAM file with its sample, read counts and the PAT file of the sample, counted in parallel.
+    PAT files without BAM file get a row without BAM statistics.
+    """
+    bam_files = sorted(os.path.join(bam_dir, f) for f in os.listdir(bam_dir) if f.endswith(".bam") and not f.startswith("."))
+    pat_files = {}
+    if pat_dir and os.path.isdir(pat_dir):
+        for f in sorted(os.listdir(pat_dir)):
+            if f.endswith(".pat.gz"):
+                pat_files.setdefault(sample_name(f), []).append(os.path.join(pat_dir, f))
+
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        stats = list(pool.map(bam_stats, bam_files, [index_only] * len(bam_files)))
+
+    rows = []
+    for bam_file, bam_stat in zip(bam_files, stats):
+        name = os.path.basename(bam_file)
+        pats = pat_files.get(sample_name(name), [])
+        # The BAM written by process_pat_files.py for a PAT file has the same name up to the extension
+        current = any(os.path.basename(pat)[:-len(".pat.gz")] == name[:-len(".bam")] for pat in pats)
+        rows.append({"sample": sample_name(name), "bam": bam_file, "pat": pats[0] if pats else None,
+                     "from_current_pat": current, **bam_stat})
+    converted = {row["sample"] for row in rows}
+    for sample, pats in pat_files.items():
+        if sample not in converted:
+            rows.append({"sample": sample, "bam": None, "pat": pats[0], "from_current_pat": False,
+                         "bytes": None, "mtime": None, "n_reads": None, "n_mapped": None, "count_source": None})
+    return pd.DataFrame(rows).astype({"n_reads": "Int64", "n_mapped": "Int64", "bytes": "Int64"})
+
+def build_manifest(files, cell_types, max_per_class=None):
+    """
+    Add the cell type, the label, the duplicates and the selection to the scanned files.
+
+    Parameters:
+    files (pandas.DataFrame): Output of scan_files.
+    cell_types (dict): Class label of every cell type.
+    max_per_class (int): Keep at most this many samples per class, those with most reads (None: all).
+
+    Returns:
+    pandas.DataFrame: The files with the columns cell_type, label, duplicate_of and selected.
+    """
+    manifest = files.copy()
+    manifest["cell_type"] = [m.group(1) if m else None for m in map(CELL_TYPE_PATTERN.match, manifest["sample"])]
+    manifest["label"] = manifest["cell_type"].map(cell_types)
+
+    # One BAM per sample: the conversion of the current PAT file, then most reads, then by name
+    has_bam = manifest["bam"].notna()
+    ranked = manifest[has_bam].assign(_reads=manifest["n_reads"].fillna(-1)) \
+        .sort_values(["sample", "from_current_pat", "_reads", "bam"], ascending=[True, False, False, True])
+    kept = ranked.drop_duplicates("sample")
+    manifest["duplicate_of"] = manifest["sample"].map(kept.set_index("sample")["bam"])
+    manifest.loc[manifest["duplicate_of"] == manifest["bam"], "duplicate_of"] = None
+    manifest.loc[~has_bam, "duplicate_of"] = None
+
+    selected = has_bam & manifest["duplicate_of"].isna() & manifest["label"].notna()
+    if max_per_class is not None:
+        candidates = manifest[selected].assign(_reads=manifest["n_reads"].fillna(-1)) \
+            .sort_values(["label", "_reads", "bam"], ascending=[True, False, True])
+        keep = candidates.groupby("label").head(max_per_class).index
+        selected &= manifest.index.isin(keep)
+    manifest["selected"] = selected
+
+    columns = ["sample", "cell_type", "label", "bam", "pat", "n_reads", "n_mapped", "count_source", "bytes",
+               "duplicate_of", "selected"]
+    return manifest[columns].sort_values(["sample", "bam"], na_position="last").reset_index(drop=True)
+
+def class_stats(manifest):
+    """Samples and reads of the selected files per class, and the fraction of reads to keep for balanced classes."""
+    selected = manifest[manifest["selected"]]
+    stats = selected.groupby(["label", "cell_type"], dropna=False) \
+        .agg(samples=("bam", "size"), n_reads=("n_reads", "sum")).reset_index()
+    smallest = stats["n_reads"][stats["n_reads"] > 0].min()
+    stats["downsample_to"] = (smallest / stats["n_reads"]).where(stats["n_reads"] > 0).clip(upper=1)
+    # Numeric labels in numeric order
+    return stats.sort_values("label", key=lambda labels: pd.to_numeric(labels, errors="coerce"), kind="stable").reset_index(drop=True)
+
+def write_file_list(manifest, output):
+    """Write the selected BAM files with their labels in the format of fine_tune_data.txt, atomically."""
+    selected = manifest[manifest["selected"]].sort_values("bam")
+    tmp_output = f"{output}.{os.getpid()}.tmp"
+    with open(tmp_output, "w") as f:
+        f.writelines(f"{bam}\t{label}\n" for bam, label in zip(selected["bam"], selected["label"]))
+    os.replace(tmp_output, output)
+    return len(selected)
+
+def main():
+    parser = argparse.ArgumentParser(description="Scan the atlas BAM files, detect duplicates, assign labels and write fine_tune_data.txt.")
+    parser.add_argument("--bam-dir", default=BAM_DIR, help=f"Directory with the BAM files (default: {BAM_DIR})")
+    parser.add_argument("--pat-dir", default=PAT_DIR, help=f"Directory with the PAT files (default: {PAT_DIR})")
+    parser.add_argument("--cell-types", default=CELL_TYPES, help=f"Cell type to class mapping (default: {CELL_TYPES})")
+    parser.add_argument("-o", "--output", default=FILE_LIST, help=f"File list for finetune_data_generate (default: {FILE_LIST})")
+    parser.add_argument("--stats", default=STATS, help=f"Table with one row per file (default: {STATS})")
+    parser.add_argument("--class-stats", default=None, help="Table with the reads per class and the downsampling fractions")
+    parser.add_argument("--max-per-class", type=int, default=None, help="Keep at most this many samples per class (those with most reads)")
+    parser.add_argument("--index-only", action="store_true", help="Do not count the reads of BAM files without index")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="Number of BAM files read at once (default: all cores)")
+    args = parser.parse_args()
+
+    files = scan_files(args.bam_dir, args.pat_dir, args.jobs, args.index_only)
+    if files.empty:
+        sys.exit(f"No BAM or PAT files found in {args.bam_dir} and {args.pat_dir}")
+    manifest = build_manifest(files, read_cell_types(args.cell_types), args.max_per_class)
+
+    os.makedirs(os.path.dirname(args.stats) or ".", exist_ok=True)
+    manifest.to_csv(args.stats, sep="\t", header=True, index=False)
+    classes = class_stats(manifest)
+    if args.class_stats:
+        classes.to_csv(args.class_stats, sep="\t", header=True, index=False)
+    n_written = write_file_list(manifest, args.output)
+
+    duplicates = manifest["duplicate_of"].notna().sum()
+    unlabeled = manifest[manifest["bam"].notna() & manifest["label"].isna()]
+    not_converted = manifest["bam"].isna().sum()
+    print(classes.to_string(index=False))
+    print(f"{duplicates} duplicate BAM file(s) left out")
+    if len(unlabeled):
+        print(f"{len(unlabeled)} BAM file(s) without a class in {args.cell_types}: {', '.join(sorted(set(unlabeled['sample'])))}")
+    if not_converted:
+        print(f"{not_converted} PAT file(s) without BAM file")
+    print(f"{n_written} BAM files written to {args.output}, statistics in {args.stats}")
+
+if __name__ == "__main__":
+    main()
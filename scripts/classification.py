@@ -1,11 +1,12 @@
 ''' Second part of the MethylBERT procedure. Fine Tuning needs to be finished. '''
 
 import torch
-from methylbert.data import finetune_data_generate as fdg
+from fdg_cache import cached_finetune_data_generate
+import instrumentation
 from methylbert.utils import set_seed
 from torch.utils.data import DataLoader
 from methylbert.data.vocab import MethylVocab
-from methylbert.data.dataset import MethylBertFinetuneDataset
+from memmap_dataset import memmap_finetune_dataset
 from methylbert.trainer import MethylBertFinetuneTrainer
 import os
 import pandas as pd
@@ -19,6 +20,9 @@ from methylbert.deconvolute import deconvolute
 
 '''
 
+# Timings and resources, written if METRICS_REPORT / METRICS_PROMETHEUS are set (see instrumentation.py)
+instrumentation.start("classification")
+
 set_seed(42)
 seq_len=100
 n_mers=3
@@ -34,7 +38,7 @@ print("DMR COUInt", dmr_df.shape[0])
 
 f_bam = "../data/bam_for_classification/sorted_bulk_data.bam"
 
-fdg.finetune_data_generate(
+cached_finetune_data_generate(
     input_file = f_bam,
     f_dmr = f_dmr,
     f_ref = f_ref,
@@ -57,7 +61,7 @@ print(len(tokenizer))
 print("[2/6] Created tokenizer")
 
 # loading the bulk data
-dataset = MethylBertFinetuneDataset("tmp/data.csv", tokenizer, seq_len=seq_len)
+dataset = memmap_finetune_dataset("tmp/data.csv", tokenizer, seq_len=seq_len)
 data_loader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers)
 
 
@@ -66,7 +70,7 @@ print("[3/6] Created dataset")
 restore_dir = "tmp/fine_tune/"
 trainer = MethylBertFinetuneTrainer(len(tokenizer),
                                     train_dataloader=data_loader,
-                                    test_dataloader=data_loader, with_cude=False
+                                    test_dataloader=data_loader, with_cuda=False
                                     )
 print("[4/6] Trainer created")
 
@@ -87,6 +91,9 @@ print("[5/6] model loaded")
 '''
 df = pd.read_csv("tmp/train_seq.csv", sep="\t")
 print(len(df))
+# Collapsed reads (pat_to_sam.py --collapse) count as often as their XC tag for the cell-type margins
+if "XC" in df.columns:
+    df = df.loc[df.index.repeat(df["XC"].fillna(1).astype(int))]
 
 
 deconvolute(trainer = trainer,
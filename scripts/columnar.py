@@ -0,0 +1,206 @@
+''' Parquet storage for the tables passed between the stages, with conversion to and from the CSV layout.
+
+The read tables (train_seq.csv, test_seq.csv, data.csv), the read classification (res.csv), the CpG table
+(cpg_index_to_pos.tsv) and the methylation matrix of dmr_calling.py can be stored as Parquet files instead
+of text: typed columns (see COLUMN_TYPES, all other columns are strings), zstd compression, row groups of
+ROW_GROUP_SIZE rows that are read one at a time, and reading only the needed columns.
+
+The scripts take a .parquet file wherever they take one of these CSV files (memmap_dataset.py,
+fast_deconvolution.py --train, dmr_calling.py --matrix, convert_cpg_cites.py -o), and write res.parquet with
+--res-format parquet. pyarrow is only needed for Parquet files.
+
+python columnar.py to-parquet tmp/train_seq.csv tmp/test_seq.csv tmp/bulk/data.csv
+python columnar.py to-csv tmp/deconvolution/res.parquet
+'''
+
+import argparse
+import csv
+import json
+import os
+
+import pandas as pd
+
+ROW_GROUP_SIZE = 100_000
+COMPRESSION = "zstd"
+# Columns stored with a numeric type, all other columns are strings (methyl_seq is a string of digits)
+COLUMN_TYPES = {
+    # read tables (finetune_data_generate)
+    "flag": "int32", "ref_pos": "int64", "map_quality": "int32", "next_ref_pos": "int64", "length": "int32",
+    "dmr_label": "int32", "XC": "float32", "XD": "int32",
+    # read classification (res.csv)
+    "pred": "int8", "n_cpg": "int16", "P_ctype": "float32", "P_N": "float32",
+    # CpG table and methylation matrix
+    "index": "int64", "pos": "int64",
+}
+
+def require_pyarrow():
+    """Import pyarrow, with a hint if it is missing (it is only needed for Parquet files)."""
+    try:
+        import pyarrow
+        import pyarrow.csv
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError("Parquet files need pyarrow, install it with: pip install pyarrow") from e
+    return pyarrow
+
+def is_parquet(path):
+    return path.endswith(".parquet")
+
+def schema_for(columns, types=None):
+    """Arrow schema of a table with the given columns: COLUMN_TYPES (updated by types), strings for the rest."""
+    pa = require_pyarrow()
+    types = {**COLUMN_TYPES, **(types or {})}
+    return pa.schema([(column, pa.type_for_alias(types.get(column, "string"))) for column in columns])
+
+def csv_columns(csv_path, delimiter="\t"):
+    with open(csv_path, newline="") as f:
+        return next(csv.reader(f, delimiter=delimiter, quoting=csv.QUOTE_NONE))
+
+def csv_to_parquet(csv_path, parquet_path=None, delimiter="\t", types=None,
+                   row_group_size=ROW_GROUP_SIZE, compression=COMPRESSION):
+    """
+    Convert a CSV file into a Parquet file, streaming (the CSV is never loaded as a whole).
+
+    Parameters:
+    csv_path (str): Tab-separated file with a header line.
+    parquet_path (str): Output file (default: csv_path with the extension replaced by .parquet).
+    delimiter (str): Field separator.
+    types (dict): Column types (Arrow aliases like "int32") in addition to COLUMN_TYPES.
+    row_group_size (int): Rows per row group.
+    compression (str): Parquet compression codec.
+
+    Returns:
+    str: The Parquet file.
+    """
+    pa = require_pyarrow()
+    parquet_path = parquet_path or os.path.splitext(csv_path)[0] + ".parquet"
+    schema = schema_for(csv_columns(csv_path, delimiter), types)
+    reader = pa.csv.open_csv(csv_path,
+                             parse_options=pa.csv.ParseOptions(delimiter=delimiter, quote_char=False),
+                             convert_options=pa.csv.ConvertOptions(column_types=schema, strings_can_be_null=False))
+
+    # Written to a temporary file and renamed when complete, like the other outputs
+    tmp_path = parquet_path + ".tmp"
+    n_rows = 0
+    with pa.parquet.ParquetWriter(tmp_path, schema, compression=compression) as writer:
+        pending, n_pending = [], 0
+        for batch in reader:
+            pending.append(batch)
+            n_pending += batch.num_rows
+            if n_pending >= row_group_size:
+                writer.write_table(pa.Table.from_batches(pending, schema), row_group_size=row_group_size)
+                n_rows += n_pending
+                pending, n_pending = [], 0
+        if pending or n_rows == 0:
+            writer.write_table(pa.Table.from_batches(pending, schema), row_group_size=row_group_size)
+            n_rows += n_pending
+    os.replace(tmp_path, parquet_path)
+    print(f"Converted {n_rows} rows from {csv_path} to {parquet_path}")
+    return parquet_path
+
+def parquet_to_csv(parquet_path, csv_path=None, columns=None, delimiter="\t"):
+    """
+    Convert a Parquet file back into the CSV layout, one row group at a time.
+
+    Parameters:
+    parquet_path (str): Parquet file.
+    csv_path (str): Output file (default: parquet_path with the extension replaced by .csv).
+    columns (list): Columns to write (default: all).
+
+    Returns:
+    str: The CSV file.
+    """
+    csv_path = csv_path or os.path.splitext(parquet_path)[0] + ".csv"
+    n_rows = 0
+    with open(csv_path, "w") as f:
+        for i, chunk in enumerate(iter_chunks(parquet_path, columns)):
+            chunk.to_csv(f, sep=delimiter, header=i == 0, index=False)
+            n_rows += len(chunk)
+        if n_rows == 0:
+            f.write(delimiter.join(columns or parquet_columns(parquet_path)) + "\n")
+    print(f"Converted {n_rows} rows from {parquet_path} to {csv_path}")
+    return csv_path
+
+def parquet_columns(parquet_path):
+    require_pyarrow()
+    import pyarrow.parquet as pq
+    return pq.ParquetFile(parquet_path).schema_arrow.names
+
+def parquet_metadata(parquet_path):
+    """The metadata stored by write_parquet."""
+    require_pyarrow()
+    import pyarrow.parquet as pq
+    metadata = pq.ParquetFile(parquet_path).schema_arrow.metadata or {}
+    return {k.decode(): json.loads(v) for k, v in metadata.items() if k != b"pandas"}
+
+def iter_chunks(parquet_path, columns=None, chunksize=None):
+    """
+    Read a Parquet file as pandas DataFrames, one row group (or chunksize rows) at a time.
+
+    Parameters:
+    parquet_path (str): Parquet file.
+    columns (list): Columns to read (default: all), the others are not read from disk.
+    chunksize (int): Rows per DataFrame (default: the row groups of the file).
+    """
+    require_pyarrow()
+    import pyarrow.parquet as pq
+    parquet = pq.ParquetFile(parquet_path)
+    if chunksize is None:
+        for i in range(parquet.num_row_groups):
+            yield parquet.read_row_group(i, columns=columns).to_pandas()
+    else:
+        for batch in parquet.iter_batches(batch_size=chunksize, columns=columns):
+            yield batch.to_pandas()
+
+def read_parquet(parquet_path, columns=None):
+    """Read (the given columns of) a Parquet file into a DataFrame."""
+    require_pyarrow()
+    import pyarrow.parquet as pq
+    return pq.read_table(parquet_path, columns=columns).to_pandas()
+
+def write_parquet(df, parquet_path, types=None, metadata=None, row_group_size=ROW_GROUP_SIZE, compression=COMPRESSION):
+    """
+    Write a DataFrame as a Parquet file, with the column types of schema_for (numeric columns keep their type).
+    metadata (dict) is stored in the file as JSON, see parquet_metadata.
+    """
+    pa = require_pyarrow()
+    numeric = {**COLUMN_TYPES, **(types or {})}
+    # Numbers kept as strings (e.g. the columns of a MemmapFinetuneDataset), empty strings are missing values
+    parsed = {column: pd.to_numeric(df[column].replace("", None))
+              for column in df.columns if column in numeric and not pd.api.types.is_numeric_dtype(df[column])}
+    table = pa.Table.from_pandas(df.assign(**parsed), preserve_index=False)
+    fields = []
+    for field in table.schema:
+        if field.name in numeric:
+            field = schema_for([field.name], types).field(0)
+        elif pa.types.is_large_string(field.type) or field.type == pa.null():
+            field = pa.field(field.name, pa.string())
+        fields.append(field)
+    table = table.cast(pa.schema(fields, metadata={k: json.dumps(v) for k, v in (metadata or {}).items()}))
+    tmp_path = parquet_path + ".tmp"
+    pa.parquet.write_table(table, tmp_path, row_group_size=row_group_size, compression=compression)
+    os.replace(tmp_path, parquet_path)
+    return parquet_path
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert the tab-separated tables of the pipeline to Parquet and back.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    to_parquet = subparsers.add_parser("to-parquet", help="Convert CSV files to Parquet (next to the input)")
+    to_parquet.add_argument("files", nargs="+", help="Tab-separated files with a header line")
+    to_parquet.add_argument("--row-group-size", type=int, default=ROW_GROUP_SIZE, help=f"Rows per row group (default: {ROW_GROUP_SIZE})")
+    to_parquet.add_argument("--compression", default=COMPRESSION, help=f"Compression codec (default: {COMPRESSION})")
+
+    to_csv = subparsers.add_parser("to-csv", help="Convert Parquet files to tab-separated files (next to the input)")
+    to_csv.add_argument("files", nargs="+", help="Parquet files")
+    to_csv.add_argument("--columns", nargs="+", default=None, help="Columns to write (default: all)")
+    args = parser.parse_args()
+
+    for path in args.files:
+        if args.command == "to-parquet":
+            csv_to_parquet(path, row_group_size=args.row_group_size, compression=args.compression)
+        else:
+            parquet_to_csv(path, columns=args.columns)
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,51 @@
-# ''' script to convert cpg cites from .pkl format to .csv format. '''
+# ''' script to convert cpg cites from the CpG index to .tsv format (or .parquet, see columnar.py). '''
 
+import argparse
 
-import pickle
-import pandas as pd
+import numpy as np
 
-# Load your existing CpG sites file
-with open("../data/reference/cpg_sites.pkl", "rb") as f:
-    cpg_dict = pickle.load(f)  # Structure: { "chr1": [0, 1, 5, ...], ... }
+from columnar import COMPRESSION, is_parquet, require_pyarrow, schema_for
+from cpg_index import CpGIndex
 
-# Convert to flat table with global 1-based index and 1-based positions
-records = []
-index = 1
-for chrom in sorted(cpg_dict.keys()):
-    for pos in cpg_dict[chrom]:
-        records.append((index, chrom, pos + 1))  # convert to 1-based genome position
-        index += 1
+CPG_SITES = "../data/reference/cpg_sites"
+OUTPUT = "cpg_index_to_pos.tsv"
 
-# Create DataFrame
-df = pd.DataFrame(records, columns=["index", "chr", "pos"])
+def iter_cpg_table(cpg):
+    """Global 1-based index and 1-based positions of every chromosome, chromosomes sorted by name."""
+    index = 1
+    for chrom in sorted(cpg.chroms):
+        positions = cpg.positions(chrom).astype(np.int64) + 1  # convert to 1-based genome position
+        yield chrom, np.arange(index, index + len(positions)), positions
+        index += len(positions)
 
-# Save as TSV for R
-df.to_csv("cpg_index_to_pos.tsv", sep="\t", index=False)
-print(f"Saved {len(df)} CpG sites to cpg_index_to_pos.tsv")
+def write_cpg_table(cpg_index, output):
+    # Load your existing CpG index (memory-mapped, nothing is read up front)
+    cpg = CpGIndex(cpg_index)
+    n_sites = 0
+    if is_parquet(output):
+        # One row group per chromosome
+        pa = require_pyarrow()
+        schema = schema_for(["index", "chr", "pos"])
+        with pa.parquet.ParquetWriter(output, schema, compression=COMPRESSION) as writer:
+            for chrom, indices, positions in iter_cpg_table(cpg):
+                writer.write_table(pa.table([indices, pa.repeat(chrom, len(indices)), positions], schema=schema),
+                                   row_group_size=max(len(indices), 1))
+                n_sites += len(indices)
+    else:
+        # Write a flat table with global 1-based index and 1-based positions, chromosomes sorted by name
+        with open(output, "w") as out:
+            out.write("index\tchr\tpos\n")
+            for chrom, indices, positions in iter_cpg_table(cpg):
+                np.savetxt(out, np.column_stack([indices, positions]), fmt=f"%d\t{chrom}\t%d")
+                n_sites += len(indices)
+    print(f"Saved {n_sites} CpG sites to {output}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Write the CpG index as a table of global index, chromosome and position.")
+    parser.add_argument("--cpg-index", default=CPG_SITES, help=f"CpG index directory (default: {CPG_SITES})")
+    parser.add_argument("-o", "--output", default=OUTPUT, help=f"Output .tsv or .parquet file (default: {OUTPUT})")
+    args = parser.parse_args()
+    write_cpg_table(args.cpg_index, args.output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+''' Memory-mapped access to the CpG index written by extract_methylation_sites.py.
+
+CpG indices are 0-based, either per chromosome or global (position in the flat index,
+chromosomes in the order of chroms.tsv). Genomic positions are 0-based as well.
+'''
+
+import os
+import numpy as np
+
+from extract_methylation_sites import POSITIONS_FILE, CHROMS_FILE, POSITION_DTYPE
+
+class CpGIndex:
+    """
+    Read-only view on a CpG index directory.
+
+    The positions are memory-mapped, so opening the index is cheap and all
+    processes using the same index share the page cache.
+
+    Parameters:
+    index_dir (str): Directory containing positions.u32 and chroms.tsv.
+    """
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        self.chroms = []
+        self._offsets = {}
+        with open(os.path.join(index_dir, CHROMS_FILE)) as f:
+            next(f)  # header
+            for line in f:
+                chrom, offset, count = line.rstrip("\n").split("\t")
+                self.chroms.append(chrom)
+                self._offsets[chrom] = (int(offset), int(count))
+
+        self._n_sites = sum(count for _, count in self._offsets.values())
+        # Start offset of every chromosome plus the total number of sites
+        self._starts = np.array([self._offsets[c][0] for c in self.chroms] + [self._n_sites], dtype=np.int64)
+        path = os.path.join(index_dir, POSITIONS_FILE)
+        if os.path.getsize(path) == 0:
+            self._positions = np.zeros(0, dtype=POSITION_DTYPE)
+        else:
+            self._positions = np.memmap(path, dtype=POSITION_DTYPE, mode="r")
+
+    def __len__(self):
+        return self._n_sites
+
+    def __contains__(self, chrom):
+        return chrom in self._offsets
+
+    def count(self, chrom):
+        """Number of CpG sites on a chromosome."""
+        return self._offsets[chrom][1]
+
+    def offset(self, chrom):
+        """Global index of the first CpG site of a chromosome."""
+        return self._offsets[chrom][0]
+
+    def positions(self, chrom):
+        """All CpG positions of a chromosome as a read-only array (no copy)."""
+        offset, count = self._offsets[chrom]
+        return self._positions[offset:offset + count]
+
+    def position(self, chrom, idx):
+        """Genomic position of the idx-th CpG site of a chromosome."""
+        offset, count = self._offsets[chrom]
+        if not 0 <= idx < count:
+            raise IndexError(f"CpG index {idx} out of range for {chrom} ({count} sites)")
+        return int(self._positions[offset + idx])
+
+    def locus(self, global_idx):
+        """Return (chromosome, position) for a global CpG index."""
+        if not 0 <= global_idx < len(self._positions):
+            raise IndexError(f"Global CpG index {global_idx} out of range")
+        chrom_idx = int(np.searchsorted(self._starts, global_idx, side="right")) - 1
+        return self.chroms[chrom_idx], int(self._positions[global_idx])
+
+    def loci(self, global_indices):
+        """Vectorized locus(): return (chromosome index array, position array)."""
+        global_indices = np.asarray(global_indices, dtype=np.int64)
+        chrom_indices = np.searchsorted(self._starts, global_indices, side="right") - 1
+        return chrom_indices, np.asarray(self._positions[global_indices])
+
+    def index_of(self, chrom, pos):
+        """Per-chromosome index of the CpG site at pos, or -1 if pos is not a CpG site."""
+        return int(self.indices_of(chrom, [pos])[0])
+
+    def indices_of(self, chrom, positions):
+        """Vectorized index_of() for many positions on one chromosome (binary search)."""
+        chrom_positions = self.positions(chrom)
+        positions = np.asarray(positions, dtype=np.int64)
+        idx = np.searchsorted(chrom_positions, positions)
+        found = idx < len(chrom_positions)
+        found[found] = chrom_positions[idx[found]] == positions[found]
+        return np.where(found, idx, -1)
+
+    def global_index_of(self, chrom, pos):
+        """Global index of the CpG site at pos, or -1 if pos is not a CpG site."""
+        idx = self.index_of(chrom, pos)
+        return idx if idx < 0 else self.offset(chrom) + idx
+
+    def first_at_or_after(self, chrom, pos):
+        """Per-chromosome index of the first CpG site at or after pos."""
+        return int(np.searchsorted(self.positions(chrom), pos))
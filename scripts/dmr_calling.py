@@ -1,7 +1,7 @@
 ''' DMR data is calculated from the BigWig data files.
 The following should be provided:
 - path to bigwig data
-- file with the classes of the data in the order of processing (groups.txt)
+- file with the classes of the data in the order of processing, i.e. sorted file names (groups.txt)
 - output csv file
 
 '''
@@ -9,74 +9,307 @@ The following should be provided:
 #!/usr/bin/env python3
 
 import argparse
+import numpy as np
 import pyBigWig
 import pandas as pd
+from scipy import stats
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import io
 import subprocess
 import tempfile
+import threading
 import os
 
+from columnar import parquet_metadata, read_parquet, write_parquet
+from instrumentation import add_arguments, session_from_args, stage
+
+BLOCK_SIZE = 10_000_000  # bp read from a BigWig in one values() call
+WRITE_CHUNK = 100_000  # matrix rows formatted at once for metilene
+
 def read_groups_file(groups_path):
     with open(groups_path) as f:
         return [int(x) for x in f.read().strip().split()]
 
-def extract_common_cpgs(bigwig_files, max_sites=1_000_000):
-    """Extract common CpG positions across all BigWig files"""
-    site_sets = []
+def read_site_starts(bw_path, chrom):
+    """Sorted starts of all intervals of one chromosome in one BigWig file"""
+    bw = pyBigWig.open(bw_path)
+    intervals = bw.intervals(chrom) or ()
+    bw.close()
+    return np.fromiter((start for start, end, val in intervals), dtype=np.int64, count=len(intervals))
+
+@stage("dmr_calling.common_sites")
+def extract_common_cpgs(bigwig_files, max_sites=1_000_000, n_jobs=None):
+    """
+    Extract common CpG positions across all BigWig files.
+
+    Files are scanned in parallel per (file, chromosome). The sorted starts of every file are
+    intersected with the running intersection of their chromosome as soon as they arrive, so
+    memory does not grow with the number of files. At most
+    max_sites sites are kept in total, taking chromosomes in sorted order.
+
+    Returns {chrom: sorted int64 array of starts}
+    """
+    chroms_per_file = []
     for bw_path in bigwig_files:
         bw = pyBigWig.open(bw_path)
-        sites = set()
-        print(f"  Reading {os.path.basename(bw_path)}...")
-        for chrom in bw.chroms().keys():
-            values = bw.intervals(chrom)
-            if values:
-                for start, end, val in values:
-                    sites.add((chrom, start))
-                    if len(sites) >= max_sites:
-                        break
+        chroms_per_file.append(set(bw.chroms().keys()))
         bw.close()
-        print(f"    -> {len(sites)} sites extracted.")
-        site_sets.append(sites)
-
-    if not site_sets:
+    if not chroms_per_file:
         raise ValueError("No CpG sites found in any BigWig file.")
+    chroms = sorted(set.intersection(*chroms_per_file))
+
+    common_per_chrom = {}
+    n_sites_per_file = defaultdict(int)
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        futures = {pool.submit(read_site_starts, bw_path, chrom): (bw_path, chrom)
+                   for bw_path in bigwig_files for chrom in chroms}
+        for future in as_completed(futures):
+            bw_path, chrom = futures.pop(future)
+            starts = future.result()
+            n_sites_per_file[bw_path] += len(starts)
+            if chrom in common_per_chrom:
+                starts = np.intersect1d(common_per_chrom[chrom], starts, assume_unique=True)
+            common_per_chrom[chrom] = starts
+
+    for bw_path in bigwig_files:
+        print(f"  {os.path.basename(bw_path)}: {n_sites_per_file[bw_path]} sites.")
+
+    common_sites = {}
+    n_common = 0
+    for chrom in chroms:
+        starts = common_per_chrom[chrom][:max_sites - n_common]
+        if len(starts):
+            common_sites[chrom] = starts
+            n_common += len(starts)
+        if n_common >= max_sites:
+            print(f"  Reached max_sites={max_sites}, remaining chromosomes are skipped.")
+            break
 
-    common_sites = set.intersection(*site_sets)
     if not common_sites:
         raise ValueError("No common CpG sites found across all BigWig files.")
 
-    print(f"  => {len(common_sites)} common CpG sites found across all samples.")
-    return sorted(common_sites)
+    print(f"  => {n_common} common CpG sites found across all samples.")
+    return common_sites
 
-def extract_methylation_matrix(bigwig_files, sites, groups):
-    """Create a methylation matrix from BigWigs at the given sites"""
-    methylation_dict = defaultdict(list)
+def read_site_values(bw, chrom, starts, block_size=BLOCK_SIZE):
+    """Values of one BigWig at the given sorted starts, read in blocks of at most block_size bp"""
+    values = np.empty(len(starts), dtype=np.float32)
+    i = 0
+    while i < len(starts):
+        block_start = starts[i]
+        j = int(np.searchsorted(starts, block_start + block_size, side="left"))
+        block_end = starts[j - 1] + 1
+        block = bw.values(chrom, int(block_start), int(block_end), numpy=True)
+        values[i:j] = block[starts[i:j] - block_start]
+        i = j
+    return values
+
+def read_file_site_values(bw_path, chrom, starts):
+    """read_site_values() opening the BigWig file, for the process pool"""
+    bw = pyBigWig.open(bw_path)
+    values = read_site_values(bw, chrom, starts)
+    bw.close()
+    return values
+
+@stage("dmr_calling.matrix")
+def extract_methylation_matrix(bigwig_files, sites, groups, n_jobs=None):
+    """Create a methylation matrix from BigWigs at the given sites ({chrom: sorted starts}), in parallel per (file, chromosome)"""
     sample_names = [os.path.splitext(os.path.basename(f))[0] for f in bigwig_files]
     sample_names_with_group = ["g" + str(groups[i]) + "_" + sample_names[i] for i in range(len(groups))]
 
-    for bw_path in bigwig_files:
-        bw = pyBigWig.open(bw_path)
-        for chrom, start in sites:
-            val = bw.values(chrom, start, start+1)[0]
-            val = 0.0 if val != val else val
-            methylation_dict[(chrom, start)].append(val)
-        bw.close()
+    row_offsets = {}
+    n_sites = 0
+    for chrom, starts in sites.items():
+        row_offsets[chrom] = n_sites
+        n_sites += len(starts)
 
-    rows = []
-    for (chrom, start), values in methylation_dict.items():
-        rows.append([chrom, start] + values)
-    columns = ["chr", "pos"] + sample_names_with_group
-    df = pd.DataFrame(rows, columns=columns)
+    matrix = np.empty((n_sites, len(bigwig_files)), dtype=np.float32)
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        futures = {pool.submit(read_file_site_values, bw_path, chrom, starts): (col, chrom)
+                   for col, bw_path in enumerate(bigwig_files) for chrom, starts in sites.items()}
+        for future in as_completed(futures):
+            col, chrom = futures.pop(future)
+            row = row_offsets[chrom]
+            matrix[row:row + len(sites[chrom]), col] = future.result()
+    np.nan_to_num(matrix, copy=False, nan=0.0)
+
+    df = pd.DataFrame(matrix, columns=sample_names_with_group)
+    df.insert(0, "pos", np.concatenate(list(sites.values())) if sites else np.zeros(0, dtype=np.int64))
+    df.insert(0, "chr", np.repeat(list(sites.keys()), [len(starts) for starts in sites.values()]))
     return df
 
-def run_metilene(matrix_path, groups_path, output_path):
-    try:
-        with open(output_path, "w") as out:
-            subprocess.run(["metilene", "-a" , "g0", "-b", "g1", matrix_path], stdout=out, check=True)
-    except subprocess.CalledProcessError as e:
-        print(f"Metilene failed: {e}")
+def chrom_partitions(chroms):
+    """Row ranges (start, end) of every chromosome of the matrix, largest first"""
+    boundaries = np.flatnonzero(chroms[1:] != chroms[:-1]) + 1
+    partitions = [(int(a), int(b)) for a, b in zip(np.r_[0, boundaries], np.r_[boundaries, len(chroms)])]
+    return sorted(partitions, key=lambda p: p[0] - p[1])
+
+def write_partition(stream, columns, chrom, starts, values):
+    """Write one chromosome of the matrix as metilene input (with header) to a text stream, in chunks"""
+    stream.write("\t".join(columns) + "\n")
+    fmt = [f"{chrom}\t%d"] + ["%.6g"] * values.shape[1]
+    for i in range(0, len(starts), WRITE_CHUNK):
+        block = np.column_stack([starts[i:i + WRITE_CHUNK], values[i:i + WRITE_CHUNK]])
+        np.savetxt(stream, block, fmt="\t".join(fmt))
+
+def run_metilene_partition(metilene, chrom, columns, starts, values, threads):
+    """
+    Run metilene on one chromosome, streaming the input to its stdin.
+
+    Returns the metilene output (text). Raises RuntimeError if metilene fails.
+    """
+    cmd = [metilene, "-a", "g0", "-b", "g1", "-t", str(threads), "/dev/stdin"]
+    with tempfile.TemporaryFile(mode="w+") as stderr:
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=stderr, text=True)
+
+        def feed():
+            try:
+                write_partition(proc.stdin, columns, chrom, starts, values)
+            except BrokenPipeError:
+                pass  # metilene exited early, reported through the return code
+            finally:
+                try:
+                    proc.stdin.close()
+                except BrokenPipeError:
+                    pass
+
+        writer = threading.Thread(target=feed)
+        writer.start()
+        output = proc.stdout.read()
+        writer.join()
+        if proc.wait() != 0:
+            stderr.seek(0)
+            raise RuntimeError(f"metilene failed on {chrom} (exit code {proc.returncode}): {stderr.read().strip()}")
+    return output
+
+@stage("dmr_calling.metilene")
+def run_metilene(matrix_df, output_path, metilene="metilene", jobs=1, threads=1):
+    """
+    Run metilene per chromosome, up to jobs processes at a time with threads threads each,
+    and write the merged output sorted by chromosome and start to output_path.
+    """
+    columns = list(matrix_df.columns)
+    chroms = matrix_df["chr"].to_numpy()
+    partitions = chrom_partitions(chroms)
+    starts = matrix_df["pos"].to_numpy()
+    values = matrix_df.iloc[:, 2:].to_numpy(dtype=np.float32)
+
+    results = []
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(run_metilene_partition, metilene, chroms[a], columns,
+                               starts[a:b], values[a:b], threads) for a, b in partitions]
+        for future in as_completed(futures):
+            output = future.result()
+            if output.strip():
+                results.append(pd.read_csv(io.StringIO(output), sep="\t", header=None))
+
+    with open(output_path, "w") as out:
+        if results:
+            merged = pd.concat(results, ignore_index=True).sort_values([0, 1], kind="stable")
+            merged.to_csv(out, sep="\t", header=False, index=False)
+
+def welch_t_test(g1, g2):
+    """Per-site Welch t statistic and two-sided p-value for two groups (sites x samples)"""
+    n1, n2 = g1.shape[1], g2.shape[1]
+    diff = g1.mean(axis=1) - g2.mean(axis=1)
+    v1, v2 = g1.var(axis=1, ddof=1) / n1, g2.var(axis=1, ddof=1) / n2
+    se2 = v1 + v2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = np.where(se2 > 0, diff / np.sqrt(se2), np.where(diff == 0, 0.0, np.sign(diff) * np.inf))
+        dof = np.where(se2 > 0, se2 ** 2 / (v1 ** 2 / (n1 - 1) + v2 ** 2 / (n2 - 1)), n1 + n2 - 2)
+    p = 2 * stats.t.sf(np.abs(t), np.nan_to_num(dof, nan=n1 + n2 - 2))
+    return t, p
+
+def call_dmrs_native_partition(chrom, starts, g1, g2, alpha=0.05, min_cpgs=10, max_dist=300, min_diff=0.1):
+    """
+    Call DMRs on one chromosome without metilene.
+
+    Runs of adjacent sites with p < alpha, the same direction of change and at most max_dist bp
+    between neighbours form a DMR if they contain at least min_cpgs sites and the mean difference
+    is at least min_diff. The region p-value is a Mann-Whitney U test over all values of the region.
+
+    Returns rows of (chr, start, end, nCG, meanMethy1, meanMethy2, diff.Methy, p, areaStat)
+    """
+    t, p = welch_t_test(g1, g2)
+    direction = np.where(p < alpha, np.sign(t), 0)
+    # a new run starts where the direction changes or the gap to the previous site is too large
+    breaks = np.r_[True, (direction[1:] != direction[:-1]) | (np.diff(starts) > max_dist)]
+    run_starts = np.flatnonzero(breaks)
+    run_ends = np.r_[run_starts[1:], len(starts)]
+
+    rows = []
+    for a, b in zip(run_starts, run_ends):
+        if direction[a] == 0 or b - a < min_cpgs:
+            continue
+        mean1, mean2 = float(g1[a:b].mean()), float(g2[a:b].mean())
+        if abs(mean1 - mean2) < min_diff:
+            continue
+        region_p = stats.mannwhitneyu(g1[a:b].ravel(), g2[a:b].ravel()).pvalue
+        rows.append((chrom, int(starts[a]), int(starts[b - 1]) + 1, int(b - a),
+                     mean1, mean2, mean1 - mean2, float(region_p), float(t[a:b].sum())))
+    return rows
+
+def benjamini_hochberg(p):
+    """Benjamini-Hochberg adjusted p-values (q-values)"""
+    p = np.asarray(p, dtype=np.float64)
+    order = np.argsort(p)
+    ranked = p[order] * len(p) / np.arange(1, len(p) + 1)
+    q = np.empty_like(p)
+    q[order] = np.minimum.accumulate(ranked[::-1])[::-1].clip(max=1.0)
+    return q
+
+@stage("dmr_calling.native")
+def run_native(matrix_df, output_path, jobs=None, **params):
+    """
+    Native DMR calling (group g0 vs g1, like metilene -a g0 -b g1), in parallel per chromosome.
+    Writes the DMRs in the column order expected by format_dmrs_for_methylbert, sorted by chromosome and start.
+    """
+    g1_cols = [c for c in matrix_df.columns if c.startswith("g0_")]
+    g2_cols = [c for c in matrix_df.columns if c.startswith("g1_")]
+    if len(g1_cols) < 2 or len(g2_cols) < 2:
+        raise ValueError("The native backend needs at least two samples in group 0 and in group 1.")
+    chroms = matrix_df["chr"].to_numpy()
+    starts = matrix_df["pos"].to_numpy()
+    g1 = matrix_df[g1_cols].to_numpy(dtype=np.float64)
+    g2 = matrix_df[g2_cols].to_numpy(dtype=np.float64)
+
+    rows = []
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(call_dmrs_native_partition, chroms[a], starts[a:b], g1[a:b], g2[a:b], **params)
+                   for a, b in chrom_partitions(chroms)]
+        for future in as_completed(futures):
+            rows.extend(future.result())
+
+    dmrs = pd.DataFrame(rows, columns=["chr", "start", "end", "nCG", "meanMethy1", "meanMethy2", "diff.Methy", "p", "areaStat"])
+    dmrs["q"] = benjamini_hochberg(dmrs["p"]) if len(dmrs) else []
+    dmrs = dmrs.sort_values(["chr", "start"], kind="stable")
+    dmrs = dmrs[["chr", "start", "end", "nCG", "meanMethy1", "meanMethy2", "diff.Methy", "p", "q", "areaStat"]]
+    dmrs.to_csv(output_path, sep="\t", header=False, index=False)
+
+@stage("dmr_calling.load_matrix")
+def load_matrix(matrix_path, bigwig_files, groups, max_sites):
+    """
+    The methylation matrix saved by an earlier run (Parquet), or None if it is missing, older than one of the
+    BigWig files, made from other files or groups, or with fewer than max_sites sites.
+    """
+    if not os.path.exists(matrix_path):
+        return None
+    if os.path.getmtime(matrix_path) < max(os.path.getmtime(f) for f in bigwig_files):
+        return None
+    # The sites are taken in the same order for any max_sites, a matrix made with more sites can be cut
+    if parquet_metadata(matrix_path).get("max_sites", 0) < max_sites:
+        return None
+    sample_names = [os.path.splitext(os.path.basename(f))[0] for f in bigwig_files]
+    columns = ["chr", "pos"] + ["g" + str(group) + "_" + name for group, name in zip(groups, sample_names)]
+    matrix_df = read_parquet(matrix_path)
+    if list(matrix_df.columns) != columns:
+        return None
+    return matrix_df.iloc[:max_sites]
 
 def format_dmrs_for_methylbert(dmrs_path, output_csv_path):
+    if os.path.getsize(dmrs_path) == 0:
+        raise ValueError("No DMRs were found, nothing to write.")
     df = pd.read_csv(dmrs_path, sep='\t', header=None)
     df.columns = ["chr", "start", "end", "nCG", "meanMethy1", "meanMethy2", "diff.Methy", "p", "q", "areaStat"]
     df["length"] = df["end"] - df["start"]
@@ -85,37 +318,56 @@ def format_dmrs_for_methylbert(dmrs_path, output_csv_path):
     df.to_csv(output_csv_path, sep='\t', index=False)
 
 def main():
-    parser = argparse.ArgumentParser(description="Call DMRs from BigWig files using metilene for MethylBERT.")
+    parser = argparse.ArgumentParser(description="Call DMRs from BigWig files using metilene or the native backend for MethylBERT.")
     parser.add_argument("bigwig_dir", help="Directory with BigWig files")
     parser.add_argument("groups_file", help="groups.txt file for metilene")
     parser.add_argument("output_file", help="Output DMR file for MethylBERT")
+    parser.add_argument("--max-sites", type=int, default=1_000_000, help="Maximum number of common CpG sites (default: 1000000)")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="Number of worker processes (default: all cores)")
+    parser.add_argument("--metilene", default="metilene", help="metilene executable (default: metilene from PATH)")
+    parser.add_argument("--metilene-jobs", type=int, default=4, help="Number of chromosomes processed by metilene at the same time (default: 4)")
+    parser.add_argument("--metilene-threads", type=int, default=1, help="Threads per metilene process (default: 1)")
+    parser.add_argument("--backend", choices=["metilene", "native"], default="metilene", help="DMR caller (default: metilene)")
+    parser.add_argument("--alpha", type=float, default=0.05, help="native: per-site p-value threshold (default: 0.05)")
+    parser.add_argument("--min-cpgs", type=int, default=10, help="native: minimum CpGs per DMR (default: 10)")
+    parser.add_argument("--max-dist", type=int, default=300, help="native: maximum distance between adjacent CpGs (default: 300)")
+    parser.add_argument("--min-diff", type=float, default=0.1, help="native: minimum mean methylation difference (default: 0.1)")
+    parser.add_argument("--matrix", default=None, help="Parquet file to keep the methylation matrix in; later runs with the same BigWig files read it instead of the BigWig files")
+    add_arguments(parser)
     args = parser.parse_args()
 
-    bigwig_files = [args.bigwig_dir + f for f in os.listdir(args.bigwig_dir) if os.path.isfile(os.path.join(args.bigwig_dir, f))]
-    groups = read_groups_file(args.groups_file)
-
-    if len(groups) != len(bigwig_files):
-        raise ValueError(f"groups.txt must have {len(bigwig_files)} values, but has {len(groups)}.")
+    with session_from_args("dmr_calling", args):
+        bigwig_files = [os.path.join(args.bigwig_dir, f) for f in sorted(os.listdir(args.bigwig_dir)) if os.path.isfile(os.path.join(args.bigwig_dir, f))]
+        groups = read_groups_file(args.groups_file)
 
-    print("[1/4] Extracting common CpG sites...")
-    common_sites = extract_common_cpgs(bigwig_files)
+        if len(groups) != len(bigwig_files):
+            raise ValueError(f"groups.txt must have {len(bigwig_files)} values, but has {len(groups)}.")
 
-    print("[2/4] Building methylation matrix...")
-    matrix_df = extract_methylation_matrix(bigwig_files, common_sites, groups)
-    print(matrix_df.columns)
+        matrix_df = load_matrix(args.matrix, bigwig_files, groups, args.max_sites) if args.matrix else None
+        if matrix_df is not None:
+            print(f"[1/4] [2/4] Methylation matrix of {len(matrix_df)} CpG sites read from {args.matrix}")
+        else:
+            print("[1/4] Extracting common CpG sites...")
+            common_sites = extract_common_cpgs(bigwig_files, args.max_sites, args.jobs)
 
-    with tempfile.NamedTemporaryFile(mode='w+', delete=False, suffix=".tsv") as tmp_matrix:
-        matrix_df.to_csv(tmp_matrix.name, sep='\t', index=False, header=True)
-        tmp_matrix_path = tmp_matrix.name
+            print("[2/4] Building methylation matrix...")
+            matrix_df = extract_methylation_matrix(bigwig_files, common_sites, groups, args.jobs)
+            if args.matrix:
+                write_parquet(matrix_df, args.matrix, metadata={"max_sites": args.max_sites})
+        print(matrix_df.columns)
 
-    print("[3/4] Running metilene...")
-    with tempfile.NamedTemporaryFile(mode='w+', delete=False, suffix=".tsv") as tmp_dmrs:
-        run_metilene(tmp_matrix_path, args.groups_file, tmp_dmrs.name)
+        print(f"[3/4] Running {args.backend}...")
+        with tempfile.NamedTemporaryFile(mode='w+', suffix=".tsv") as tmp_dmrs:
+            if args.backend == "native":
+                run_native(matrix_df, tmp_dmrs.name, args.jobs, alpha=args.alpha, min_cpgs=args.min_cpgs,
+                           max_dist=args.max_dist, min_diff=args.min_diff)
+            else:
+                run_metilene(matrix_df, tmp_dmrs.name, args.metilene, args.metilene_jobs, args.metilene_threads)
 
-        print("[4/4] Formatting DMRs for MethylBERT...")
-        format_dmrs_for_methylbert(tmp_dmrs.name, args.output_file)
+            print("[4/4] Formatting DMRs for MethylBERT...")
+            format_dmrs_for_methylbert(tmp_dmrs.name, args.output_file)
 
-    print(f"✅ DMR file written to: {args.output_file}")
+        print(f"✅ DMR file written to: {args.output_file}")
 
 if __name__ == "__main__":
     main()
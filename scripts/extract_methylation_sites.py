@@ -1,44 +1,72 @@
-import sys
+''' Extracts all CpG sites from the reference genome into a compact on-disk index.
+
+The index is a directory with two files:
+- positions.u32: 0-based CpG positions of all chromosomes as one flat little-endian uint32 array
+- chroms.tsv: chromosome name, offset into positions.u32 and number of CpG sites
+
+The FASTA is streamed one chromosome at a time, so memory is bounded by the largest chromosome.
+'''
+
 import argparse
-from collections import defaultdict
-import pickle
-from Bio import SeqIO
-
-def find_cpg_sites(seq: str) -> list[int]:
-    """Return 0-based positions of all CpG sites in a sequence."""
-    cpg_sites = []
-    for i in range(len(seq) - 1):
-        if seq[i:i+2].upper() == "CG":
-            cpg_sites.append(i)
-    return cpg_sites
-
-def extract_cpg_from_fasta(fasta_path: str) -> dict:
-    """Extract CpG site positions from a FASTA file."""
-    cpg_dict = defaultdict(list)
-    for record in SeqIO.parse(fasta_path, "fasta"):
-        chrom = record.id
-        if "_" in chrom:
-            continue
-        seq = str(record.seq)
-        positions = find_cpg_sites(seq)
-        cpg_dict[chrom] = positions
-        print(f"Found {len(positions)} CpG sites in {chrom}")
-    return dict(cpg_dict)
-
-def save_cpg_sites(cpg_sites: dict, output_path: str):
-    """Save the CpG site dictionary to a pickle file."""
-    with open(output_path, "wb") as f:
-        pickle.dump(cpg_sites, f)
-    print(f"Saved CpG site positions to {output_path}")
+import gzip
+import os
+import numpy as np
+
+POSITIONS_FILE = "positions.u32"
+CHROMS_FILE = "chroms.tsv"
+POSITION_DTYPE = np.dtype("<u4")
+
+def iter_fasta(fasta_path: str):
+    """Yield (chromosome, sequence as bytearray) for every record of a (optionally gzipped) FASTA file."""
+    opener = gzip.open if fasta_path.endswith(".gz") else open
+    name, seq = None, bytearray()
+    with opener(fasta_path, "rb") as f:
+        for line in f:
+            if line.startswith(b">"):
+                if name is not None:
+                    yield name, seq
+                name, seq = line[1:].split()[0].decode(), bytearray()
+            else:
+                seq += line.rstrip()
+    if name is not None:
+        yield name, seq
+
+def find_cpg_sites(seq: bytes | bytearray) -> np.ndarray:
+    """Return 0-based positions of all CpG sites in a sequence (case-insensitive)."""
+    bases = np.frombuffer(seq, dtype=np.uint8) | 0x20  # lower-case all letters
+    is_cpg = (bases[:-1] == ord("c")) & (bases[1:] == ord("g"))
+    return np.flatnonzero(is_cpg).astype(POSITION_DTYPE)
+
+def extract_cpg_from_fasta(fasta_path: str, output_dir: str):
+    """Extract CpG site positions from a FASTA file and write them to the index in output_dir."""
+    os.makedirs(output_dir, exist_ok=True)
+    chroms = []
+    offset = 0
+    with open(os.path.join(output_dir, POSITIONS_FILE), "wb") as f_pos:
+        for chrom, seq in iter_fasta(fasta_path):
+            if "_" in chrom:
+                continue
+            if len(seq) > np.iinfo(POSITION_DTYPE).max:
+                raise ValueError(f"{chrom} is too long for uint32 positions ({len(seq)} bp).")
+            positions = find_cpg_sites(seq)
+            positions.tofile(f_pos)
+            chroms.append((chrom, offset, len(positions)))
+            offset += len(positions)
+            print(f"Found {len(positions)} CpG sites in {chrom}")
+
+    with open(os.path.join(output_dir, CHROMS_FILE), "w") as f_chroms:
+        f_chroms.write("chrom\toffset\tcount\n")
+        for chrom, chrom_offset, count in chroms:
+            f_chroms.write(f"{chrom}\t{chrom_offset}\t{count}\n")
+    print(f"Saved {offset} CpG site positions to {output_dir}")
 
 def main():
     parser = argparse.ArgumentParser(description="Extract CpG sites from a FASTA reference.")
-    parser.add_argument("fasta", help="Reference genome in FASTA format")
-    parser.add_argument("-o", "--output", default="cpg_sites.pkl", help="Output file (default: cpg_sites.pkl)")
+    parser.add_argument("fasta", help="Reference genome in FASTA format (may be gzipped)")
+    parser.add_argument("-o", "--output", default="cpg_sites", help="Output index directory (default: cpg_sites)")
     args = parser.parse_args()
 
-    cpg_sites = extract_cpg_from_fasta(args.fasta)
-    save_cpg_sites(cpg_sites, args.output)
+    extract_cpg_from_fasta(args.fasta, args.output)
 
 if __name__ == "__main__":
     main()
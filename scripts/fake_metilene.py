@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+''' Stand-in for the metilene binary, to run dmr_calling.py without metilene installed:
+
+python dmr_calling.py ../data/bigwig ../data/groups.txt dmr.csv --metilene ./fake_metilene.py
+
+Accepts the metilene arguments used by dmr_calling.py (-a, -b, -t, input file) and reports every
+window of 10 consecutive CpG sites as a "DMR" with the group means. The statistics are not meaningful.
+'''
+
+import argparse
+import numpy as np
+import pandas as pd
+
+WINDOW = 10
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake metilene for offline tests.")
+    parser.add_argument("-a", default="g1")
+    parser.add_argument("-b", default="g2")
+    parser.add_argument("-t", type=int, default=1)
+    parser.add_argument("input")
+    args = parser.parse_args()
+
+    df = pd.read_csv(args.input, sep="\t")
+    g1 = df[[c for c in df.columns if c.startswith(args.a + "_")]].to_numpy()
+    g2 = df[[c for c in df.columns if c.startswith(args.b + "_")]].to_numpy()
+
+    for start in range(0, len(df) - WINDOW + 1, WINDOW):
+        rows = slice(start, start + WINDOW)
+        mean1, mean2 = g1[rows].mean(), g2[rows].mean()
+        diff = mean1 - mean2
+        print("\t".join(str(v) for v in [df["chr"].iloc[start], df["pos"].iloc[start], df["pos"].iloc[start + WINDOW - 1] + 1,
+                                          WINDOW, mean1, mean2, diff, 0.01, 0.05, diff * WINDOW]))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+''' Inference-only deconvolution of a bulk sample with a fine-tuned MethylBERT model.
+
+Produces the same res.csv, deconvolution.csv and FI.csv as methylbert's deconvolute, without a
+MethylBertFinetuneTrainer: the model is loaded once, the reads come directly from the memory-mapped
+dataset (memmap_dataset.py) in large batches, and the classification runs under torch.inference_mode.
+Optionally the Linear layers are quantized to int8 (dynamic quantization) or the model runs in bfloat16
+(both change the probabilities slightly). The intra-op and inter-op thread counts are set explicitly.
+--metrics, --prometheus and --profile write the batch latencies and resources (see instrumentation.py).
+
+python fast_deconvolution.py tmp/data.csv --model tmp/fine_tune/ --train tmp/train_seq.csv -o tmp/deconvolution/
+'''
+
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import torch
+
+from methylbert.data.vocab import MethylVocab
+from methylbert.deconvolute import optimise_nll_deconvolute, purity_estimation
+from methylbert.network import MethylBertEmbeddedDMR
+
+from columnar import is_parquet, parquet_columns, read_parquet, write_parquet
+from instrumentation import add_arguments, batches, session_from_args, timer
+from memmap_dataset import WEIGHT_COLUMN, MemmapFinetuneDataset, memmap_finetune_dataset, read_weights
+
+MODEL_DIR = "tmp/fine_tune/"
+TRAIN_FILE = "tmp/train_seq.csv"
+OUTPUT_DIR = "tmp/deconvolution/"
+BATCH_SIZE = 128
+
+def set_threads(threads=None, interop_threads=None):
+    """Set the number of intra-op and inter-op threads of torch (None keeps the default)."""
+    if threads:
+        torch.set_num_threads(threads)
+    if interop_threads:
+        # Can only be set before the first parallel work in the process
+        torch.set_num_interop_threads(interop_threads)
+
+def load_model(model_dir, seq_len, quantize=False):
+    """
+    Load a fine-tuned MethylBERT model for inference.
+
+    Parameters:
+    model_dir (str): Directory with config.json and the model weights (save path of the fine-tuning).
+    seq_len (int): Sequence length the model was trained with.
+    quantize (bool): Quantize the Linear layers dynamically to int8.
+
+    Returns:
+    MethylBertEmbeddedDMR: The model in eval mode.
+    """
+    # The number of DMRs is taken from the saved config, attentions and hidden states are not needed
+    model = MethylBertEmbeddedDMR.from_pretrained(model_dir, seq_len=seq_len,
+                                                  output_attentions=False, output_hidden_states=False)
+    model.eval()
+    if quantize:
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return model
+
+def classify_reads(model, dataset, start=0, stop=None, batch_size=BATCH_SIZE, bf16=False):
+    """
+    Cell-type probabilities for the reads start:stop of a MemmapFinetuneDataset.
+
+    Returns:
+    numpy.ndarray: float32 array (reads, 2) with the probabilities (P_N, P_ctype), like the logits of read_classification.
+    """
+    stop = len(dataset) if stop is None else stop
+    probs = np.empty((stop - start, 2), dtype=np.float32)
+    with torch.inference_mode(), torch.autocast(device_type="cpu", dtype=torch.bfloat16, enabled=bf16):
+        # Loading (from the memory-mapped arrays) and model time are recorded per batch
+        for rows, inputs in batches(read_batches(dataset, start, stop, batch_size), "deconvolution.classify",
+                                    size=lambda batch: batch[0].stop - batch[0].start):
+            output = model(step=0, **inputs)
+            probs[rows.start - start:rows.stop - start] = output["classification_logits"].float().numpy()
+    return probs
+
+def read_batches(dataset, start, stop, batch_size):
+    """Rows and model inputs of the batches of the reads start:stop."""
+    arrays = dataset.arrays
+    for begin in range(start, stop, batch_size):
+        rows = slice(begin, min(begin + batch_size, stop))
+        yield rows, {"input_ids": torch.from_numpy(arrays["dna_seq"][rows].astype(np.int64)),
+                     "token_type_ids": torch.from_numpy(arrays["methyl_seq"][rows].astype(np.int64)),
+                     "labels": torch.from_numpy(arrays["dmr_label"][rows].astype(np.int64)),
+                     "ctype_label": torch.from_numpy(arrays["ctype_label"][rows].astype(np.int64))}
+
+def decode_dna_seqs(tokens, vocab):
+    """DNA sequences of token rows, the same as methylbert.utils.get_dna_seq for every row."""
+    # Special tokens (<pad>, <sos>, <unk>, ...) are skipped
+    is_kmer = np.array([not s.startswith("<") for s in vocab.itos])
+    first = np.array([s[:1] for s in vocab.itos])
+    middle = np.array([s[1:2] for s in vocab.itos])
+    last = np.array([s[-1:] for s in vocab.itos])
+    valid = is_kmer[tokens]
+
+    seqs = []
+    for row, mask in zip(tokens, valid):
+        ids = row[mask]
+        seqs.append(first[ids[0]] + "".join(middle[ids]) + last[ids[-1]] if len(ids) else "")
+    return seqs
+
+def read_results(dataset, probs, start=0, stop=None):
+    """
+    The read classification table of deconvolute (res.csv) for the reads start:stop.
+
+    Returns:
+    pandas.DataFrame: The columns of the input file (dna_seq and methyl_seq from the tokens), pred, n_cpg, P_ctype and P_N.
+    """
+    arrays = dataset.arrays
+    stop = len(dataset) if stop is None else stop
+    rows = slice(start, stop)
+    methyl = np.asarray(arrays["methyl_seq"][rows])
+
+    res = {}
+    for column in dataset.headers:
+        if column == "dna_seq":
+            res[column] = decode_dna_seqs(np.asarray(arrays["dna_seq"][rows]), dataset.vocab)
+        elif column == "methyl_seq":
+            res[column] = (methyl + ord("0")).astype(np.uint8).view(f"S{methyl.shape[1]}").ravel().astype(str)
+        elif column == "dmr_label":
+            res[column] = np.asarray(arrays["dmr_label"][rows]).astype(np.int64)
+        else:
+            res[column] = np.char.decode(np.asarray(arrays[column][rows]), "utf-8")
+    res = pd.DataFrame(res)
+    res["pred"] = np.argmax(probs, axis=1)
+    res["n_cpg"] = (methyl < 2).sum(axis=1)
+    res["P_ctype"] = probs[:, 1]
+    res["P_N"] = probs[:, 0]
+    return res
+
+@timer("deconvolution.estimate")
+def estimate_proportions(res, df_train, output_path, n_grid=10000, adjustment=False, res_format="csv"):
+    """
+    Proportion estimation of deconvolute from classified reads. Writes res.csv (or res.parquet), deconvolution.csv and FI.csv.
+
+    Parameters:
+    res (pandas.DataFrame): Output of read_results.
+    df_train (pandas.DataFrame): Training data (at least the ctype column, see read_train_ctypes) for the margins.
+    output_path (str): Output directory.
+    n_grid (int): Number of grid points of the grid search.
+    adjustment (bool): Whether to run the estimation adjustment.
+    res_format (str): Format of the read classification table, csv or parquet (see columnar.py).
+    """
+    os.makedirs(output_path, exist_ok=True)
+    if res_format == "parquet":
+        write_parquet(res.drop(columns=["P_N"]), os.path.join(output_path, "res.parquet"))
+    else:
+        res.drop(columns=["P_N"]).to_csv(os.path.join(output_path, "res.csv"), sep="\t", header=True, index=False)
+
+    # Select reads which contain methylation patterns
+    res = res[res["n_cpg"] > 0]
+    if res.shape[0] == 0:
+        raise ValueError("There are no reads selected for deconvolution. It may mean all of the reads do not have CpG methylation.")
+    # A collapsed read counts as often as the reads it stands for
+    if WEIGHT_COLUMN in res.columns:
+        res = res.loc[res.index.repeat(read_weights(res[WEIGHT_COLUMN].astype(str)).astype(np.int64))]
+
+    margins = train_margins(df_train)
+    print("Margins : ", margins)
+
+    if len(margins.keys()) == 2:
+        deconv_res, fi_res = purity_estimation(reads=res, margins=margins, n_grid=n_grid, adjustment=adjustment)
+        deconv_res.to_csv(os.path.join(output_path, "deconvolution.csv"), sep="\t", header=True, index=False)
+        fi_res.to_csv(os.path.join(output_path, "FI.csv"), sep="\t", header=True, index=False)
+    elif len(margins.keys()) > 2:
+        deconv_res = optimise_nll_deconvolute(reads=res, margins=margins)
+        deconv_res.to_csv(os.path.join(output_path, "deconvolution.csv"), sep="\t", header=True, index=False)
+    else:
+        raise RuntimeError(f"There are less than two cell types in the training data set. {margins.keys()} Neither purity estimation nor deconvolution can be performed.")
+    return deconv_res
+
+def train_margins(df_train):
+    """Fraction of every cell type in the training data (weighted by the XC counts of collapsed reads)."""
+    if WEIGHT_COLUMN in df_train.columns:
+        return df_train.groupby("ctype")[WEIGHT_COLUMN].sum() / df_train[WEIGHT_COLUMN].sum()
+    return df_train.value_counts("ctype", normalize=True)
+
+def read_train_ctypes(train_file):
+    """The ctype column of a train_seq.csv (or .parquet), with the XC read counts if the reads are collapsed."""
+    if is_parquet(train_file):
+        df_train = read_parquet(train_file, [c for c in parquet_columns(train_file) if c in ("ctype", WEIGHT_COLUMN)])
+    else:
+        df_train = pd.read_csv(train_file, sep="\t", usecols=lambda column: column in ("ctype", WEIGHT_COLUMN))
+    if WEIGHT_COLUMN in df_train.columns:
+        df_train[WEIGHT_COLUMN] = df_train[WEIGHT_COLUMN].fillna(1)
+    return df_train
+
+def load_dataset(data, vocab, seq_len):
+    """MemmapFinetuneDataset for a data.csv (converted if needed) or an already converted directory."""
+    if os.path.isdir(data):
+        return MemmapFinetuneDataset(data, vocab)
+    return memmap_finetune_dataset(data, vocab, seq_len)
+
+def main():
+    parser = argparse.ArgumentParser(description="Deconvolute a bulk sample with a fine-tuned MethylBERT model (inference only).")
+    parser.add_argument("data", help="data.csv (or .parquet) of the bulk sample, or its converted .mm directory")
+    parser.add_argument("--model", default=MODEL_DIR, help=f"Fine-tuned model directory (default: {MODEL_DIR})")
+    parser.add_argument("--train", default=TRAIN_FILE, help=f"Training data (CSV or Parquet) for the cell-type margins (default: {TRAIN_FILE})")
+    parser.add_argument("-o", "--output", default=OUTPUT_DIR, help=f"Output directory (default: {OUTPUT_DIR})")
+    parser.add_argument("--seq-len", type=int, default=100, help="Sequence length of the model (default: 100)")
+    parser.add_argument("--n-mers", type=int, default=3, help="k of the k-mer tokens (default: 3)")
+    parser.add_argument("-b", "--batch-size", type=int, default=BATCH_SIZE, help=f"Reads per batch (default: {BATCH_SIZE})")
+    parser.add_argument("--threads", type=int, default=os.cpu_count(), help="Intra-op threads (default: all cores)")
+    parser.add_argument("--interop-threads", type=int, default=1, help="Inter-op threads (default: 1)")
+    precision = parser.add_mutually_exclusive_group()
+    precision.add_argument("--quantize", action="store_true", help="Dynamic int8 quantization of the Linear layers")
+    precision.add_argument("--bf16", action="store_true", help="Run the model in bfloat16")
+    parser.add_argument("--n-grid", type=int, default=10000, help="Grid size of the purity estimation (default: 10000)")
+    parser.add_argument("--adjustment", action="store_true", help="Run the estimation adjustment")
+    parser.add_argument("--res-format", choices=["csv", "parquet"], default="csv", help="Format of the read classification table (default: csv)")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    with session_from_args("deconvolution", args):
+        set_threads(args.threads, args.interop_threads)
+        vocab = MethylVocab(args.n_mers)
+        with timer("deconvolution.load"):
+            dataset = load_dataset(args.data, vocab, args.seq_len)
+            model = load_model(args.model, dataset.seq_len, args.quantize)
+
+        start = time.time()
+        probs = classify_reads(model, dataset, batch_size=args.batch_size, bf16=args.bf16)
+        elapsed = time.time() - start
+        print(f"Classified {len(dataset)} reads in {elapsed:.1f}s ({len(dataset) / max(elapsed, 1e-9):.0f} reads/s)")
+
+        res = read_results(dataset, probs)
+        estimate_proportions(res, read_train_ctypes(args.train), args.output, args.n_grid, args.adjustment, args.res_format)
+        print(f"Deconvolution results written to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+''' Content-addressed cache for the outputs of methylbert's finetune_data_generate.
+
+The cache key is a hash of all inputs and parameters: the BAM files (from the file list or input_file),
+f_dmr, f_ref (size and modification time, or SHA-256 checksums) and the parameters like n_mers,
+split_ratio and seed. On a cache hit the stored train_seq.csv / test_seq.csv / data.csv / dmrs.csv
+are linked into output_dir and finetune_data_generate is not run.
+The cache directory is kept below a size limit by removing the least recently used entries.
+'''
+
+import hashlib
+import inspect
+import json
+import os
+import shutil
+import uuid
+
+from methylbert.data import finetune_data_generate as fdg
+
+CACHE_DIR = "../data/cache/finetune_data"
+MAX_CACHE_BYTES = 50 * 1024**3
+# Parameters that do not change the output
+IGNORED_PARAMS = {"output_dir", "n_cores", "verbose"}
+
+def file_fingerprint(path, checksum=False):
+    """Identify the content of a file by size and mtime, or by its SHA-256 checksum."""
+    stat = os.stat(path)
+    fingerprint = {"path": os.path.abspath(path), "size": stat.st_size}
+    if checksum:
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha.update(block)
+        fingerprint["sha256"] = sha.hexdigest()
+    else:
+        fingerprint["mtime_ns"] = stat.st_mtime_ns
+    return fingerprint
+
+def bam_files(sc_dataset=None, input_file=None):
+    """The BAM files (with labels) finetune_data_generate reads."""
+    if sc_dataset:
+        with open(sc_dataset) as f:
+            return [line.strip().split("\t") for line in f if line.strip()]
+    return [[input_file]]
+
+def cache_key(checksum=False, **kwargs):
+    """Hash of all inputs and output-relevant parameters of a finetune_data_generate call."""
+    params = inspect.signature(fdg.finetune_data_generate).bind(**kwargs)
+    params.apply_defaults()
+    params = {k: v for k, v in params.arguments.items() if k not in IGNORED_PARAMS}
+
+    func = params.pop("read_extract_sequences_func", None)
+    key = {
+        "params": {k: v for k, v in params.items() if k not in ("f_dmr", "f_ref", "sc_dataset", "input_file")},
+        "read_extract_sequences_func": None if func is None else f"{func.__module__}.{func.__qualname__}",
+        "f_dmr": file_fingerprint(params["f_dmr"], checksum),
+        "f_ref": file_fingerprint(params["f_ref"], checksum),
+        "bam_files": [[file_fingerprint(entry[0], checksum)] + entry[1:]
+                      for entry in bam_files(params["sc_dataset"], params["input_file"])],
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+
+def link_or_copy(src, dst):
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+def dir_size(path):
+    return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+
+def evict(cache_dir, max_bytes, keep=None):
+    """Remove the least recently used cache entries until the cache is below max_bytes."""
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if os.path.isdir(path) and not name.startswith("."):
+            entries.append((os.path.getmtime(path), dir_size(path), path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if path == keep:
+            continue
+        print(f"Evicting finetune data cache entry {os.path.basename(path)}")
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+def cached_finetune_data_generate(output_dir, cache_dir=CACHE_DIR, max_cache_bytes=MAX_CACHE_BYTES,
+                                  checksum=False, **kwargs):
+    """
+    finetune_data_generate with a cache. Takes the same arguments as finetune_data_generate.
+
+    Parameters:
+    output_dir (str): Directory where the output files are placed, as in finetune_data_generate.
+    cache_dir (str): Cache directory.
+    max_cache_bytes (int): Size limit of the cache directory.
+    checksum (bool): Identify input files by SHA-256 checksum instead of size and modification time.
+
+    Returns:
+    list: Paths of the output files in output_dir.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    os.makedirs(output_dir, exist_ok=True)
+    key = cache_key(checksum=checksum, output_dir=output_dir, **kwargs)
+    entry = os.path.join(cache_dir, key)
+
+    if os.path.isdir(entry):
+        print(f"Finetune data cache hit ({key[:12]}), reusing outputs.")
+        os.utime(entry)
+    else:
+        print(f"Finetune data cache miss ({key[:12]}), generating data...")
+        tmp_entry = os.path.join(cache_dir, f".{key}.{uuid.uuid4().hex}")
+        try:
+            fdg.finetune_data_generate(output_dir=tmp_entry, **kwargs)
+            try:
+                os.rename(tmp_entry, entry)
+            except OSError:  # another process stored the same entry meanwhile
+                pass
+        finally:
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+        evict(cache_dir, max_cache_bytes, keep=entry)
+
+    outputs = []
+    for name in sorted(os.listdir(entry)):
+        link_or_copy(os.path.join(entry, name), os.path.join(output_dir, name))
+        outputs.append(os.path.join(output_dir, name))
+    return outputs
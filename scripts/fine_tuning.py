@@ -11,12 +11,14 @@
 
 '''
 import torch
-from methylbert.data import finetune_data_generate as fdg
+from fdg_cache import cached_finetune_data_generate
+import instrumentation
 from methylbert.utils import set_seed
 from torch.utils.data import DataLoader
 from methylbert.data.vocab import MethylVocab
-from methylbert.data.dataset import MethylBertFinetuneDataset
-from methylbert.trainer import MethylBertFinetuneTrainer
+from memmap_dataset import memmap_finetune_dataset, weighted_sampler
+from model_store import pretrained_model
+from resumable_trainer import ResumableFinetuneTrainer
 import os
 import pandas as pd
 from methylbert.deconvolute import deconvolute
@@ -29,6 +31,8 @@ from transformers import AutoModel
 '''
 
 torch.multiprocessing.set_sharing_strategy('file_system')
+# Timings, batch latencies and resources, written if METRICS_REPORT / METRICS_PROMETHEUS are set (see instrumentation.py)
+instrumentation.start("fine_tuning")
 print("Fine Tuning start...")
 
 f_bam_file_list = "../fine_tune_data.txt"
@@ -36,7 +40,7 @@ f_dmr = "../data/reference/dmr_filtered.csv"
 f_ref = "../data/reference/hg38.fa"
 out_dir = "tmp/"
 
-fdg.finetune_data_generate(
+cached_finetune_data_generate(
     sc_dataset = f_bam_file_list,
     f_dmr = f_dmr,
     f_ref = f_ref,
@@ -53,6 +57,7 @@ seq_len=100
 n_mers=3
 batch_size=5
 num_workers=0
+checkpoint_freq=500
 output_path = "tmp/fine_tune/"
 
 print("[1/8] set fine-tuning parameters")
@@ -63,36 +68,38 @@ tokenizer = MethylVocab(n_mers)
 print("[2/8] Created Tokenizer")
 
 # Load the data files int a data set object
-train_dataset = MethylBertFinetuneDataset("tmp/train_seq.csv",
+train_dataset = memmap_finetune_dataset("tmp/train_seq.csv",
                                           tokenizer,
                                           seq_len=seq_len)
-test_dataset = MethylBertFinetuneDataset("tmp/test_seq.csv",
+test_dataset = memmap_finetune_dataset("tmp/test_seq.csv",
                                          tokenizer,seq_len=seq_len)
 
 print("[3/8] Data loaded to Dataset object.")
 
 # Load the data into a data loader
-train_data_loader = DataLoader(train_dataset, batch_size=batch_size, num_workers=num_workers, pin_memory=False, shuffle=True)
+# Collapsed reads (pat_to_sam.py --collapse) are drawn in proportion to their XC count, other data is just shuffled
+train_data_loader = DataLoader(train_dataset, batch_size=batch_size, num_workers=num_workers, pin_memory=False, sampler=weighted_sampler(train_dataset))
 
-test_data_loader = DataLoader(test_dataset, batch_size=batch_size, num_workers=num_workers, pin_memory=True, shuffle=False)
+test_data_loader = DataLoader(test_dataset, batch_size=batch_size, num_workers=num_workers, pin_memory=True, sampler=weighted_sampler(test_dataset, shuffle=False))
 
 print("[4/8] Data loaded into data loader.")
 
 # creating trainer object for fine tuning model
-trainer = MethylBertFinetuneTrainer(len(tokenizer),
+trainer = ResumableFinetuneTrainer(len(tokenizer),
                       save_path=output_path,
                       train_dataloader=train_data_loader,
                       test_dataloader=test_data_loader,
                       lr=1e-4, with_cuda=False,
                       log_freq=1,
                       eval_freq=1, #activate this only when you want to evaluate the model with test_data_loader
-                      warmup_step=3
+                      warmup_step=3,
+                      checkpoint_freq=checkpoint_freq # continues from tmp/fine_tune/checkpoint/ after a crash
                       )
 
 print("[5/8] Created trainer object")
 
 # load pretrained model into trainer object
-trainer.load("hanyangii/methylbert_hg19_2l") # alternative numbers of encoder blocks: 2,4,6,8,12
+trainer.load(pretrained_model(2)) # alternative numbers of encoder blocks: 2,4,6,8,12 (python model_store.py fetch --layers 2)
 
 print("[6/8] Loaded model into trainer.")
 
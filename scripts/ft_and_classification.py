@@ -1,4 +1,4 @@
-''' Fine tuning of the methylbert model. '''
+''' Fine tuning of the methylbert model and deconvolution of the bulk sample, as one pipeline. '''
 
 
 ''' Input data needed:
@@ -7,169 +7,151 @@
     DMRs as a tab-separated .csv file
     Pure tumour and normal samples as BAM/SAM files
 
+    The stages run with pipeline.py: a stage is skipped if its outputs are newer than its inputs,
+    the bulk data generation runs alongside the training, and tmp/run_report.json records the
+    wall time, peak memory and output sizes of every stage, with the batch latencies and reads/s
+    of the fine-tuning and the deconvolution (python instrumentation.py tmp/run_report.json).
+
 '''
-from methylbert.data import finetune_data_generate as fdg
+import argparse
+import os
+
 from methylbert.utils import set_seed
 from torch.utils.data import DataLoader
 from methylbert.data.vocab import MethylVocab
-from methylbert.data.dataset import MethylBertFinetuneDataset
-from methylbert.trainer import MethylBertFinetuneTrainer
-import os
-import pandas as pd
-from methylbert.deconvolute import deconvolute
-from transformers import AutoModel
-
-''' This part preprosses the tumor and normal data later used for fine tuning the model.
-    The output files are seq_train.csv, seq_test.csv and dmrs.csv.
-    They can later be loaded into a dataloader.
-
-'''
+from model_store import pretrained_model
+from resumable_trainer import ResumableFinetuneTrainer
 
-print("Fine Tuning start...")
+from fdg_cache import cached_finetune_data_generate
+from memmap_dataset import memmap_finetune_dataset, weighted_sampler
+from pipeline import Pipeline, Stage
+import fast_deconvolution as fd
 
 f_bam_file_list = "../fine_tune_data.txt"
 f_bam = "../data/bam_for_classification/sorted_bulk_data.bam"
 f_dmr = "../data/reference/dmr_filtered.csv"
 f_ref = "../data/reference/hg38.fa"
-out_dir = "test/"
+out_dir = "tmp/"
+bulk_dir = "tmp/bulk/"
+model_dir = "tmp/fine_tune/"
+deconvolution_dir = "tmp/deconvolution/"
+report = "tmp/run_report.json"
 
-
-fdg.finetune_data_generate(
-    sc_dataset = f_bam_file_list,
-    f_dmr = f_dmr,
-    f_ref = f_ref,
-    output_dir=out_dir,
-    split_ratio = 0.8, # Split ratio to make training and validation data
-    n_mers=3, # 3-mer DNA sequences
-    n_cores=20
-)
-
-# This part is for fine tuning the model.
-
-set_seed(42)
 seq_len=100
 n_mers=3
 batch_size=5
 num_workers=0
-output_path = "tmp/fine_tune/"
-
-print("[1/13] set fine-tuning parameters")
-
-# Creat a look-up table
-tokenizer = MethylVocab(n_mers)
-
-print("[2/13] Created Tokenizer")
-
-# Load the data files int a data set object
-train_dataset = MethylBertFinetuneDataset("tmp/train_seq.csv",
-                                          tokenizer,
-                                          seq_len=seq_len)
-test_dataset = MethylBertFinetuneDataset("tmp/test_seq.csv",
-                                         tokenizer,seq_len=seq_len)
-
-print("[3/13] Data loaded to Dataset object.")
-
-# Load the data into a data loader
-train_data_loader = DataLoader(train_dataset, batch_size=batch_size, num_workers=num_workers, pin_memory=False, shuffle=True)
-
-test_data_loader = DataLoader(test_dataset, batch_size=batch_size, num_workers=num_workers, pin_memory=True, shuffle=False)
-
-print("[4/13] Data loaded into data loader.")
-
-# creating trainer object for fine tuning model
-trainer = MethylBertFinetuneTrainer(len(tokenizer),
-                      save_path=output_path,
-                      train_dataloader=train_data_loader,
-                      test_dataloader=test_data_loader,
-                      lr=1e-4, with_cuda=False,
-                      log_freq=1,
-                      #eval_freq=10, #activate this only when you want to evaluate the model with test_data_loader
-                      warmup_step=3,
-                      use_multiprocessing=False
-                      )
-
-print("[5/13] Created trainer object")
-
-# load pretrained model into trainer object
-trainer.load("hanyangii/methylbert_hg19_2l") # alternative numbers of encoder blocks: 2,4,6,8,12
-
-print("[6/13] Loaded model into trainer.")
-
-''' Training produces the following files in the tmp/fine_tune/ directory.
-
-    config.json and pytorch_model.bin: model configuration and the trained MethylBERT model
-    dmr_encoder.pickle : The trained DMR encoder in the MethylBERT model
-    read_classification_model.pickle : The trained fully connected neural network for read classification
-    train.csv and eval.csv : tracked training and evaluation loss and accuracy values during the training
-
-'''
-trainer.train(steps=1)
-print("[7/13] Completed Training")
-
-
-''' Second part of the MethylBERT procedure. Fine Tuning needs to be finished. '''
-
-''' This part preprocesses the input bulk data used for testing later.
-    Here, the output file data.csv is generated.
-    This should also be loaded into a dataloader later.
-
-'''
-
-fdg.finetune_data_generate(
-    input_file = f_bam,
-    f_dmr = f_dmr,
-    f_ref = f_ref,
-    output_dir=out_dir,
-    n_mers=3, # 3-mer DNA sequences
-    n_cores=20
-)
-
-
-# This part is for the actual deconvolution of the bulk data.
-
-output_path="tmp/deconvolution/"
-
-
-print("[8/13] Setup for deconvolution complete")
-
-
-print("[9/13] Created tokenizer")
-
-# loading the bulk data
-dataset = MethylBertFinetuneDataset("tmp/data.csv",
-                                    tokenizer,
-                                    seq_len=seq_len)
-data_loader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers)
-
-
-print("[10/13] Created dataset")
-
-restore_dir = "tmp/fine_tune/"
-trainer = MethylBertFinetuneTrainer(len(tokenizer),
-                                    train_dataloader=train_data_loader,
-                                    test_dataloader=data_loader, with_cude=False
-                                    )
-print("[11/13] Trainer created")
-
-#trainer.load("model") # Load the fine-tuned MethylBERT model
-trainer.load(restore_dir)
-
-print("[12/13] model loaded")
-
-''' deconvolution produces the following output files:
-
-
-    decconvolution.csv : tumour deconvolution result
-    FI.csv : the Fisher information value
-    res.csv : read classification result (the classification result for each read is given in pred column)
-
-    If estimate adjustment is needed, add adjustment = True as parameter to the function.
-
-'''
-deconvolute(trainer = trainer,
-            tokenizer = tokenizer,
-            data_loader = data_loader,
-            output_path = output_path,
-            df_train = pd.read_csv("tmp/train_seq.csv", sep="\t"))
-
-print("[13/13] Deconvolution complete.")
+checkpoint_freq=500
+
+def generate_fine_tune_data():
+    ''' This part preprosses the tumor and normal data later used for fine tuning the model.
+        The output files are train_seq.csv, test_seq.csv and dmrs.csv.
+    '''
+    cached_finetune_data_generate(
+        sc_dataset = f_bam_file_list,
+        f_dmr = f_dmr,
+        f_ref = f_ref,
+        output_dir=out_dir,
+        split_ratio = 0.8, # Split ratio to make training and validation data
+        n_mers=n_mers, # 3-mer DNA sequences
+        n_cores=20
+    )
+
+def generate_bulk_data():
+    ''' This part preprocesses the input bulk data used for the deconvolution.
+        Here, the output file data.csv is generated (in its own directory, the dmrs.csv would clash otherwise).
+    '''
+    cached_finetune_data_generate(
+        input_file = f_bam,
+        f_dmr = f_dmr,
+        f_ref = f_ref,
+        output_dir=bulk_dir,
+        n_mers=n_mers, # 3-mer DNA sequences
+        n_cores=20
+    )
+
+def fine_tune():
+    ''' Training produces the following files in the tmp/fine_tune/ directory.
+
+        config.json and the model weights: model configuration and the trained MethylBERT model
+        dmr_encoder.pickle : The trained DMR encoder in the MethylBERT model
+        read_classification_model.pickle : The trained fully connected neural network for read classification
+        train.csv and eval.csv : tracked training and evaluation loss and accuracy values during the training
+    '''
+    set_seed(42)
+
+    # Creat a look-up table
+    tokenizer = MethylVocab(n_mers)
+
+    # Load the data files int a data set object
+    train_dataset = memmap_finetune_dataset(os.path.join(out_dir, "train_seq.csv"), tokenizer, seq_len=seq_len)
+    test_dataset = memmap_finetune_dataset(os.path.join(out_dir, "test_seq.csv"), tokenizer, seq_len=seq_len)
+
+    # Collapsed reads (pat_to_sam.py --collapse) are drawn in proportion to their XC count, other data is just shuffled
+    train_data_loader = DataLoader(train_dataset, batch_size=batch_size, num_workers=num_workers, pin_memory=False, sampler=weighted_sampler(train_dataset))
+    test_data_loader = DataLoader(test_dataset, batch_size=batch_size, num_workers=num_workers, pin_memory=True, sampler=weighted_sampler(test_dataset, shuffle=False))
+
+    # creating trainer object for fine tuning model
+    trainer = ResumableFinetuneTrainer(len(tokenizer),
+                          save_path=model_dir,
+                          train_dataloader=train_data_loader,
+                          test_dataloader=test_data_loader,
+                          lr=1e-4, with_cuda=False,
+                          log_freq=1,
+                          #eval_freq=10, #activate this only when you want to evaluate the model with test_data_loader
+                          warmup_step=3,
+                          use_multiprocessing=False,
+                          checkpoint_freq=checkpoint_freq # continues from tmp/fine_tune/checkpoint/ after a crash
+                          )
+
+    # load pretrained model into trainer object
+    trainer.load(pretrained_model(2)) # alternative numbers of encoder blocks: 2,4,6,8,12 (python model_store.py fetch --layers 2)
+    trainer.train(steps=1)
+
+def deconvolute_bulk():
+    ''' deconvolution produces the following output files:
+
+        deconvolution.csv : tumour deconvolution result
+        FI.csv : the Fisher information value
+        res.csv : read classification result (the classification result for each read is given in pred column)
+    '''
+    tokenizer = MethylVocab(n_mers)
+    dataset = memmap_finetune_dataset(os.path.join(bulk_dir, "data.csv"), tokenizer, seq_len=seq_len)
+    model = fd.load_model(model_dir, seq_len)
+    probs = fd.classify_reads(model, dataset)
+    res = fd.read_results(dataset, probs)
+    fd.estimate_proportions(res, fd.read_train_ctypes(os.path.join(out_dir, "train_seq.csv")),
+                            deconvolution_dir)
+
+def fine_tune_bams():
+    with open(f_bam_file_list) as f:
+        return [line.split("\t")[0].strip() for line in f if line.strip()]
+
+def build_pipeline(jobs=2, prometheus=None, profile_dir=None):
+    train_files = [os.path.join(out_dir, name) for name in ("train_seq.csv", "test_seq.csv", "dmrs.csv")]
+    model_files = [os.path.join(model_dir, "config.json"), os.path.join(model_dir, "dmr_encoder.pickle")]
+    bulk_file = os.path.join(bulk_dir, "data.csv")
+    return Pipeline([
+        Stage("fine_tune_data", generate_fine_tune_data,
+              inputs=[f_bam_file_list, f_dmr, f_ref] + fine_tune_bams(), outputs=train_files),
+        Stage("bulk_data", generate_bulk_data, inputs=[f_bam, f_dmr, f_ref], outputs=[bulk_file]),
+        Stage("fine_tune", fine_tune, inputs=train_files[:2], outputs=model_files),
+        Stage("deconvolution", deconvolute_bulk, inputs=model_files + [bulk_file, train_files[0]],
+              outputs=[os.path.join(deconvolution_dir, name) for name in ("res.csv", "deconvolution.csv")]),
+    ], report=report, jobs=jobs, prometheus=prometheus, profile_dir=profile_dir)
+
+def main():
+    parser = argparse.ArgumentParser(description="Fine-tune MethylBERT and deconvolute the bulk sample, skipping up-to-date stages.")
+    parser.add_argument("-j", "--jobs", type=int, default=2, help="Stages running at the same time (default: 2)")
+    parser.add_argument("--force", action="store_true", help="Run all stages, even if they are up to date")
+    parser.add_argument("--prometheus", default=None, help="Prometheus textfile with the metrics of every stage")
+    parser.add_argument("--profile-dir", default=None, help="Directory for a cProfile dump of every stage (<stage>.prof)")
+    args = parser.parse_args()
+
+    result = build_pipeline(args.jobs, args.prometheus, args.profile_dir).run(force=args.force)
+    print(f"Run report written to {report}")
+    if any(stage["status"] in ("failed", "blocked") for stage in result["stages"]):
+        raise SystemExit("Pipeline failed")
+
+if __name__ == "__main__":
+    main()
@@ -1,56 +1,308 @@
-''' This generates the data needed for testing the fine-tuned model by combining reads from generated bam files.'''
+''' This generates the data needed for testing the fine-tuned model by combining reads from generated bam files.
 
-import pysam
+Reads are drawn with a seeded single-pass reservoir sampler, so memory is bounded by the number
+of requested reads and not by the size of the input BAM files. The output is coordinate-sorted and indexed.
+
+In grid mode many mixtures (e.g. tumour fractions x depths) are generated at once: every source BAM is
+read only once and its sampled reads are routed to all mixtures, each with a manifest of the true proportions.
+'''
+
+import argparse
+import heapq
+import math
+import os
 import random
+import pysam
+
+class Reservoir:
+    """
+    Uniform random sample of k items from a stream of unknown length (Algorithm L).
+
+    The caller only has to offer the item whose stream index equals next_index,
+    all other items are skipped without touching the random number generator.
+
+    Parameters:
+    k (int): The number of items to keep.
+    rng (random.Random): Random number generator.
+    """
+
+    def __init__(self, k, rng):
+        self.k = k
+        self.rng = rng
+        self.items = []
+        self.next_index = 0 if k > 0 else math.inf
+        self._w = 1.0
+
+    def _uniform(self):
+        return 1.0 - self.rng.random()  # in (0, 1], safe for log()
+
+    def _skip(self):
+        return math.floor(math.log(self._uniform()) / math.log(1.0 - self._w))
 
-def select_random_reads(bam_file, n_reads):
+    def offer(self, index, item):
+        """Add the item with stream index next_index to the sample."""
+        if len(self.items) < self.k:
+            self.items.append(item)
+            if len(self.items) < self.k:
+                self.next_index = index + 1
+                return
+        else:
+            self.items[self.rng.randrange(self.k)] = item
+        self._w *= math.exp(math.log(self._uniform()) / self.k)
+        self.next_index = index + self._skip() + 1
+
+def select_random_reads_multi(bam_file, sizes, rng):
     """
-    Randomly select n_reads from a BAM file.
+    Draw several independent random samples from a BAM file in a single pass.
+
+    Parameters:
+    bam_file (str): The path to the BAM file.
+    sizes (list): The number of reads of every sample.
+    rng (random.Random): Random number generator.
+
+    Returns:
+    list: One list of selected reads per size (all reads if the file has fewer).
+    """
+    reservoirs = [Reservoir(k, rng) for k in sizes]
+    # Reservoirs ordered by the stream index of the next read they accept
+    pending = [(r.next_index, j) for j, r in enumerate(reservoirs) if r.k > 0]
+    heapq.heapify(pending)
+    with pysam.AlignmentFile(bam_file, "rb") as samfile:
+        for i, read in enumerate(samfile.fetch(until_eof=True)):
+            if not pending:
+                break
+            while pending[0][0] == i:
+                _, j = pending[0]
+                reservoirs[j].offer(i, read)
+                heapq.heapreplace(pending, (reservoirs[j].next_index, j))
+    return [r.items for r in reservoirs]
+
+def select_random_reads(bam_file, n_reads, rng):
+    """
+    Randomly select n_reads from a BAM file in a single pass.
 
     Parameters:
     bam_file (str): The path to the BAM file.
     n_reads (int): The number of reads to randomly select.
+    rng (random.Random): Random number generator.
 
     Returns:
-    list: List of selected reads.
+    list: List of selected reads (all reads if the file has fewer than n_reads).
+    """
+    return select_random_reads_multi(bam_file, [n_reads], rng)[0]
+
+def split_reads(n_reads, proportions):
     """
-    # Open the BAM file
-    samfile = pysam.AlignmentFile(bam_file, "rb")
+    Split n_reads into integer read counts following the given proportions (largest remainder).
+
+    Parameters:
+    n_reads (int): Total number of reads.
+    proportions (list): Mixing proportions, normalised to sum to one.
 
-    # Get all reads
-    all_reads = [read for read in samfile.fetch()]
+    Returns:
+    list: Number of reads per proportion, summing to n_reads.
+    """
+    total = sum(proportions)
+    if total <= 0 or any(p < 0 for p in proportions):
+        raise ValueError(f"Proportions must be non-negative and not all zero, got {proportions}")
+    exact = [n_reads * p / total for p in proportions]
+    counts = [math.floor(e) for e in exact]
+    by_remainder = sorted(range(len(exact)), key=lambda i: counts[i] - exact[i])
+    for i in by_remainder[:n_reads - sum(counts)]:
+        counts[i] += 1
+    return counts
 
-    # Randomly select n_reads
-    selected_reads = random.sample(all_reads, min(n_reads, len(all_reads)))
+def check_headers(bam_files):
+    """Return the header of the first BAM file after checking all files use the same references."""
+    with pysam.AlignmentFile(bam_files[0], "rb") as f:
+        header = f.header
+    for bam_file in bam_files[1:]:
+        with pysam.AlignmentFile(bam_file, "rb") as f:
+            if f.references != header.references or f.lengths != header.lengths:
+                raise ValueError(f"{bam_file} uses different reference sequences than {bam_files[0]}")
+    return header
 
-    return selected_reads
+def write_sorted_bam(reads, header, output_file):
+    """Write reads coordinate-sorted (unmapped reads last) to output_file and index it."""
+    def sort_key(read):
+        tid = read.reference_id if read.reference_id >= 0 else math.inf
+        return tid, read.reference_start
+    with pysam.AlignmentFile(output_file, "wb", header=header) as out_bam:
+        for read in sorted(reads, key=sort_key):
+            out_bam.write(read)
+    pysam.index(output_file)
 
-def combine_bam_files(bam_file_0, bam_file_1, n_reads_0, n_reads_1, output_file):
+def combine_bam_files(bam_files, proportions, n_reads, output_file, seed=None):
     """
-    Combine random reads from two BAM files into one.
+    Combine random reads from several BAM files into one sorted and indexed BAM file.
 
     Parameters:
-    bam_file_0 (str): The path to the BAM file for cell type 0.
-    bam_file_1 (str): The path to the BAM file for cell type 1.
-    n_reads_0 (int): The number of reads to select from bam_file_0.
-    n_reads_1 (int): The number of reads to select from bam_file_1.
+    bam_files (list): The paths to the BAM files, one per cell type.
+    proportions (list): The mixing proportion of every BAM file.
+    n_reads (int): The total number of reads in the combined file.
     output_file (str): The path to save the combined BAM file.
+    seed (int): Random seed.
+
+    Returns:
+    list: The number of reads taken from every BAM file.
     """
-    # Select random reads from both BAM files
-    selected_reads_0 = select_random_reads(bam_file_0, n_reads_0)
-    selected_reads_1 = select_random_reads(bam_file_1, n_reads_1)
+    if len(bam_files) != len(proportions):
+        raise ValueError(f"Got {len(bam_files)} BAM files but {len(proportions)} proportions")
+    header = check_headers(bam_files)
+    rng = random.Random(seed)
 
-    # Open the output BAM file for writing
-    with pysam.AlignmentFile(output_file, "wb", header=pysam.AlignmentFile(bam_file_0, "rb").header) as out_bam:
-        # Write the selected reads from both cell types into the output BAM file
-        for read in selected_reads_0 + selected_reads_1:
-            out_bam.write(read)
+    selected_reads = []
+    n_selected = []
+    for bam_file, n in zip(bam_files, split_reads(n_reads, proportions)):
+        reads = select_random_reads(bam_file, n, rng)
+        if len(reads) < n:
+            print(f"Warning: {bam_file} has only {len(reads)} reads, {n} were requested.")
+        selected_reads.extend(reads)
+        n_selected.append(len(reads))
+
+    write_sorted_bam(selected_reads, header, output_file)
+    print(f"Wrote {len(selected_reads)} reads to {output_file}")
+    return n_selected
+
+def write_manifest(path, labels, bam_files, proportions, n_selected):
+    """Write the requested and the true (realised) proportion of every source of a mixture."""
+    total = sum(n_selected)
+    with open(path, "w") as f:
+        f.write("label\tbam\trequested_proportion\tn_reads\tproportion\n")
+        requested_total = sum(proportions)
+        for label, bam_file, p, n in zip(labels, bam_files, proportions, n_selected):
+            f.write(f"{label}\t{bam_file}\t{p / requested_total:.6g}\t{n}\t{n / total if total else 0.0:.6g}\n")
+
+def generate_mixtures(bam_files, labels, mixtures, output_dir, seed=None):
+    """
+    Generate many mixtures reading every source BAM file only once.
+
+    The reads sampled from one source are appended to unsorted temporary BAM files
+    of all mixtures right away, so only the reads of one source are held in memory.
+
+    Parameters:
+    bam_files (list): The paths to the BAM files, one per cell type.
+    labels (list): A label for every BAM file, used in the manifests.
+    mixtures (list): Dicts with name, depth (total reads) and proportions (one per BAM file).
+    output_dir (str): Directory for <name>.bam, <name>.proportions.tsv and manifest.tsv.
+    seed (int): Random seed.
+    """
+    header = check_headers(bam_files)
+    rng = random.Random(seed)
+    os.makedirs(output_dir, exist_ok=True)
+
+    counts = [split_reads(m["depth"], m["proportions"]) for m in mixtures]
+    n_selected = [[0] * len(bam_files) for _ in mixtures]
+    tmp_files = [os.path.join(output_dir, f".{m['name']}.unsorted.bam") for m in mixtures]
+    writers = [pysam.AlignmentFile(f, "wb", header=header) for f in tmp_files]
+    try:
+        for i, bam_file in enumerate(bam_files):
+            print(f"Sampling {bam_file} for {len(mixtures)} mixtures...")
+            samples = select_random_reads_multi(bam_file, [c[i] for c in counts], rng)
+            for m, reads in enumerate(samples):
+                if len(reads) < counts[m][i]:
+                    print(f"Warning: {bam_file} has only {len(reads)} reads, {counts[m][i]} were requested for {mixtures[m]['name']}.")
+                for read in reads:
+                    writers[m].write(read)
+                n_selected[m][i] = len(reads)
+    finally:
+        for writer in writers:
+            writer.close()
+
+    with open(os.path.join(output_dir, "manifest.tsv"), "w") as f_manifest:
+        f_manifest.write("\t".join(["name", "bam", "n_reads"] + labels) + "\n")
+        for m, mixture in enumerate(mixtures):
+            out_bam = os.path.join(output_dir, mixture["name"] + ".bam")
+            pysam.sort("-o", out_bam, tmp_files[m])
+            pysam.index(out_bam)
+            os.remove(tmp_files[m])
+            write_manifest(os.path.join(output_dir, mixture["name"] + ".proportions.tsv"),
+                           labels, bam_files, mixture["proportions"], n_selected[m])
+            total = sum(n_selected[m])
+            true_props = [f"{n / total if total else 0.0:.6g}" for n in n_selected[m]]
+            f_manifest.write("\t".join([mixture["name"], out_bam, str(total)] + true_props) + "\n")
+    print(f"Wrote {len(mixtures)} mixtures to {output_dir}")
+
+def read_grid(grid_file, labels):
+    """
+    Read mixtures from a tab-separated file with the columns name, depth and one column per label.
+    """
+    mixtures = []
+    with open(grid_file) as f:
+        columns = f.readline().rstrip("\n").split("\t")
+        missing = [l for l in labels if l not in columns]
+        if "name" not in columns or "depth" not in columns or missing:
+            raise ValueError(f"{grid_file} needs the columns name, depth and {', '.join(labels)}")
+        for line in f:
+            if not line.strip():
+                continue
+            row = dict(zip(columns, line.rstrip("\n").split("\t")))
+            mixtures.append({"name": row["name"], "depth": int(row["depth"]),
+                             "proportions": [float(row[l]) for l in labels]})
+    return mixtures
+
+def fraction_grid(fractions, depths, background_proportions):
+    """
+    Mixtures for every combination of fraction and depth. The first BAM file gets the fraction,
+    the other files share the rest following background_proportions.
+    """
+    background_total = sum(background_proportions)
+    mixtures = []
+    for depth in depths:
+        for fraction in fractions:
+            rest = [(1 - fraction) * p / background_total for p in background_proportions]
+            mixtures.append({"name": f"f{fraction:g}_d{depth}", "depth": depth,
+                             "proportions": [fraction] + rest})
+    return mixtures
+
+def parse_source(source):
+    """Parse 'file.bam' or 'file.bam:proportion'."""
+    path, sep, proportion = source.rpartition(":")
+    if sep and path:
+        try:
+            return path, float(proportion)
+        except ValueError:
+            pass
+    return source, None
+
+def main():
+    parser = argparse.ArgumentParser(description="Mix random reads from several BAM files into one or many bulk samples.")
+    parser.add_argument("bam_files", nargs="+", help="Input BAM files as file.bam or file.bam:proportion (default: equal proportions)")
+    parser.add_argument("-n", "--n-reads", type=int, help="Total number of reads in the bulk sample")
+    parser.add_argument("-o", "--output", default="../data/bam_for_classification/combined_bulk_sample.bam", help="Output BAM file")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed (default: 42)")
+    grid = parser.add_argument_group("grid mode", "Generate many mixtures in one pass over the BAM files")
+    grid.add_argument("--output-dir", help="Output directory for the mixtures (enables grid mode)")
+    grid.add_argument("--grid", help="Tab-separated file with the columns name, depth and one column per label")
+    grid.add_argument("--fractions", help="Comma-separated fractions of the first BAM file, e.g. 0.01,0.1,0.5,0.99")
+    grid.add_argument("--depths", help="Comma-separated total read counts, e.g. 1000,10000")
+    grid.add_argument("--labels", help="Comma-separated labels of the BAM files (default: file names)")
+    args = parser.parse_args()
+
+    sources = [parse_source(s) for s in args.bam_files]
+    bam_files = [path for path, _ in sources]
+    proportions = [1.0 if p is None else p for _, p in sources]
+
+    if args.output_dir is None:
+        if args.n_reads is None:
+            parser.error("--n-reads is required unless --output-dir is given")
+        combine_bam_files(bam_files, proportions, args.n_reads, args.output, args.seed)
+        return
 
-# Example usage
-bam_file_0 = "../data/bam_for_fine_tuning/GSM5652176_Adipocytes-Z000000T7.bam"
-bam_file_1 = "../data/bam_for_fine_tuning/GSM5652179_Aorta-Endothel-Z00000422.bam"
-n_reads_0 = 1000  # Select 1000 reads from cell type 0
-n_reads_1 = 1000  # Select 1000 reads from cell type 1
-output_file = "../data/bam_for_classification/combined_bulk_sample.bam"  # Combined BAM file with reads from both cell types
+    labels = args.labels.split(",") if args.labels else [os.path.basename(f).split(".")[0] for f in bam_files]
+    if len(labels) != len(bam_files):
+        parser.error("--labels needs one label per BAM file")
+    if args.grid:
+        mixtures = read_grid(args.grid, labels)
+    elif args.fractions and args.depths:
+        if len(bam_files) < 2:
+            parser.error("--fractions needs at least two BAM files")
+        mixtures = fraction_grid([float(f) for f in args.fractions.split(",")],
+                                 [int(d) for d in args.depths.split(",")],
+                                 proportions[1:])
+    else:
+        parser.error("grid mode needs either --grid or --fractions and --depths")
+    generate_mixtures(bam_files, labels, mixtures, args.output_dir, args.seed)
 
-combine_bam_files(bam_file_0, bam_file_1, n_reads_0, n_reads_1, output_file)
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,489 @@
+''' Timers, resource sampling, batch latency histograms and profiling for the scripts.
+
+All measurements go to one Metrics object per process (METRICS), through the module functions:
+- timer(name): context manager and decorator, records the durations in a histogram.
+- stage(name): a timer that also samples the RSS (of the process and its children) and the CPU usage
+  with psutil in a background thread.
+- batches(iterable, name): wraps a DataLoader (or any iterable of batches) and records per batch the time
+  spent waiting for the batch (name.load) and in the loop body (name.compute), and the reads per second.
+- count(name, n) and observe(name, seconds) for everything else.
+
+The fine-tuning (resumable_trainer.py) and the deconvolution (fast_deconvolution.py) record their batches,
+pipeline.py adds the metrics of every stage to the run report. session() writes the report as JSON and
+optionally as a Prometheus textfile (for the node exporter), and can profile the run: a .prof file is a
+cProfile dump (pstats, snakeviz), any other file gets collapsed stacks of a sampling profiler, the raw
+format of py-spy (flamegraph.pl, speedscope, inferno). Without arguments, the paths are taken from the
+environment variables METRICS_REPORT, METRICS_PROMETHEUS and METRICS_PROFILE, so flat scripts and
+library calls can be instrumented from the outside.
+
+with session("deconvolution", report="tmp/metrics.json", prometheus="tmp/metrics.prom", profile="tmp/run.prof"):
+    for batch in batches(data_loader, "deconvolution"):
+        ...
+
+python instrumentation.py tmp/metrics.json
+'''
+
+import argparse
+import bisect
+import cProfile
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+import psutil
+
+# Upper bounds of the latency histogram buckets in seconds (the last bucket is +Inf)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+SAMPLE_INTERVAL = 0.5  # seconds between two RSS/CPU samples of a stage
+PROFILE_INTERVAL = 0.01  # seconds between two stack samples
+ENV_REPORT = "METRICS_REPORT"
+ENV_PROMETHEUS = "METRICS_PROMETHEUS"
+ENV_PROFILE = "METRICS_PROFILE"
+PROMETHEUS_PREFIX = "methylbert_"
+THREAD_NAME = "instrumentation"  # sampler threads, not profiled
+
+class Histogram:
+    """Count, sum, min, max and bucket counts of observed durations."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = float("inf")
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """Upper bound of the bucket with the q-quantile (max for the last bucket)."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {"count": self.count, "total_s": self.sum, "mean_s": self.sum / self.count if self.count else None,
+                "min_s": self.min if self.count else None, "max_s": self.max,
+                "p50_s": self.quantile(0.5), "p90_s": self.quantile(0.9), "p99_s": self.quantile(0.99),
+                "buckets": {str(bound): n for bound, n in zip(self.buckets + ("+Inf",), self.counts)}}
+
+class ResourceSampler:
+    """Samples RSS (process and children) and CPU utilisation of the current process in a background thread."""
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.process = psutil.Process()
+        self.peak_rss = 0
+        self.peak_rss_children = 0
+        self.cpu_percent = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=THREAD_NAME, daemon=True)
+
+    def _sample(self):
+        try:
+            self.peak_rss = max(self.peak_rss, self.process.memory_info().rss)
+            children = 0
+            for child in self.process.children(recursive=True):
+                with contextlib.suppress(psutil.Error):
+                    children += child.memory_info().rss
+            self.peak_rss_children = max(self.peak_rss_children, children)
+        except psutil.Error:
+            pass
+
+    def _run(self):
+        self.process.cpu_percent()
+        while not self._stop.wait(self.interval):
+            self._sample()
+            self.cpu_percent.append(self.process.cpu_percent())
+
+    def __enter__(self):
+        self.cpu_start = self.process.cpu_times()
+        self.start = time.perf_counter()
+        self._sample()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+        cpu = self.process.cpu_times()
+        wall = time.perf_counter() - self.start
+        self.result = {
+            "wall_time_s": wall,
+            "cpu_user_s": cpu.user - self.cpu_start.user,
+            "cpu_system_s": cpu.system - self.cpu_start.system,
+            "cpu_children_s": (cpu.children_user + cpu.children_system) - (self.cpu_start.children_user + self.cpu_start.children_system),
+            "cpu_percent_mean": (cpu.user + cpu.system - self.cpu_start.user - self.cpu_start.system) / wall * 100 if wall else None,
+            "cpu_percent_max": max(self.cpu_percent, default=None),
+            "peak_rss_mb": round(self.peak_rss / 2**20, 1),
+            "peak_rss_children_mb": round(self.peak_rss_children / 2**20, 1),
+        }
+        return False
+
+class Timer(contextlib.ContextDecorator):
+    """Records the duration of a with block or of every call of a decorated function."""
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+        self._starts = []
+
+    def __enter__(self):
+        self._starts.append(time.perf_counter())
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self._starts.pop())
+        return False
+
+class Stage(contextlib.ContextDecorator):
+    """A timer that also samples the memory and CPU usage."""
+
+    def __init__(self, metrics, name, interval=SAMPLE_INTERVAL):
+        self.metrics = metrics
+        self.name = name
+        self.interval = interval
+        self._samplers = []
+
+    def __enter__(self):
+        self._samplers.append(ResourceSampler(self.interval).__enter__())
+        return self
+
+    def __exit__(self, *exc):
+        sampler = self._samplers.pop()
+        sampler.__exit__(*exc)
+        self.metrics.observe(self.name, sampler.result["wall_time_s"])
+        self.metrics.add_stage(self.name, sampler.result, failed=exc[0] is not None)
+        return False
+
+def batch_size(batch):
+    """Number of reads in a batch: a dict or tuple of tensors (the first one counts), or anything with a length."""
+    if isinstance(batch, dict):
+        batch = next(iter(batch.values()))
+    elif isinstance(batch, (tuple, list)) and batch and hasattr(batch[0], "__len__"):
+        batch = batch[0]
+    return len(batch)
+
+class Metrics:
+    """Histograms, counters, throughputs and stage resources of one process."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.histograms = {}
+        self.counters = Counter()
+        self.throughput = {}
+        self.stages = {}
+
+    def observe(self, name, seconds):
+        with self._lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(seconds)
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def add_items(self, name, items, seconds):
+        """Add items processed in seconds to the throughput of name."""
+        with self._lock:
+            total = self.throughput.setdefault(name, [0, 0.0])
+            total[0] += items
+            total[1] += seconds
+
+    def add_stage(self, name, result, failed=False):
+        with self._lock:
+            previous = self.stages.get(name)
+            if previous is None:
+                self.stages[name] = {**result, "runs": 1, "failed": int(failed)}
+                return
+            # A stage entered several times: times add up, peaks are the maximum
+            for key, value in result.items():
+                if value is None:
+                    continue
+                if key.startswith("peak_") or key == "cpu_percent_max":
+                    previous[key] = max(previous.get(key) or 0, value)
+                elif key != "cpu_percent_mean":
+                    previous[key] = (previous.get(key) or 0) + value
+            cpu = previous["cpu_user_s"] + previous["cpu_system_s"]
+            previous["cpu_percent_mean"] = cpu / previous["wall_time_s"] * 100 if previous["wall_time_s"] else None
+            previous["runs"] += 1
+            previous["failed"] += int(failed)
+
+    def timer(self, name):
+        return Timer(self, name)
+
+    def stage(self, name, interval=SAMPLE_INTERVAL):
+        return Stage(self, name, interval)
+
+    def batches(self, iterable, name, size=batch_size):
+        """
+        Yield the batches of iterable and record the latencies of every batch.
+
+        Parameters:
+        iterable: DataLoader or any other iterable of batches.
+        name (str): Prefix of the histograms name.load (waiting for the batch) and name.compute (the loop body).
+        size (callable): Number of reads of a batch, for the reads per second (None: not recorded).
+        """
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            loaded = time.perf_counter()
+            self.observe(f"{name}.load", loaded - start)
+            try:
+                yield batch
+            finally:
+                # Also after a break in the loop body
+                done = time.perf_counter()
+                self.observe(f"{name}.compute", done - loaded)
+                if size is not None:
+                    self.add_items(name, size(batch), done - start)
+
+    def report(self):
+        with self._lock:
+            return {
+                "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+                "pid": os.getpid(),
+                "stages": {name: dict(stats) for name, stats in self.stages.items()},
+                "timers": {name: histogram.to_dict() for name, histogram in self.histograms.items()},
+                "counters": dict(self.counters),
+                "throughput": {name: {"reads": items, "seconds": seconds, "reads_per_s": items / seconds if seconds else None}
+                               for name, (items, seconds) in self.throughput.items()},
+            }
+
+METRICS = Metrics()
+
+def timer(name):
+    """Context manager and decorator recording durations under name."""
+    return METRICS.timer(name)
+
+def stage(name, interval=SAMPLE_INTERVAL):
+    """Context manager and decorator recording duration, peak RSS and CPU usage under name."""
+    return METRICS.stage(name, interval)
+
+def batches(iterable, name, size=batch_size):
+    return METRICS.batches(iterable, name, size)
+
+def count(name, n=1):
+    METRICS.count(name, n)
+
+def observe(name, seconds):
+    METRICS.observe(name, seconds)
+
+def write_json(report, path):
+    """Write a report (Metrics.report() or a dict of them) atomically."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(report, f, indent=1)
+    os.replace(tmp_path, path)
+
+def metric_name(name):
+    return PROMETHEUS_PREFIX + "".join(c if c.isalnum() else "_" for c in name)
+
+def write_prometheus(reports, path, job=None):
+    """
+    Write reports in the Prometheus text format (for the textfile collector of the node exporter).
+
+    Parameters:
+    reports (dict): Metrics.report() outputs by stage (the stage label), or a single report.
+    path (str): Output .prom file, replaced atomically.
+    job (str): Value of the job label.
+    """
+    from prometheus_client import CollectorRegistry, write_to_textfile
+    from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, HistogramMetricFamily
+
+    if "timers" in reports:
+        reports = {"": reports}
+    labels = ["job", "stage"]
+
+    class ReportCollector:
+        def collect(self):
+            families = {}
+            def family(cls, name, doc, extra=()):
+                if name not in families:
+                    families[name] = cls(name, doc, labels=labels + list(extra))
+                return families[name]
+
+            for stage_label, report in reports.items():
+                values = [job or "", stage_label]
+                for name, histogram in report.get("timers", {}).items():
+                    buckets, cumulative = [], 0
+                    for bound, n in histogram["buckets"].items():
+                        cumulative += n
+                        buckets.append((bound, cumulative))
+                    family(HistogramMetricFamily, metric_name(name) + "_seconds", f"Duration of {name}") \
+                        .add_metric(values, buckets, histogram["total_s"])
+                for name, value in report.get("counters", {}).items():
+                    family(CounterMetricFamily, metric_name(name), f"Counter {name}").add_metric(values, value)
+                for name, stats in report.get("throughput", {}).items():
+                    family(CounterMetricFamily, metric_name(name) + "_reads", f"Reads of {name}").add_metric(values, stats["reads"])
+                    if stats["reads_per_s"] is not None:
+                        family(GaugeMetricFamily, metric_name(name) + "_reads_per_second", f"Reads per second of {name}") \
+                            .add_metric(values, stats["reads_per_s"])
+                for name, stats in report.get("stages", {}).items():
+                    for key, value in stats.items():
+                        if isinstance(value, (int, float)) and key not in ("runs", "failed"):
+                            family(GaugeMetricFamily, PROMETHEUS_PREFIX + "stage_" + key, f"Stage {key}", ["name"]) \
+                                .add_metric(values + [name], value)
+            yield from families.values()
+
+    registry = CollectorRegistry()
+    registry.register(ReportCollector())
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    write_to_textfile(path, registry)
+
+class StackSampler:
+    """Sampling profiler: counts the stacks of all other threads every interval seconds (collapsed stack format)."""
+
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=THREAD_NAME, daemon=True)
+
+    def _run(self):
+        names = {}
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id not in names:
+                    names = {t.ident: t.name for t in threading.enumerate()}
+                if names.get(thread_id) == THREAD_NAME:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({code.co_filename}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stack.append(f"thread ({names.get(thread_id, thread_id)})")
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self, path):
+        self._stop.set()
+        self._thread.join()
+        with open(path, "w") as f:
+            f.writelines(f"{stack} {n}\n" for stack, n in self.stacks.most_common())
+
+@contextlib.contextmanager
+def profiled(path):
+    """Profile the with block: cProfile dump for .prof files, collapsed stacks (py-spy raw format) otherwise."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    if path.endswith(".prof"):
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(path)
+    else:
+        sampler = StackSampler()
+        sampler.start()
+        try:
+            yield
+        finally:
+            sampler.stop(path)
+    print(f"Profile written to {path}")
+
+@contextlib.contextmanager
+def session(name, report=None, prometheus=None, profile=None):
+    """
+    Run the with block as the stage name, then write the metrics of the process.
+
+    Parameters:
+    name (str): Name of the stage (and of the Prometheus job).
+    report (str): JSON report (default: $METRICS_REPORT, no report if neither is set).
+    prometheus (str): Prometheus textfile (default: $METRICS_PROMETHEUS).
+    profile (str): Profile output, .prof for cProfile, collapsed stacks otherwise (default: $METRICS_PROFILE).
+    """
+    report = report or os.environ.get(ENV_REPORT)
+    prometheus = prometheus or os.environ.get(ENV_PROMETHEUS)
+    profile = profile or os.environ.get(ENV_PROFILE)
+    try:
+        with profiled(profile) if profile else contextlib.nullcontext(), stage(name):
+            yield METRICS
+    finally:
+        if report:
+            write_json({"name": name, **METRICS.report()}, report)
+            print(f"Metrics written to {report}")
+        if prometheus:
+            write_prometheus(METRICS.report(), prometheus, job=name)
+
+def start(name, **kwargs):
+    """Start a session for the rest of the process (for flat scripts), finished at exit."""
+    import atexit
+    context = session(name, **kwargs)
+    context.__enter__()
+    atexit.register(context.__exit__, None, None, None)
+
+def add_arguments(parser):
+    """Add --metrics, --prometheus and --profile to an argparse parser (see session)."""
+    group = parser.add_argument_group("instrumentation")
+    group.add_argument("--metrics", default=None, help=f"JSON report of timings, batch latencies and resources (default: ${ENV_REPORT})")
+    group.add_argument("--prometheus", default=None, help=f"Prometheus textfile with the same metrics (default: ${ENV_PROMETHEUS})")
+    group.add_argument("--profile", default=None, help=f"Profile output: .prof for a cProfile dump, otherwise collapsed stacks (default: ${ENV_PROFILE})")
+    return group
+
+def session_from_args(name, args):
+    return session(name, args.metrics, args.prometheus, args.profile)
+
+def summary(report):
+    """Lines of a table with the stages and timers of a JSON report, slowest first."""
+    reports = report["stages"] if "timers" not in report else {"": report}
+    rows = []
+    for stage_label, stage_report in reports.items():
+        metrics = stage_report.get("metrics", stage_report)
+        prefix = f"{stage_label}/" if stage_label else ""
+        for name, histogram in metrics.get("timers", {}).items():
+            rows.append((histogram["total_s"], f"{prefix}{name}", histogram))
+    lines = [f"{'timer':50} {'count':>9} {'total_s':>10} {'mean_ms':>9} {'p90_ms':>9} {'max_ms':>9}"]
+    for total, name, histogram in sorted(rows, key=lambda row: -row[0]):
+        lines.append(f"{name:50} {histogram['count']:9d} {total:10.2f} {histogram['mean_s'] * 1000:9.2f} "
+                     f"{histogram['p90_s'] * 1000:9.2f} {histogram['max_s'] * 1000:9.2f}")
+    for stage_label, stage_report in reports.items():
+        metrics = stage_report.get("metrics", stage_report)
+        for name, stats in metrics.get("throughput", {}).items():
+            if stats["reads_per_s"] is not None:
+                lines.append(f"{stage_label + '/' if stage_label else ''}{name}: {stats['reads']} reads, {stats['reads_per_s']:.0f} reads/s")
+    return lines
+
+def main():
+    parser = argparse.ArgumentParser(description="Print the timers of a metrics report (or a pipeline run report), slowest first.")
+    parser.add_argument("report", help="JSON report written by --metrics or tmp/run_report.json")
+    args = parser.parse_args()
+    with open(args.report) as f:
+        report = json.load(f)
+    if isinstance(report.get("stages"), list):
+        # Run report of pipeline.py
+        report = {"stages": {stage["name"]: stage for stage in report["stages"] if "metrics" in stage}}
+    print("\n".join(summary(report)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,298 @@
+''' Pre-tokenized, memory-mapped version of the finetune_data_generate outputs (train_seq.csv, test_seq.csv, data.csv).
+
+The conversion runs once per CSV file (or Parquet file, see columnar.py) and writes into a directory next to
+it (e.g. tmp/train_seq.csv.mm/):
+- dna_seq.npy: token IDs (int32, seq_len+1 per read, with SOS/EOS and padding as in MethylBertFinetuneDataset)
+- methyl_seq.npy: methylation states (int8, same shape)
+- dmr_label.npy, ctype_label.npy: labels (int32)
+- <column>.npy: every other column of the CSV (dmr_ctype, ctype, name, ...) as fixed-width byte strings
+- weight.npy: read weights (float32) from the XC column of collapsed reads (pat_to_sam.py --collapse), if present
+- meta.json: number of reads, seq_len, n_mers, columns and the source file it was made from
+
+MemmapFinetuneDataset returns the same items as MethylBertFinetuneDataset, so it can be used with
+MethylBertFinetuneTrainer and deconvolute. The arrays are opened with mmap, so all DataLoader workers
+share the same pages instead of each holding a copy of the parsed CSV.
+
+A collapsed read stands for XC identical reads. weighted_sampler draws the reads in proportion to their
+weight, so the training sees the distribution of the uncollapsed data:
+
+DataLoader(train_dataset, batch_size=batch_size, sampler=weighted_sampler(train_dataset))
+'''
+
+import argparse
+import csv
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import torch
+from torch.utils.data import Dataset, RandomSampler, Sampler, SequentialSampler, WeightedRandomSampler
+
+from methylbert.data.vocab import MethylVocab
+
+from columnar import is_parquet, iter_chunks
+
+META_FILE = "meta.json"
+FORMAT_VERSION = 2
+WEIGHT_COLUMN = "XC"  # multiplicity tag of collapsed reads, see pat_to_sam.py
+CHUNK_SIZE = 100_000
+# Columns that are stored as tokens/labels instead of strings
+TOKEN_COLUMNS = ("dna_seq", "methyl_seq", "dmr_label")
+REQUIRED_COLUMNS = ("dna_seq", "methyl_seq", "ctype", "dmr_ctype", "dmr_label")
+
+def read_chunks(csv_path, chunksize=CHUNK_SIZE):
+    """Read a finetune_data_generate CSV (or its Parquet conversion) in chunks, with all values as strings."""
+    if is_parquet(csv_path):
+        # The values as they would be in the CSV file, missing values as empty strings
+        return (chunk.astype("string").fillna("").astype(object) for chunk in iter_chunks(csv_path, chunksize=chunksize))
+    return pd.read_csv(csv_path, sep="\t", dtype=str, keep_default_na=False, na_filter=False,
+                       quoting=csv.QUOTE_NONE, chunksize=chunksize)
+
+def tokenize(dna_seqs, methyl_seqs, vocab, seq_len):
+    """
+    Tokenize reads exactly like MethylBertFinetuneDataset.__getitem__.
+
+    Parameters:
+    dna_seqs (list): Space-separated k-mer strings.
+    methyl_seqs (list): Methylation state strings (0, 1 or 2 per k-mer).
+    vocab (MethylVocab): Look-up table for the k-mers.
+    seq_len (int): Length of the processed sequences (without SOS).
+
+    Returns:
+    tuple: Token IDs (int32) and methylation states (int8), both with shape (reads, seq_len+1).
+    """
+    n = len(dna_seqs)
+    dna = np.full((n, seq_len + 1), vocab.pad_index, dtype=np.int32)
+    methyl = np.full((n, seq_len + 1), 2, dtype=np.int8)
+    for i, (seq, states) in enumerate(zip(dna_seqs, methyl_seqs)):
+        tokens = vocab.to_seq(seq.split(" "))[:seq_len]
+        dna[i, 1:len(tokens) + 1] = tokens
+        states = np.frombuffer(states.encode()[:seq_len], dtype=np.uint8) - ord("0")
+        methyl[i, 1:len(states) + 1] = states
+
+    # The last non-padding token is followed by EOS, or replaced by it if the read fills seq_len
+    rows = np.arange(n)
+    nonpad = dna[:, 1:] != vocab.pad_index
+    end = seq_len - np.argmax(nonpad[:, ::-1], axis=1)
+    end = np.minimum(end, seq_len - 1) + 1
+    dna[rows, end] = vocab.eos_index
+    methyl[rows, end] = 2
+    dna[:, 0] = vocab.sos_index
+    methyl[:, 0] = 2
+    return dna, methyl
+
+def read_weights(counts):
+    """Read weights from the XC column values, 1 for reads without a count."""
+    return pd.to_numeric(counts.replace("", "1")).to_numpy(dtype=np.float32)
+
+def source_stamp(csv_path):
+    stat = os.stat(csv_path)
+    return {"path": os.path.abspath(csv_path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+def convert_finetune_csv(csv_path, output_dir=None, seq_len=100, n_mers=3, chunksize=CHUNK_SIZE):
+    """
+    Convert a finetune_data_generate CSV into the memory-mapped format.
+
+    Parameters:
+    csv_path (str): Path to train_seq.csv, test_seq.csv or data.csv (or their .parquet conversion).
+    output_dir (str): Output directory (default: csv_path + ".mm").
+    seq_len (int): Length of the processed sequences, as the seq_len of MethylBertFinetuneDataset.
+    n_mers (int): k of the k-mer tokens.
+    chunksize (int): Number of CSV lines processed at once.
+
+    Returns:
+    str: The output directory.
+    """
+    output_dir = output_dir or csv_path + ".mm"
+    os.makedirs(output_dir, exist_ok=True)
+    if os.path.exists(os.path.join(output_dir, META_FILE)):
+        os.remove(os.path.join(output_dir, META_FILE))
+    vocab = MethylVocab(n_mers)
+
+    # First pass: number of reads and the widths of the string columns
+    n_reads, widths, columns = 0, {}, None
+    for chunk in read_chunks(csv_path, chunksize):
+        if columns is None:
+            columns = list(chunk.columns)
+            missing = [c for c in REQUIRED_COLUMNS if c not in columns]
+            if missing:
+                raise ValueError(f"{csv_path} is missing the column(s) {', '.join(missing)}")
+        n_reads += len(chunk)
+        for column in columns:
+            if column not in TOKEN_COLUMNS:
+                width = int(chunk[column].str.encode("utf-8").str.len().max())
+                widths[column] = max(widths.get(column, 1), width)
+    if columns is None:
+        raise ValueError(f"{csv_path} is empty")
+
+    def open_array(name, dtype, shape):
+        return np.lib.format.open_memmap(os.path.join(output_dir, name + ".npy"), mode="w+", dtype=dtype, shape=shape)
+
+    dna = open_array("dna_seq", np.int32, (n_reads, seq_len + 1))
+    methyl = open_array("methyl_seq", np.int8, (n_reads, seq_len + 1))
+    dmr_label = open_array("dmr_label", np.int32, (n_reads,))
+    ctype_label = open_array("ctype_label", np.int32, (n_reads,))
+    strings = {column: open_array(column, f"S{width}", (n_reads,)) for column, width in widths.items()}
+    weight = open_array("weight", np.float32, (n_reads,)) if WEIGHT_COLUMN in columns else None
+
+    # Second pass: tokenize and fill the arrays
+    start = 0
+    for chunk in read_chunks(csv_path, chunksize):
+        rows = slice(start, start + len(chunk))
+        dna[rows], methyl[rows] = tokenize(chunk["dna_seq"].tolist(), chunk["methyl_seq"].tolist(), vocab, seq_len)
+        dmr_label[rows] = chunk["dmr_label"].astype(np.int32).to_numpy()
+        ctype_label[rows] = (chunk["ctype"] == chunk["dmr_ctype"]).to_numpy()
+        for column, array in strings.items():
+            array[rows] = chunk[column].str.encode("utf-8").to_numpy(dtype=array.dtype)
+        if weight is not None:
+            weight[rows] = read_weights(chunk[WEIGHT_COLUMN])
+        start = rows.stop
+
+    for array in [dna, methyl, dmr_label, ctype_label, *strings.values()] + ([weight] if weight is not None else []):
+        array.flush()
+    meta = {
+        "version": FORMAT_VERSION,
+        "n_reads": n_reads,
+        "seq_len": seq_len,
+        "n_mers": n_mers,
+        "columns": columns,
+        "string_columns": list(widths),
+        "weighted": weight is not None,
+        "dmr_labels": sorted(int(l) for l in np.unique(dmr_label)),
+        "source": source_stamp(csv_path),
+    }
+    # meta.json is written last, so an interrupted conversion is never used
+    with open(os.path.join(output_dir, META_FILE), "w") as f:
+        json.dump(meta, f, indent=1)
+    print(f"Converted {n_reads} reads from {csv_path} to {output_dir}")
+    return output_dir
+
+class MemmapFinetuneDataset(Dataset):
+    """
+    Drop-in replacement for MethylBertFinetuneDataset reading the output of convert_finetune_csv.
+    The arrays are opened lazily in every process, so the dataset can be sent to DataLoader workers cheaply.
+    """
+
+    def __init__(self, path, vocab=None):
+        self.path = path
+        with open(os.path.join(path, META_FILE)) as f:
+            self.meta = json.load(f)
+        self.seq_len = self.meta["seq_len"]
+        self.vocab = vocab if vocab is not None else MethylVocab(self.meta["n_mers"])
+        self.headers = self.meta["columns"]
+        self.set_dmr_labels = set(self.meta["dmr_labels"])
+        self.weighted = self.meta["weighted"]
+        self._arrays = None
+        # For collapsed reads, the number of reads they stand for
+        self.ctype_label_count = np.bincount(self.arrays["ctype_label"], weights=self.weights)
+        print("Total number of sequences : ", len(self))
+        if self.weighted:
+            print("Total weight of the sequences : ", self.weights.sum())
+        print("# of reads in each label: ", self.ctype_label_count)
+
+    @property
+    def arrays(self):
+        if self._arrays is None:
+            names = ["dna_seq", "methyl_seq", "dmr_label", "ctype_label"] + self.meta["string_columns"]
+            names += ["weight"] if self.weighted else []
+            self._arrays = {name: np.load(os.path.join(self.path, name + ".npy"), mmap_mode="r") for name in names}
+        return self._arrays
+
+    @property
+    def weights(self):
+        """Weight of every read (all 1 without an XC column)."""
+        if self.weighted:
+            return self.arrays["weight"]
+        return np.ones(len(self), dtype=np.float32)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_arrays"] = None
+        return state
+
+    def __len__(self):
+        return self.meta["n_reads"]
+
+    def num_dmrs(self):
+        return max(len(self.set_dmr_labels), max(self.set_dmr_labels) + 1)  # +1 is for the label 0
+
+    def __getitem__(self, index):
+        arrays = self.arrays
+        item = {column: arrays[column][index].decode("utf-8") for column in self.meta["string_columns"]}
+        # int64 like the tensors of MethylBertFinetuneDataset; only this row is copied out of the mapping
+        item["dna_seq"] = torch.tensor(arrays["dna_seq"][index], dtype=torch.int64)
+        item["methyl_seq"] = torch.tensor(arrays["methyl_seq"][index], dtype=torch.int64)
+        item["dmr_label"] = int(arrays["dmr_label"][index])
+        item["ctype_label"] = int(arrays["ctype_label"][index])
+        return item
+
+def is_current(csv_path, output_dir, seq_len, n_mers):
+    """Whether output_dir holds a complete conversion of the current csv_path with the same settings."""
+    try:
+        with open(os.path.join(output_dir, META_FILE)) as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        return False
+    return (meta.get("version") == FORMAT_VERSION and meta["source"] == source_stamp(csv_path)
+            and meta["seq_len"] == seq_len and meta["n_mers"] == n_mers)
+
+def memmap_finetune_dataset(csv_path, vocab, seq_len):
+    """
+    MemmapFinetuneDataset for a finetune_data_generate CSV, converting it first if the conversion is missing or outdated.
+    Can be used instead of MethylBertFinetuneDataset(csv_path, vocab, seq_len=seq_len).
+    """
+    output_dir = csv_path + ".mm"
+    if not is_current(csv_path, output_dir, seq_len, vocab.kmers):
+        convert_finetune_csv(csv_path, output_dir, seq_len, vocab.kmers)
+    return MemmapFinetuneDataset(output_dir, vocab)
+
+class RepeatSampler(Sampler):
+    """
+    Deterministic sampler that yields every read index as often as its (integer) weight, in order.
+    For evaluation data, where the result should be exactly that of the uncollapsed reads.
+    """
+
+    def __init__(self, weights):
+        self.indices = np.repeat(np.arange(len(weights)), np.rint(weights).astype(np.int64))
+
+    def __iter__(self):
+        return iter(self.indices.tolist())
+
+    def __len__(self):
+        return len(self.indices)
+
+def weighted_sampler(dataset, shuffle=True, num_samples=None):
+    """
+    Sampler drawing the reads of a dataset in proportion to their weight.
+
+    Parameters:
+    dataset (MemmapFinetuneDataset): The dataset.
+    shuffle (bool): Random draws with replacement (for training), or every read repeated by its weight in order
+                    (RepeatSampler, for evaluation).
+    num_samples (int): Number of draws per epoch with shuffle (default: the number of reads in the dataset).
+
+    Returns:
+    torch.utils.data.Sampler: Use as DataLoader(dataset, sampler=...) instead of shuffle. For a dataset without
+                              weights, the sampler of DataLoader(dataset, shuffle=shuffle).
+    """
+    if not dataset.weighted:
+        return RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+    if not shuffle:
+        return RepeatSampler(dataset.weights)
+    # Drawn from the global torch RNG, like the shuffling of the DataLoader
+    return WeightedRandomSampler(torch.from_numpy(np.asarray(dataset.weights, dtype=np.float64)),
+                                 num_samples or len(dataset), replacement=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert finetune_data_generate CSV files into the memory-mapped dataset format.")
+    parser.add_argument("csv_files", nargs="+", help="train_seq.csv, test_seq.csv or data.csv files")
+    parser.add_argument("--seq-len", type=int, default=100, help="Length of the processed sequences (default: 100)")
+    parser.add_argument("--n-mers", type=int, default=3, help="k of the k-mer tokens (default: 3)")
+    args = parser.parse_args()
+
+    for csv_path in args.csv_files:
+        convert_finetune_csv(csv_path, seq_len=args.seq_len, n_mers=args.n_mers)
+
+if __name__ == "__main__":
+    main()
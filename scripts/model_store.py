@@ -0,0 +1,99 @@
+''' Local, version-pinned store for the pretrained MethylBERT encoders (hanyangii/methylbert_hg19_<n>l).
+
+fetch downloads a model once and pins the revision (commit hash) in models.json of the store, so the
+scripts load the pretrained model from disk and work offline. Fetching again keeps the pinned revision
+unless --update or --revision is given.
+
+python model_store.py fetch --layers 2 4
+python model_store.py list
+'''
+
+import argparse
+import json
+import os
+
+MODEL_STORE = "../data/models"
+LOCK_FILE = "models.json"
+N_LAYERS = (2, 4, 6, 8, 12)
+
+def repo_id(n_layers):
+    if n_layers not in N_LAYERS:
+        raise ValueError(f"There is no pretrained model with {n_layers} encoder blocks (available: {', '.join(map(str, N_LAYERS))})")
+    return f"hanyangii/methylbert_hg19_{n_layers}l"
+
+def read_lock(store=MODEL_STORE):
+    path = os.path.join(store, LOCK_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def write_lock(lock, store=MODEL_STORE):
+    tmp_file = os.path.join(store, LOCK_FILE + ".tmp")
+    with open(tmp_file, "w") as f:
+        json.dump(lock, f, indent=1, sort_keys=True)
+    os.replace(tmp_file, os.path.join(store, LOCK_FILE))
+
+def fetch_model(n_layers, store=MODEL_STORE, revision=None, update=False):
+    """
+    Download a pretrained model into the store and pin its revision.
+
+    Parameters:
+    n_layers (int): Number of encoder blocks (2, 4, 6, 8 or 12).
+    store (str): Directory of the model store.
+    revision (str): Branch, tag or commit to download (default: the pinned one, or main).
+    update (bool): Resolve the revision again instead of keeping the pinned one.
+
+    Returns:
+    str: Local directory of the model.
+    """
+    from huggingface_hub import HfApi, snapshot_download
+
+    os.makedirs(store, exist_ok=True)
+    repo = repo_id(n_layers)
+    lock = read_lock(store)
+    if revision is None and not update and repo in lock:
+        revision = lock[repo]["revision"]
+    # Resolve branches and tags to the commit hash, which is what gets pinned
+    sha = HfApi().model_info(repo, revision=revision or "main").sha
+    local_dir = os.path.join(store, repo.split("/")[-1], sha)
+    snapshot_download(repo, revision=sha, local_dir=local_dir)
+
+    lock[repo] = {"revision": sha, "path": os.path.relpath(local_dir, store)}
+    write_lock(lock, store)
+    print(f"{repo}@{sha} stored in {local_dir}")
+    return local_dir
+
+def pretrained_model(n_layers=2, store=MODEL_STORE):
+    """
+    Local directory of a pinned pretrained model, to use with trainer.load instead of the hub name.
+    Does not access the network.
+    """
+    repo = repo_id(n_layers)
+    entry = read_lock(store).get(repo)
+    if entry is None or not os.path.isdir(os.path.join(store, entry["path"])):
+        raise FileNotFoundError(f"{repo} is not in the model store {store}, run: python model_store.py fetch --layers {n_layers}")
+    return os.path.join(store, entry["path"])
+
+def main():
+    parser = argparse.ArgumentParser(description="Local, version-pinned store for the pretrained MethylBERT models.")
+    parser.add_argument("--store", default=MODEL_STORE, help=f"Model store directory (default: {MODEL_STORE})")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    fetch = subparsers.add_parser("fetch", help="Download and pin pretrained models")
+    fetch.add_argument("--layers", type=int, nargs="+", default=[2], help="Numbers of encoder blocks (default: 2)")
+    fetch.add_argument("--revision", default=None, help="Branch, tag or commit to pin (default: keep the pinned one, or main)")
+    fetch.add_argument("--update", action="store_true", help="Pin the latest revision instead of the pinned one")
+
+    subparsers.add_parser("list", help="List the models in the store")
+    args = parser.parse_args()
+
+    if args.command == "fetch":
+        for n_layers in args.layers:
+            fetch_model(n_layers, args.store, args.revision, args.update)
+    else:
+        for repo, entry in sorted(read_lock(args.store).items()):
+            print(f"{repo}\t{entry['revision']}\t{os.path.join(args.store, entry['path'])}")
+
+if __name__ == "__main__":
+    main()
@@ -1,91 +1,151 @@
-''' this created a bam file using the pat files'''
+''' this created a bam file using the pat files (.pat or .pat.gz). Output is BAM if the file ends with .bam, otherwise SAM.
 
+With --collapse, every PAT line gives one representative read instead of cnt copies, and the count is
+stored in the XC:i tag. finetune_data_generate keeps the tag as the XC column of train_seq.csv, which
+memmap_dataset.py uses as the read weight.'''
 
-import argparse, pickle, random
+
+import argparse, gzip, time
+from collections import OrderedDict
+import numpy as np
 import pysam
-from Bio import SeqIO
+
+from cpg_index import CpGIndex
 
 READ_LEN = 100
 OFFSET_WINDOW = 20  # random ±bp around first CpG
 
-def load_cpg_sites(pkl): return pickle.load(open(pkl,'rb'))
-def load_fasta(fa):
-    return {r.id: str(r.seq) for r in SeqIO.parse(fa, "fasta")}
+REF_WINDOW = 1_000_000  # bp fetched from the reference at once
+REF_CACHE_WINDOWS = 4
+
+class ReferenceWindows:
+    '''Random access to a faidx-indexed FASTA (the .fai is created if missing),
+    keeping the most recently used windows of each chromosome in an LRU cache.'''
+    def __init__(self, fa, window=REF_WINDOW, max_windows=REF_CACHE_WINDOWS):
+        self.fasta = pysam.FastaFile(fa)
+        self.lengths = dict(zip(self.fasta.references, self.fasta.lengths))
+        self.window, self.max_windows = window, max_windows
+        self.cache = {}  # chrom -> OrderedDict(window number -> sequence)
+
+    def __contains__(self, ch): return ch in self.lengths
+
+    def _window(self, ch, w):
+        windows = self.cache.setdefault(ch, OrderedDict())
+        if w in windows:
+            windows.move_to_end(w)
+        else:
+            windows[w] = self.fasta.fetch(ch, w*self.window, min((w+1)*self.window, self.lengths[ch]))
+            if len(windows) > self.max_windows: windows.popitem(last=False)
+        return windows[w]
+
+    def fetch(self, ch, start, end):
+        W = self.window
+        return ''.join(self._window(ch, w)[max(start-w*W, 0):end-w*W]
+                       for w in range(start//W, (end-1)//W + 1))
+
+def open_pat(pat):
+    return gzip.open(pat,'rt') if pat.endswith('.gz') else open(pat)
 
 def revcomp(s):
     return s.translate(str.maketrans("ACGT","TGCA"))[::-1]
 
-def context_label(seq, i):
-    c = seq[i].upper()
-    if c!='C': return None
-    nxt = seq[i+1:i+3].upper()
-    if len(nxt)<2: return None
-    if nxt[0]=='G': return 'CpG'
-    if nxt[1]=='G': return 'CHG'
-    return 'CHH'
-
-def build_xm(seq, cpg_pos_set, cpg_call_map):
-    xm=[]
-    for i,base in enumerate(seq):
-        if base.upper()!='C':
-            xm.append('.'); continue
-        ctx=context_label(seq, i)
-        if ctx=='CpG' and i in cpg_pos_set:
-            xm.append('Z' if cpg_call_map[i] else 'z')
-        elif ctx=='CHG':
-            xm.append('H' if random.random()<0.15 else 'h')
-        elif ctx=='CHH':
-            xm.append('X' if random.random()<0.05 else 'x')
-        else:
-            xm.append('.')
-    return ''.join(xm)
+# cytosine contexts
+NON_C, CPG, CHG, CHH = 0, 1, 2, 3
+CHG_METHYL_RATE = 0.15
+CHH_METHYL_RATE = 0.05
+XM_DOT, XM_Z, XM_z = ord('.'), ord('Z'), ord('z')
+COUNT_TAG = "XC"  # multiplicity of a collapsed read
 
-def pat_to_sam(pat, cpg_pkl, fa, out):
-    cpg=load_cpg_sites(cpg_pkl); fa=load_fasta(fa)
-    header={'HD':{'VN':'1.6'},'SQ':[{'SN':c,'LN':len(fa[c])} for c in fa]}
+def context_codes(seq):
+    '''Cytosine context code of every base of seq. The last two bases have no full context (NON_C).'''
+    b = np.frombuffer(seq.upper().encode(), dtype=np.uint8)
+    ctx = np.full(len(b), NON_C, dtype=np.uint8)
+    if len(b) < 3: return ctx
+    is_c = b[:-2] == ord('C')
+    ctx[:-2][is_c] = CHH
+    ctx[:-2][is_c & (b[2:] == ord('G'))] = CHG
+    ctx[:-2][is_c & (b[1:-1] == ord('G'))] = CPG
+    return ctx
+
+def synthesize_reads(fa, ch, pos_arr, calls, cnt, rng):
+    '''Generate up to cnt reads for one PAT row.
+
+    The window covering all possible read starts is fetched and labelled once; the start
+    offsets and the CHG/CHH calls of all copies come from a single RNG draw.
+    Yields (start, sequence, XM string) for reads that contain at least one CpG call.'''
+    u = rng.random((cnt, READ_LEN+1))  # column 0: start offset, the rest: non-CpG calls
+    starts = pos_arr[0] - (u[:,0]*(OFFSET_WINDOW+1)).astype(np.int64)
+    keep = (starts>=0) & (starts+READ_LEN<=fa.lengths[ch])
+    starts, u = starts[keep], u[keep,1:]
+    if not len(starts): return
+
+    span_start = int(starts.min())
+    span = fa.fetch(ch, span_start, int(starts.max())+READ_LEN)
+    ctx = context_codes(span)
+    cpg_xm = np.full(len(span), XM_DOT, dtype=np.uint8)
+    rel = pos_arr - span_start
+    inside = (rel>=0) & (rel<len(span))
+    cpg_xm[rel[inside]] = np.where(calls[inside], XM_Z, XM_z)
+
+    cols = (starts-span_start)[:,None] + np.arange(READ_LEN)
+    c = ctx[cols]
+    c[:,-2:] = NON_C  # context is taken from the read only
+    xm = np.full(c.shape, XM_DOT, dtype=np.uint8)
+    m = c==CPG; xm[m] = cpg_xm[cols][m]
+    m = c==CHG; xm[m] = np.where(u[m]<CHG_METHYL_RATE, ord('H'), ord('h'))
+    m = c==CHH; xm[m] = np.where(u[m]<CHH_METHYL_RATE, ord('X'), ord('x'))
+
+    has_cpg = ((xm==XM_Z) | (xm==XM_z)).any(axis=1)
+    for start, row in zip(starts[has_cpg].tolist(), xm[has_cpg]):
+        off = start-span_start
+        yield start, span[off:off+READ_LEN], row.tobytes().decode()
+
+def pat_to_sam(pat, cpg_index, fa, out, seed=None, collapse=False):
+    cpg=CpGIndex(cpg_index); fa=ReferenceWindows(fa)
+    rng=np.random.default_rng(seed)
+    header={'HD':{'VN':'1.6'},'SQ':[{'SN':c,'LN':l} for c,l in fa.lengths.items()]}
+    quals=pysam.qualitystring_to_array("I"*READ_LEN)
     readn=0
-    with pysam.AlignmentFile(out, "w", header=header) as outf:
-        for ln in open(pat):
+    t0=time.perf_counter()
+    mode = "wb" if out.endswith(".bam") else "w"  # BGZF-compressed BAM or plain SAM
+    with pysam.AlignmentFile(out, mode, header=header) as outf, open_pat(pat) as patf:
+        for ln in patf:
             if ln.startswith('#') or not ln.strip(): continue
             ch, idx, mp, cnt = ln.split()[:4]
             idx, cnt = int(idx), int(cnt)
             if ch not in cpg or ch not in fa: continue
-            if idx+len(mp)>len(cpg[ch]): continue
+            if idx+len(mp)>cpg.count(ch): continue
 
             # get genomic positions and map calls
-            pos_list = [cpg[ch][idx+i] for i in range(len(mp))]
-            call_map = {pos: (mp[i]=='C') for i,pos in enumerate(pos_list)}
-
-            for _ in range(cnt):
-                # choose offset
-                start = pos_list[0] - random.randint(0, OFFSET_WINDOW)
-                if start<0 or start+READ_LEN>len(fa[ch]): continue
-                seq = fa[ch][start:start+READ_LEN]
-
-                # build XM using positions relative to read
-                cpg_positions = {pos-start for pos in pos_list if start <= pos < start+READ_LEN}
-                xm = build_xm(seq, cpg_positions, {p-start:call_map[p] for p in pos_list})
-                if xm.count('Z')+xm.count('z')==0: continue
+            pos_arr = cpg.positions(ch)[idx:idx+len(mp)].astype(np.int64)
+            calls = np.frombuffer(mp.encode(), dtype=np.uint8) == ord('C')
+            tid = outf.get_tid(ch)
 
+            for start, seq, xm in synthesize_reads(fa, ch, pos_arr, calls, 1 if collapse else cnt, rng):
                 readn +=1
                 a=pysam.AlignedSegment()
                 a.query_name=f"r{readn}"
-                a.flag=0; a.reference_id=outf.get_tid(ch)
+                a.flag=0; a.reference_id=tid
                 a.reference_start=start; a.mapping_quality=60
                 a.cigarstring=f"{READ_LEN}M"
                 a.query_sequence=seq
-                a.query_qualities=pysam.qualitystring_to_array("I"*READ_LEN)
+                a.query_qualities=quals
                 a.set_tag("XM", xm, value_type='Z')
                 a.set_tag("XR", "CT", value_type='Z')
                 a.set_tag("XG", "CT", value_type='Z')
+                if collapse: a.set_tag(COUNT_TAG, cnt, value_type='i')
                 outf.write(a)
-    print(f"Generated {readn} reads → {out}")
+    elapsed=time.perf_counter()-t0
+    print(f"Generated {readn} reads → {out} ({readn/max(elapsed,1e-9):.0f} reads/s)")
+    return readn
 
 if __name__ == "__main__":
     p=argparse.ArgumentParser()
     p.add_argument("pat")
-    p.add_argument("cpg_pkl")
+    p.add_argument("cpg_index")
     p.add_argument("ref_fa")
     p.add_argument("-o","--out",required=True)
+    p.add_argument("--seed",type=int,default=None,help="random seed, same seed gives the same reads")
+    p.add_argument("--collapse",action="store_true",help="one read per PAT line, with the count in the XC tag")
     args=p.parse_args()
-    pat_to_sam(args.pat, args.cpg_pkl, args.ref_fa, args.out)
+    pat_to_sam(args.pat, args.cpg_index, args.ref_fa, args.out, args.seed, args.collapse)
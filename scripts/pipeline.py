@@ -0,0 +1,211 @@
+''' Small DAG pipeline runner with stage-level caching.
+
+Every Stage declares its input and output files (or directories). A stage depends on the stages that
+produce its inputs, and is skipped when all its outputs exist and are newer than all its inputs.
+Independent stages run concurrently, each in its own process, and the run report (JSON) records the
+status, wall time, peak RSS and output sizes of every stage, and the metrics the stage recorded with
+instrumentation.py (CPU time, batch latencies, reads/s). Optionally the metrics also go to a Prometheus
+textfile and every stage is profiled (profile_dir/<stage>.prof).
+
+pipeline = Pipeline([Stage("data", make_data, inputs=["in.txt"], outputs=["data.csv"]),
+                     Stage("train", train, inputs=["data.csv"], outputs=["model/config.json"])],
+                    report="run_report.json", jobs=2)
+pipeline.run()
+'''
+
+import contextlib
+import json
+import multiprocessing as mp
+import os
+import resource
+import sys
+import time
+import traceback
+from multiprocessing.connection import wait
+
+import instrumentation
+
+def path_mtime(path):
+    """Modification time of a file, or of the newest file in a directory."""
+    if not os.path.isdir(path):
+        return os.path.getmtime(path)
+    mtimes = [os.path.getmtime(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files]
+    return max(mtimes, default=os.path.getmtime(path))
+
+def path_size(path):
+    """Size of a file, or the total size of a directory, in bytes (None if missing)."""
+    if not os.path.exists(path):
+        return None
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+
+class Stage:
+    """
+    One step of a pipeline.
+
+    Parameters:
+    name (str): Name of the stage in the log and report.
+    func (callable): Function running the stage, called as func(*args, **kwargs) in a separate process.
+    inputs (list): Files or directories the stage reads.
+    outputs (list): Files or directories the stage writes.
+    after (list): Names of stages that have to finish first, in addition to the producers of the inputs.
+    """
+
+    def __init__(self, name, func, inputs=(), outputs=(), args=(), kwargs=None, after=()):
+        self.name = name
+        self.func = func
+        self.inputs = [os.path.normpath(p) for p in inputs]
+        self.outputs = [os.path.normpath(p) for p in outputs]
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.after = list(after)
+
+    def up_to_date(self):
+        """Whether all outputs exist and are newer than all inputs."""
+        if not self.outputs or not all(os.path.exists(p) for p in self.outputs):
+            return False
+        newest_input = max((path_mtime(p) for p in self.inputs), default=0)
+        return min(path_mtime(p) for p in self.outputs) >= newest_input
+
+def run_stage(stage, conn, profile_dir=None):
+    """Run a stage in the current (child) process and send the timing, memory and instrumentation statistics back."""
+    start = time.time()
+    # Only the metrics of this stage, not those inherited from the parent
+    instrumentation.METRICS.reset()
+    profile = os.path.join(profile_dir, f"{stage.name}.prof") if profile_dir else None
+    try:
+        with instrumentation.profiled(profile) if profile else contextlib.nullcontext(), instrumentation.stage(stage.name):
+            stage.func(*stage.args, **stage.kwargs)
+        error = None
+    except BaseException:
+        error = traceback.format_exc()
+    # ru_maxrss is in KiB on Linux; worker processes of the stage count as children
+    peak_self = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    peak_children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    conn.send({"wall_time_s": time.time() - start, "peak_rss_mb": round(peak_self, 1),
+               "peak_rss_children_mb": round(peak_children, 1), "metrics": instrumentation.METRICS.report(), "error": error})
+    conn.close()
+
+class Pipeline:
+    """
+    Runs stages in dependency order.
+
+    Parameters:
+    stages (list): The Stage objects.
+    report (str): Path of the JSON run report (None for no report).
+    jobs (int): Maximum number of stages running at the same time.
+    prometheus (str): Prometheus textfile with the metrics of the stages (None for none).
+    profile_dir (str): Directory for a cProfile dump of every stage (None: no profiling).
+    """
+
+    def __init__(self, stages, report=None, jobs=1, prometheus=None, profile_dir=None):
+        self.stages = {stage.name: stage for stage in stages}
+        self.report = report
+        self.jobs = jobs
+        self.prometheus = prometheus
+        self.profile_dir = profile_dir
+        self.deps = self._dependencies()
+
+    def _dependencies(self):
+        producers = {}
+        for stage in self.stages.values():
+            for output in stage.outputs:
+                producers[output] = stage.name
+        deps = {}
+        for stage in self.stages.values():
+            deps[stage.name] = {producers[p] for p in stage.inputs if p in producers} | set(stage.after)
+            unknown = deps[stage.name] - set(self.stages)
+            if unknown:
+                raise ValueError(f"Stage {stage.name} runs after unknown stage(s) {', '.join(sorted(unknown))}")
+
+        # Check for cycles
+        visited, active = set(), set()
+        def visit(name):
+            if name in active:
+                raise ValueError(f"Cycle in the pipeline at stage {name}")
+            if name not in visited:
+                active.add(name)
+                for dep in deps[name]:
+                    visit(dep)
+                active.remove(name)
+                visited.add(name)
+        for name in self.stages:
+            visit(name)
+        return deps
+
+    def run(self, force=False):
+        """
+        Run all stages that are not up to date (all stages with force=True).
+
+        Returns:
+        dict: The run report. Stage status is one of done, skipped (up to date), failed or blocked (a dependency failed).
+        """
+        results = {}
+        pending = list(self.stages)
+        running = {}
+        start = time.time()
+
+        while pending or running:
+            # Start every stage whose dependencies are finished
+            for name in list(pending):
+                if len(running) >= self.jobs:
+                    break
+                deps = self.deps[name]
+                if any(results.get(d, {}).get("status") in ("failed", "blocked") for d in deps):
+                    results[name] = {"status": "blocked"}
+                    pending.remove(name)
+                    print(f"[{name}] blocked by a failed stage")
+                    continue
+                if not all(d in results for d in deps):
+                    continue
+                pending.remove(name)
+                stage = self.stages[name]
+                missing = [p for p in stage.inputs if not os.path.exists(p)]
+                if missing:
+                    results[name] = {"status": "failed", "error": f"Missing input(s): {', '.join(missing)}"}
+                    print(f"[{name}] failed: missing input(s) {', '.join(missing)}", file=sys.stderr)
+                elif not force and stage.up_to_date():
+                    results[name] = {"status": "skipped"}
+                    print(f"[{name}] up to date, skipped")
+                else:
+                    print(f"[{name}] started")
+                    parent_conn, child_conn = mp.Pipe(duplex=False)
+                    process = mp.Process(target=run_stage, args=(stage, child_conn, self.profile_dir), name=name)
+                    process.start()
+                    child_conn.close()
+                    running[process.sentinel] = (name, process, parent_conn)
+
+            if not running:
+                if pending and not any(all(d in results for d in self.deps[n]) for n in pending):
+                    raise RuntimeError("Pipeline is stuck, no stage can be started")
+                continue
+
+            # Wait for the next stage to finish
+            for sentinel in wait(list(running)):
+                name, process, conn = running.pop(sentinel)
+                stats = conn.recv() if conn.poll() else {"error": f"Process exited with code {process.exitcode}"}
+                process.join()
+                error = stats.pop("error")
+                results[name] = {"status": "failed" if error else "done", **stats}
+                if error:
+                    results[name]["error"] = error
+                    print(f"[{name}] failed:\n{error}", file=sys.stderr)
+                else:
+                    print(f"[{name}] done in {stats['wall_time_s']:.1f}s, peak RSS {stats['peak_rss_mb']:.0f} MB")
+
+        report = {
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(start)),
+            "wall_time_s": time.time() - start,
+            "stages": [{"name": name, **results[name],
+                        "outputs": {p: path_size(p) for p in self.stages[name].outputs}}
+                       for name in self.stages],
+        }
+        if self.report:
+            os.makedirs(os.path.dirname(self.report) or ".", exist_ok=True)
+            with open(self.report, "w") as f:
+                json.dump(report, f, indent=1)
+        if self.prometheus:
+            instrumentation.write_prometheus({stage["name"]: stage["metrics"] for stage in report["stages"] if "metrics" in stage},
+                                             self.prometheus, job="pipeline")
+        return report
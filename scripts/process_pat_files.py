@@ -0,0 +1,107 @@
+''' Converts all .pat.gz files in a directory to BAM files in parallel using pat_to_sam.
+
+The PAT files are read directly (no unzipped copy) and the BAM is written directly (no intermediate SAM).
+Every BAM is first written to a temporary file in the output directory and renamed when complete,
+so an interrupted run never leaves a truncated BAM behind. Existing BAM files are skipped.
+With --collapse, the BAMs hold one read per PAT line with the count in the XC tag (see pat_to_sam.py).
+'''
+
+import argparse
+import os
+import sys
+import zlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pysam
+
+from pat_to_sam import pat_to_sam
+
+REFERENCE = "../data/reference/hg38.fa"
+CPG_SITES = "../data/reference/cpg_sites"
+
+def convert_pat_file(pat_gz_file, bam_file, cpg_index, reference, seed=None, collapse=False):
+    """
+    Convert one PAT file into a BAM file atomically.
+
+    Parameters:
+    pat_gz_file (str): The path to the .pat.gz file.
+    bam_file (str): The path of the final BAM file.
+    cpg_index (str): The path to the CpG index directory.
+    reference (str): The path to the reference FASTA.
+    seed: Random seed passed to pat_to_sam (None for a random one).
+    collapse (bool): Write one read per PAT line with its count in the XC tag.
+
+    Returns:
+    int: Number of generated reads.
+    """
+    out_dir, name = os.path.split(bam_file)
+    tmp_file = os.path.join(out_dir, f".{name}.{os.getpid()}.tmp.bam")
+    try:
+        n_reads = pat_to_sam(pat_gz_file, cpg_index, reference, tmp_file, seed, collapse)
+        os.replace(tmp_file, bam_file)
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+    return n_reads
+
+def process_pat_files(pat_dir, output_dir, cpg_index=CPG_SITES, reference=REFERENCE, jobs=1, seed=None, collapse=False):
+    """
+    Convert all .pat.gz files in pat_dir to BAM files in output_dir, skipping existing BAM files.
+    With a seed, every file gets its own seed derived from the seed and the file name,
+    so the output does not depend on which files are skipped.
+
+    Returns:
+    list: Base names of the PAT files that failed to convert.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+
+    # Index the reference once, so the workers do not race to create the .fai
+    if not os.path.exists(reference + ".fai"):
+        pysam.faidx(reference)
+
+    tasks = {}
+    for filename in sorted(os.listdir(pat_dir)):
+        if not filename.endswith(".pat.gz"):
+            continue
+        basename = filename[:-len(".pat.gz")]
+        bam_file = os.path.join(output_dir, basename + ".bam")
+        if os.path.isfile(bam_file):
+            print(f"Skipping {basename}: BAM already exists.")
+            continue
+        tasks[basename] = (os.path.join(pat_dir, filename), bam_file)
+
+    failed = []
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = {}
+        for basename, (pat_gz_file, bam_file) in tasks.items():
+            print(f"Processing {basename}...")
+            file_seed = None if seed is None else [seed, zlib.crc32(basename.encode())]
+            futures[pool.submit(convert_pat_file, pat_gz_file, bam_file, cpg_index, reference, file_seed, collapse)] = basename
+        for future in as_completed(futures):
+            basename = futures[future]
+            try:
+                future.result()
+                print(f"Finished {basename}.")
+            except Exception as e:
+                print(f"Failed {basename}: {e}", file=sys.stderr)
+                failed.append(basename)
+    return failed
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert all .pat.gz files of a directory to BAM files.")
+    parser.add_argument("pat_dir", help="Directory with .pat.gz files")
+    parser.add_argument("output_dir", help="Output directory for the BAM files")
+    parser.add_argument("--cpg-index", default=CPG_SITES, help=f"CpG index directory (default: {CPG_SITES})")
+    parser.add_argument("--reference", default=REFERENCE, help=f"Reference FASTA (default: {REFERENCE})")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="Number of parallel conversions (default: all cores)")
+    parser.add_argument("--seed", type=int, default=None, help="Random seed for reproducible reads")
+    parser.add_argument("--collapse", action="store_true", help="One read per PAT line, with the count in the XC tag")
+    args = parser.parse_args()
+
+    failed = process_pat_files(args.pat_dir, args.output_dir, args.cpg_index, args.reference, args.jobs, args.seed, args.collapse)
+    if failed:
+        sys.exit(f"{len(failed)} PAT file(s) failed: {', '.join(sorted(failed))}")
+
+if __name__ == "__main__":
+    main()
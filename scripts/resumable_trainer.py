@@ -0,0 +1,257 @@
+''' MethylBertFinetuneTrainer with periodic checkpoints and resume.
+
+Every checkpoint_freq steps the model (with dmr_encoder.pickle and read_classification_model.pickle),
+the optimizer, the learning rate scheduler and the position in the training data are saved to
+<save_path>/checkpoint/. train() continues from this checkpoint if there is one, so an interrupted
+run does not redo the finished steps. The checkpoint is replaced atomically, a crash while saving
+keeps the previous one, and it is removed when the training is complete. Delete the checkpoint
+directory by hand to start over with changed training data. The batch latencies (loading and compute),
+the reads/s and the time of the evaluations and checkpoints are recorded with instrumentation.py.
+
+trainer = ResumableFinetuneTrainer(len(tokenizer), save_path="tmp/fine_tune/", checkpoint_freq=500, ...)
+trainer.load(pretrained_model(2))
+trainer.train(steps=10000)
+'''
+
+import os
+import shutil
+import time
+
+import numpy as np
+import torch
+from torch import nn
+from torch.cuda.amp import GradScaler
+from tqdm import tqdm
+
+from methylbert.trainer import MethylBertFinetuneTrainer, learning_rate_scheduler
+
+from instrumentation import batches, observe, timer
+
+CHECKPOINT_DIR = "checkpoint"
+TRAINER_STATE = "trainer_state.pt"
+
+def truncate_log(path, step):
+    """Remove the lines of step >= step from a train.csv / eval.csv log, they are written again after the resume."""
+    if not os.path.exists(path):
+        return
+    with open(path) as f:
+        header, *lines = f.readlines()
+    with open(path, "w") as f:
+        f.write(header)
+        f.writelines(line for line in lines if int(line.split("\t")[0]) < step)
+
+class ResumableFinetuneTrainer(MethylBertFinetuneTrainer):
+    """
+    Takes the arguments of MethylBertFinetuneTrainer and:
+
+    checkpoint_freq (int): Save a checkpoint every checkpoint_freq steps (None: no checkpoints).
+    """
+
+    def __init__(self, *args, checkpoint_freq=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkpoint_freq = checkpoint_freq
+        self.checkpoint_path = os.path.join(self.save_path, CHECKPOINT_DIR)
+
+    def _latest_checkpoint(self):
+        # A crash between the two renames in save_checkpoint leaves only the previous checkpoint
+        for path in (self.checkpoint_path, self.checkpoint_path + ".old"):
+            if os.path.exists(os.path.join(path, TRAINER_STATE)):
+                return path
+        return None
+
+    def save_checkpoint(self, epoch, batch, epoch_rng_state, scaler=None):
+        tmp_path = self.checkpoint_path + ".tmp"
+        old_path = self.checkpoint_path + ".old"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+        # The trailing separator keeps the pickles inside the checkpoint directory
+        self.save(tmp_path + os.sep)
+        torch.save({
+            "step": self.step,
+            "epoch": epoch,
+            "batch": batch,
+            "epoch_rng_state": epoch_rng_state,
+            "min_loss": self.min_loss,
+            "optimizer": self.optim.state_dict(),
+            "scheduler": self.scheduler.state_dict(),
+            "scaler": scaler.state_dict() if scaler is not None else None,
+        }, os.path.join(tmp_path, TRAINER_STATE))
+
+        shutil.rmtree(old_path, ignore_errors=True)
+        if os.path.exists(self.checkpoint_path):
+            os.rename(self.checkpoint_path, old_path)
+        os.rename(tmp_path, self.checkpoint_path)
+        shutil.rmtree(old_path, ignore_errors=True)
+
+    def restore_checkpoint(self):
+        """Load the model and the optimizer of the latest checkpoint. Returns the trainer state (None without checkpoint)."""
+        path = self._latest_checkpoint()
+        if path is None:
+            return None
+        self.load(path)
+        state = torch.load(os.path.join(path, TRAINER_STATE), map_location="cpu", weights_only=False)
+        self.optim.load_state_dict(state["optimizer"])
+        print(f"Resume from the checkpoint at step {state['step']}")
+        return state
+
+    def train(self, steps: int = 0, verbose: int = 1, resume: bool = True):
+        '''
+        Train MethylBERT over given steps, continuing from the latest checkpoint if resume is set
+
+        steps: int
+            number of steps to train the model (in total, including the steps before the resume)
+        '''
+        state = self.restore_checkpoint() if resume else None
+        if state is not None and state["step"] >= steps:
+            print(f"The checkpoint is already at step {state['step']}, nothing to train")
+            return None
+        result = self._iteration(steps, self.train_data, verbose, state)
+        # The training is complete, a later run must not continue from it
+        for path in (self.checkpoint_path, self.checkpoint_path + ".old"):
+            shutil.rmtree(path, ignore_errors=True)
+        return result
+
+    def _iteration(self, steps, data_loader, verbose=1, state=None):
+        """
+        The training loop of MethylBertFinetuneTrainer, with checkpoints and resume from a trainer state.
+        """
+        if state is None:
+            self.step = 0
+            with open(self.f_train, "w") as f_perform:
+                f_perform.write("step\tloss\tctype_acc\tlr\n")
+            with open(self.f_eval, "w") as f_perform:
+                f_perform.write("step\tloss\tctype_acc\n")
+        else:
+            self.step = state["step"]
+            self.min_loss = state["min_loss"]
+            truncate_log(self.f_train, self.step)
+            truncate_log(self.f_eval, self.step)
+
+        # Set up a learning rate scheduler
+        self.scheduler = learning_rate_scheduler(self.optim,
+                                                 num_warmup_steps=self._config.warmup_step,
+                                                 num_training_steps=steps,
+                                                 decrease_steps=self._config.decrease_steps)
+        if state is not None:
+            self.scheduler.load_state_dict(state["scheduler"])
+
+        global_step_loss = 0
+        local_step = self.step
+        start_epoch = state["epoch"] if state is not None else 0
+        skip_batches = state["batch"] if state is not None else 0
+
+        epochs = steps // (len(data_loader) // self._config.gradient_accumulation_steps) + 1
+
+        self.model.zero_grad()
+        self.model.train()
+        train_prediction_res = {"dmr_label":[], "pred_ctype_label":[], "ctype_label":[]}
+
+        scaler = GradScaler() if self._config.amp else None
+        if scaler is not None and state is not None and state["scaler"] is not None:
+            scaler.load_state_dict(state["scaler"])
+
+        duration = 0
+        epoch_progress_bar = tqdm(total=epochs, initial=start_epoch, desc="Training...")
+        for epoch in range(start_epoch, epochs):
+            # The shuffling of the epoch is drawn from the torch RNG, restoring it gives the same batch order
+            if state is not None and epoch == start_epoch:
+                torch.set_rng_state(state["epoch_rng_state"])
+            epoch_rng_state = torch.get_rng_state()
+
+            steps_progress_bar = tqdm(total=min(steps, len(data_loader)), desc=f"Epoch {epoch+1}/{epochs}")
+            for i, batch in enumerate(batches(data_loader, "fine_tune.train")):
+                if epoch == start_epoch and i < skip_batches:
+                    steps_progress_bar.update()
+                    continue
+
+                data = {key: value.to(self.device) for key, value in batch.items() if type(value) != list}
+
+                start = time.time()
+                with torch.autocast(device_type="cuda" if self._config.with_cuda else "cpu",
+                                    enabled=self._config.amp):
+                    mask_lm_output = self.model.forward(step=self.step,
+                                            input_ids=data["dna_seq"],
+                                            token_type_ids=data["methyl_seq"],
+                                            labels=data["dmr_label"],
+                                            ctype_label=data["ctype_label"])
+
+                train_prediction_res["dmr_label"].append(data["dmr_label"].detach().cpu())
+                train_prediction_res["pred_ctype_label"].append(np.argmax(mask_lm_output["classification_logits"].cpu().detach(), axis=-1))
+                train_prediction_res["ctype_label"].append(data["ctype_label"].detach().cpu())
+
+                # Calculate loss and back-propagation
+                loss = mask_lm_output["loss"].mean() if "cuda" in self.device.type else mask_lm_output["loss"]
+                loss = loss/self._config.gradient_accumulation_steps
+                scaler.scale(loss).backward(retain_graph=True) if self._config.amp else loss.backward(retain_graph=True)
+
+                global_step_loss += loss.item()
+                duration += time.time() - start
+
+                # Gradient accumulation
+                optimizer_step = (local_step+1) % self._config.gradient_accumulation_steps == 0
+                if optimizer_step:
+                    if self._config.amp:
+                        scaler.unscale_(self.optim)
+                        nn.utils.clip_grad_norm_(self.model.parameters(), self._config.max_grad_norm)
+                        scaler.step(self.optim)
+                        scaler.update()
+                    else:
+                        nn.utils.clip_grad_norm_(self.model.parameters(), self._config.max_grad_norm)
+                        self.optim.step()
+
+                    self.scheduler.step()
+                    self.model.zero_grad()
+                # Forward, backward and optimizer step, without the evaluation
+                observe("fine_tune.step", time.time() - start)
+
+                if (local_step+1) % self._config.eval_freq == 0 or local_step == 0:
+                    with timer("fine_tune.eval"):
+                        eval_pred, eval_loss = self._eval_iteration(self.test_data)
+                    eval_acc = self._acc(eval_pred["pred_ctype_label"], eval_pred["ctype_label"])
+
+                    with open(self.f_eval, "a") as f_perform:
+                        f_perform.write("\t".join([str(self.step), str(eval_loss), str(eval_acc)]) +"\n")
+
+                    if self.step % self._config.log_freq == 0 and verbose > 0:
+                        print("\nTrain Step %d iter - loss : %f / lr : %f"%(self.step, global_step_loss, self.optim.param_groups[0]["lr"]))
+                        print(f"Running time for iter = {duration}")
+
+                    if self.min_loss > eval_loss:
+                        if verbose > 0:
+                            print("Step %d loss (%f) is lower than the current min loss (%f). Save the model at %s"%(self.step, eval_loss, self.min_loss, self.save_path))
+                        self.save(self.save_path)
+                        self.min_loss = eval_loss
+
+                    # For saving an interim model to track the training
+                    if (type(self._config.save_freq) == int) and (self.step % self._config.save_freq == 0):
+                        step_save_dir = self.save_path.replace("bert.model", "bert.model_step%d"%(self.step))
+                        os.makedirs(step_save_dir, exist_ok=True)
+                        self.save(step_save_dir)
+
+                    with open(self.f_train, "a") as f_perform:
+                        train_ctype_acc = self._acc(np.concatenate(train_prediction_res["pred_ctype_label"], axis=0),
+                                                    np.concatenate(train_prediction_res["ctype_label"], axis=0))
+                        f_perform.write("\t".join([str(self.step), str(global_step_loss), str(train_ctype_acc), str(self.optim.param_groups[0]["lr"])])+"\n")
+
+                    steps_progress_bar.set_postfix(eval_loss=eval_loss)
+                    train_prediction_res = {"dmr_label":[], "pred_ctype_label":[], "ctype_label":[]}
+
+                self.step += 1
+                duration = 0
+                global_step_loss = 0
+                steps_progress_bar.update()
+
+                # Checkpoints only right after an optimizer step, so no accumulated gradients are lost
+                if self.checkpoint_freq and optimizer_step and self.step % self.checkpoint_freq == 0:
+                    with timer("fine_tune.checkpoint"):
+                        self.save_checkpoint(epoch, i + 1, epoch_rng_state, scaler)
+
+                if steps == self.step:
+                    break
+                local_step += 1
+
+            steps_progress_bar.close()
+            epoch_progress_bar.update()
+
+            if steps == self.step:
+                break
@@ -0,0 +1,174 @@
+''' Sharded read classification of a deep bulk sample, with one merged deconvolution step.
+
+classify: splits the reads of data.csv (memory-mapped, see memmap_dataset.py) into shards and classifies
+them in a process pool. Every process loads its own copy of the model and uses a capped number of threads.
+The probabilities of every shard are written to the shard directory (shard_<start>_<stop>.npy), finished
+shards are skipped, so an interrupted run can be restarted. With --only a subset of the shards can be run,
+e.g. on another node with a copy of the data.csv.mm directory and the model; then copy the shard files back.
+
+merge: checks that the shards cover all reads, and runs the proportion estimation and Fisher information
+once on all probabilities (res.csv, deconvolution.csv and FI.csv as in fast_deconvolution.py).
+
+python sharded_classification.py classify tmp/data.csv --shards 32 --jobs 8 -o tmp/shards
+python sharded_classification.py merge tmp/data.csv -o tmp/shards --deconvolution tmp/deconvolution/
+'''
+
+import argparse
+import multiprocessing as mp
+import os
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from methylbert.data.vocab import MethylVocab
+
+import fast_deconvolution as fd
+
+SHARD_DIR = "tmp/shards/"
+SHARD_PATTERN = re.compile(r"shard_(\d+)_(\d+)\.npy$")
+
+# Model and dataset of a worker process, loaded once by init_worker
+worker_state = {}
+
+def shard_bounds(n_reads, n_shards):
+    """Row ranges (start, stop) of n_shards nearly equal shards."""
+    bounds = np.linspace(0, n_reads, n_shards + 1).astype(int)
+    return [(int(start), int(stop)) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+
+def shard_file(shard_dir, start, stop):
+    return os.path.join(shard_dir, f"shard_{start:012d}_{stop:012d}.npy")
+
+def init_worker(data_dir, model_dir, threads, quantize):
+    fd.set_threads(threads, 1)
+    worker_state["dataset"] = fd.MemmapFinetuneDataset(data_dir)
+    worker_state["model"] = fd.load_model(model_dir, worker_state["dataset"].seq_len, quantize)
+
+def classify_shard(start, stop, out_file, batch_size, bf16):
+    """Classify the reads start:stop in a worker and write the probabilities atomically."""
+    probs = fd.classify_reads(worker_state["model"], worker_state["dataset"], start, stop, batch_size, bf16)
+    tmp_file = f"{out_file}.{os.getpid()}.tmp.npy"
+    np.save(tmp_file, probs)
+    os.replace(tmp_file, out_file)
+    return stop - start
+
+def classify_shards(data_dir, model_dir, shard_dir, n_shards, only=None, jobs=1, threads=None,
+                    batch_size=fd.BATCH_SIZE, quantize=False, bf16=False):
+    """
+    Classify the reads of a converted dataset shard by shard in a process pool.
+
+    Parameters:
+    data_dir (str): Directory of the memory-mapped dataset (data.csv.mm).
+    model_dir (str): Fine-tuned model directory.
+    shard_dir (str): Output directory of the shard probabilities.
+    n_shards (int): Number of shards the reads are split into.
+    only (list): Indices of the shards to run (default: all).
+    jobs (int): Number of worker processes, each with its own model.
+    threads (int): Torch threads per worker (default: cores / jobs).
+    batch_size (int): Reads per batch.
+    quantize (bool): Dynamic int8 quantization of the model.
+    bf16 (bool): Run the model in bfloat16.
+
+    Returns:
+    list: Shards (start, stop) that failed.
+    """
+    os.makedirs(shard_dir, exist_ok=True)
+    dataset = fd.MemmapFinetuneDataset(data_dir)
+    shards = shard_bounds(len(dataset), n_shards)
+    if only is not None:
+        shards = [shards[i] for i in only]
+    todo = [(start, stop) for start, stop in shards if not os.path.exists(shard_file(shard_dir, start, stop))]
+    print(f"{len(shards) - len(todo)} of {len(shards)} shards already done, classifying {len(todo)} shards")
+    if not todo:
+        return []
+
+    threads = threads or max(1, (os.cpu_count() or 1) // jobs)
+    failed = []
+    # spawn: no torch thread pools are inherited from the parent process
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=mp.get_context("spawn"), initializer=init_worker,
+                             initargs=(data_dir, model_dir, threads, quantize)) as pool:
+        futures = {pool.submit(classify_shard, start, stop, shard_file(shard_dir, start, stop), batch_size, bf16): (start, stop)
+                   for start, stop in todo}
+        for future in as_completed(futures):
+            start, stop = futures[future]
+            try:
+                future.result()
+                print(f"Finished shard {start}-{stop}")
+            except Exception as e:
+                print(f"Failed shard {start}-{stop}: {e}", file=sys.stderr)
+                failed.append((start, stop))
+    return failed
+
+def merge_shards(dataset, shard_dir):
+    """
+    Concatenate the shard probabilities of a dataset.
+
+    Returns:
+    numpy.ndarray: Probabilities of all reads, in the order of the dataset.
+    """
+    shards = []
+    for name in os.listdir(shard_dir):
+        match = SHARD_PATTERN.match(name)
+        if match:
+            shards.append((int(match.group(1)), int(match.group(2)), os.path.join(shard_dir, name)))
+    shards.sort()
+
+    position = 0
+    for start, stop, _ in shards:
+        if start != position:
+            raise ValueError(f"Reads {position}-{start} are not covered by the shards in {shard_dir}")
+        position = stop
+    if position != len(dataset):
+        raise ValueError(f"The shards in {shard_dir} cover {position} reads, the dataset has {len(dataset)}")
+    return np.concatenate([np.load(path) for _, _, path in shards]) if shards else np.empty((0, 2), dtype=np.float32)
+
+def parse_only(value):
+    return [int(i) for i in value.split(",")] if value else None
+
+def main():
+    parser = argparse.ArgumentParser(description="Sharded multi-process read classification with a merged deconvolution.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    classify = subparsers.add_parser("classify", help="Classify the reads shard by shard")
+    classify.add_argument("data", help="data.csv (or .parquet) of the bulk sample, or its converted .mm directory")
+    classify.add_argument("--model", default=fd.MODEL_DIR, help=f"Fine-tuned model directory (default: {fd.MODEL_DIR})")
+    classify.add_argument("-o", "--shard-dir", default=SHARD_DIR, help=f"Directory of the shard probabilities (default: {SHARD_DIR})")
+    classify.add_argument("--shards", type=int, required=True, help="Number of shards")
+    classify.add_argument("--only", type=parse_only, default=None, help="Comma-separated shard indices to run (default: all)")
+    classify.add_argument("-j", "--jobs", type=int, default=1, help="Worker processes, each with its own model (default: 1)")
+    classify.add_argument("--threads", type=int, default=None, help="Torch threads per worker (default: cores / jobs)")
+    classify.add_argument("-b", "--batch-size", type=int, default=fd.BATCH_SIZE, help=f"Reads per batch (default: {fd.BATCH_SIZE})")
+    precision = classify.add_mutually_exclusive_group()
+    precision.add_argument("--quantize", action="store_true", help="Dynamic int8 quantization of the Linear layers")
+    precision.add_argument("--bf16", action="store_true", help="Run the model in bfloat16")
+
+    merge = subparsers.add_parser("merge", help="Merge the shards and run the deconvolution")
+    merge.add_argument("data", help="data.csv (or .parquet) of the bulk sample, or its converted .mm directory")
+    merge.add_argument("-o", "--shard-dir", default=SHARD_DIR, help=f"Directory of the shard probabilities (default: {SHARD_DIR})")
+    merge.add_argument("--train", default=fd.TRAIN_FILE, help=f"Training data (CSV or Parquet) for the cell-type margins (default: {fd.TRAIN_FILE})")
+    merge.add_argument("--deconvolution", default=fd.OUTPUT_DIR, help=f"Output directory (default: {fd.OUTPUT_DIR})")
+    merge.add_argument("--n-grid", type=int, default=10000, help="Grid size of the purity estimation (default: 10000)")
+    merge.add_argument("--adjustment", action="store_true", help="Run the estimation adjustment")
+    merge.add_argument("--res-format", choices=["csv", "parquet"], default="csv", help="Format of the read classification table (default: csv)")
+
+    for subparser in (classify, merge):
+        subparser.add_argument("--seq-len", type=int, default=100, help="Sequence length of the model (default: 100)")
+        subparser.add_argument("--n-mers", type=int, default=3, help="k of the k-mer tokens (default: 3)")
+    args = parser.parse_args()
+
+    dataset = fd.load_dataset(args.data, MethylVocab(args.n_mers), args.seq_len)
+    if args.command == "classify":
+        failed = classify_shards(dataset.path, args.model, args.shard_dir, args.shards, args.only, args.jobs,
+                                 args.threads, args.batch_size, args.quantize, args.bf16)
+        if failed:
+            sys.exit(f"{len(failed)} shard(s) failed")
+    else:
+        probs = merge_shards(dataset, args.shard_dir)
+        res = fd.read_results(dataset, probs)
+        fd.estimate_proportions(res, fd.read_train_ctypes(args.train), args.deconvolution,
+                                args.n_grid, args.adjustment, args.res_format)
+        print(f"Deconvolution results written to {args.deconvolution}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+''' Writes slim BAM files with only the reads overlapping the DMRs.
+
+finetune_data_generate only uses reads within the DMRs (dmr_filtered.csv), so the fine-tuning and bulk
+BAM files can be cut down to these reads once. The DMRs are merged into a sorted interval index (also
+written as regions.bed to the output directory), the reads of every merged region are fetched from the
+indexed BAM, and every read gets the XD:i tag with the row (0-based) of the first overlapping DMR in the
+DMR file. The BAM files are processed in parallel; the output is sorted and indexed, written to a temporary
+file first, and existing outputs are skipped. Unsorted input BAMs (e.g. from pat_to_sam.py) are sorted first.
+
+With --file-list, a copy of the list (e.g. fine_tune_data.txt) pointing to the slim BAM files is written,
+for cached_finetune_data_generate(sc_dataset=...).
+
+python slim_bams.py ../data/reference/dmr_filtered.csv -o ../data/bam_slim --file-list ../fine_tune_data.txt -j 8
+python slim_bams.py ../data/reference/dmr_filtered.csv -o ../data/bam_slim ../data/bam_for_classification/sorted_bulk_data.bam
+'''
+
+import argparse
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+import pysam
+
+DMR_TAG = "XD"  # row of the assigned DMR in the DMR file
+REGIONS_FILE = "regions.bed"
+
+class DMRIntervals:
+    """
+    Merged, sorted DMR intervals per chromosome, with the DMRs each merged region is made of.
+
+    Parameters:
+    f_dmr (str): Tab-separated DMR file with the columns chr, start and end (dmr_filtered.csv).
+    padding (int): Bases added on both sides of every DMR.
+    """
+
+    def __init__(self, f_dmr, padding=0):
+        dmrs = pd.read_csv(f_dmr, sep="\t", usecols=["chr", "start", "end"])
+        self.n_dmrs = len(dmrs)
+        dmrs["row"] = np.arange(len(dmrs))
+        dmrs["start"] = np.maximum(dmrs["start"] - padding, 0)
+        dmrs["end"] = dmrs["end"] + padding
+        dmrs["chr"] = dmrs["chr"].astype(str)
+
+        # chrom -> (region starts, region ends, [(DMR starts, DMR ends, DMR rows) of every region])
+        self.regions = {}
+        for chrom, group in dmrs.sort_values(["chr", "start", "end"], kind="stable").groupby("chr", sort=False):
+            starts, ends, rows = (group[c].to_numpy(dtype=np.int64) for c in ("start", "end", "row"))
+            # A DMR starts a new region if it starts after the end of all DMRs before it
+            new_region = np.empty(len(starts), dtype=bool)
+            new_region[0] = True
+            new_region[1:] = starts[1:] > np.maximum.accumulate(ends)[:-1]
+            bounds = np.append(np.flatnonzero(new_region), len(starts))
+            region_starts = starts[bounds[:-1]]
+            region_ends = np.maximum.reduceat(ends, bounds[:-1])
+            members = [(starts[a:b], ends[a:b], rows[a:b]) for a, b in zip(bounds[:-1], bounds[1:])]
+            self.regions[chrom] = (region_starts, region_ends, members)
+
+    def __len__(self):
+        return sum(len(starts) for starts, _, _ in self.regions.values())
+
+    def total_length(self):
+        return int(sum((ends - starts).sum() for starts, ends, _ in self.regions.values()))
+
+    def write_bed(self, path, chroms=None):
+        """Write the merged regions as BED (in the order of chroms, e.g. the BAM header, default: sorted)."""
+        with open(path, "w") as f:
+            for chrom in chroms or sorted(self.regions):
+                if chrom in self.regions:
+                    starts, ends, _ = self.regions[chrom]
+                    f.writelines(f"{chrom}\t{s}\t{e}\n" for s, e in zip(starts, ends))
+
+def assign_dmr(members, start, end, contained=False):
+    """Row of the first DMR (by start) of a region overlapping (or containing) the read start:end, None if there is none."""
+    dmr_starts, dmr_ends, rows = members
+    if contained:
+        hits = np.flatnonzero((dmr_starts <= start) & (dmr_ends >= end))
+    else:
+        hits = np.flatnonzero((dmr_starts < end) & (dmr_ends > start))
+    return int(rows[hits[0]]) if len(hits) else None
+
+def ensure_index(bam_file, tmp_dir):
+    """
+    Path of an indexed version of bam_file: the file itself if it has an index or can be indexed,
+    otherwise a sorted copy in tmp_dir (returned as the second value, to be removed after use).
+    """
+    with pysam.AlignmentFile(bam_file) as bam:
+        if bam.has_index():
+            return bam_file, None
+        sorted_order = bam.header.to_dict().get("HD", {}).get("SO") == "coordinate"
+    if sorted_order:
+        pysam.index(bam_file)
+        return bam_file, None
+    sorted_file = os.path.join(tmp_dir, f".{os.path.basename(bam_file)}.{os.getpid()}.sorted.bam")
+    pysam.sort("-o", sorted_file, bam_file)
+    pysam.index(sorted_file)
+    return sorted_file, sorted_file
+
+def slim_bam(bam_file, out_file, intervals, contained=False):
+    """
+    Write the reads of bam_file overlapping the DMRs to out_file (sorted and indexed), with the DMR tag.
+
+    Parameters:
+    bam_file (str): Input BAM file.
+    out_file (str): Output BAM file.
+    intervals (DMRIntervals): The merged DMRs.
+    contained (bool): Only keep reads that lie completely within a DMR (the reads finetune_data_generate uses).
+
+    Returns:
+    dict: Numbers of reads and bytes of the input and output.
+    """
+    out_dir, name = os.path.split(out_file)
+    tmp_file = os.path.join(out_dir, f".{name}.{os.getpid()}.tmp.bam")
+    indexed_file, sorted_copy = ensure_index(bam_file, out_dir)
+    n_written = 0
+    try:
+        with pysam.AlignmentFile(indexed_file) as bam:
+            header = bam.header.to_dict()
+            header.setdefault("PG", []).append({"ID": "slim_bams", "PN": "slim_bams.py",
+                                                "CL": f"DMR reads, {DMR_TAG}:i = row in the DMR file"})
+            header["HD"] = {**header.get("HD", {"VN": "1.6"}), "SO": "coordinate"}
+            n_reads = bam.mapped + bam.unmapped
+            with pysam.AlignmentFile(tmp_file, "wb", header=header) as out:
+                # In the order of the header, so the output is sorted as well
+                for chrom in bam.references:
+                    if chrom not in intervals.regions:
+                        continue
+                    region_starts, region_ends, members = intervals.regions[chrom]
+                    previous_end = -1
+                    for start, end, region_members in zip(region_starts.tolist(), region_ends.tolist(), members):
+                        for read in bam.fetch(chrom, start, end):
+                            # Reads reaching into the previous region were written with it
+                            if read.reference_start < previous_end:
+                                continue
+                            row = assign_dmr(region_members, read.reference_start, read.reference_end, contained)
+                            if row is None:
+                                continue
+                            read.set_tag(DMR_TAG, row, value_type="i")
+                            out.write(read)
+                            n_written += 1
+                        previous_end = end
+        pysam.index(tmp_file)
+        os.replace(tmp_file + ".bai", out_file + ".bai")
+        os.replace(tmp_file, out_file)
+    except BaseException:
+        for path in (tmp_file, tmp_file + ".bai"):
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+    finally:
+        if sorted_copy:
+            for path in (sorted_copy, sorted_copy + ".bai"):
+                if os.path.exists(path):
+                    os.remove(path)
+    return {"reads_in": n_reads, "reads_out": n_written,
+            "bytes_in": os.path.getsize(bam_file), "bytes_out": os.path.getsize(out_file)}
+
+def slim_bams(bam_files, f_dmr, output_dir, jobs=1, padding=0, contained=False, force=False):
+    """
+    Slim BAM files in parallel, skipping existing outputs (unless force).
+
+    Returns:
+    dict: Output path of every input BAM (None if it failed).
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    intervals = DMRIntervals(f_dmr, padding)
+    intervals.write_bed(os.path.join(output_dir, REGIONS_FILE))
+    print(f"{intervals.n_dmrs} DMRs merged into {len(intervals)} regions ({intervals.total_length()} bp)")
+
+    outputs, futures = {}, {}
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        for bam_file in dict.fromkeys(bam_files):
+            out_file = os.path.join(output_dir, os.path.basename(bam_file))
+            outputs[bam_file] = out_file
+            if os.path.isfile(out_file) and not force:
+                print(f"Skipping {bam_file}: {out_file} already exists.")
+                continue
+            futures[pool.submit(slim_bam, bam_file, out_file, intervals, contained)] = bam_file
+        for future in as_completed(futures):
+            bam_file = futures[future]
+            try:
+                stats = future.result()
+                print(f"{os.path.basename(bam_file)}: {stats['reads_out']}/{stats['reads_in']} reads, "
+                      f"{stats['bytes_out'] / 2**20:.1f}/{stats['bytes_in'] / 2**20:.1f} MiB")
+            except Exception as e:
+                print(f"Failed {bam_file}: {e}", file=sys.stderr)
+                outputs[bam_file] = None
+    return outputs
+
+def read_file_list(file_list):
+    """The lines of a fine_tune_data.txt list as (BAM file, rest of the line)."""
+    with open(file_list) as f:
+        return [tuple(line.rstrip("\n").split("\t", 1)) for line in f if line.strip()]
+
+def main():
+    parser = argparse.ArgumentParser(description="Write slim BAM files with only the reads overlapping the DMRs.")
+    parser.add_argument("dmr_file", help="DMR file (dmr_filtered.csv)")
+    parser.add_argument("bam_files", nargs="*", help="BAM files to slim")
+    parser.add_argument("-o", "--output-dir", required=True, help="Output directory for the slim BAM files")
+    parser.add_argument("--file-list", help="Slim the BAM files of this list (e.g. ../fine_tune_data.txt) and write a copy pointing to the slim files")
+    parser.add_argument("--list-output", help="Output path of the slim file list (default: <output dir>/<name of the list>)")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="Number of BAM files processed at once (default: all cores)")
+    parser.add_argument("--padding", type=int, default=0, help="Bases added on both sides of every DMR (default: 0)")
+    parser.add_argument("--contained", action="store_true", help="Only keep reads completely within a DMR, like finetune_data_generate")
+    parser.add_argument("--force", action="store_true", help="Overwrite existing slim BAM files")
+    args = parser.parse_intermixed_args()
+
+    entries = read_file_list(args.file_list) if args.file_list else []
+    bam_files = args.bam_files + [entry[0] for entry in entries]
+    if not bam_files:
+        parser.error("no BAM files given (bam_files or --file-list)")
+
+    outputs = slim_bams(bam_files, args.dmr_file, args.output_dir, args.jobs, args.padding, args.contained, args.force)
+
+    if args.file_list:
+        list_output = args.list_output or os.path.join(args.output_dir, os.path.basename(args.file_list))
+        with open(list_output, "w") as f:
+            for entry in entries:
+                if outputs[entry[0]] is not None:
+                    f.write("\t".join((outputs[entry[0]],) + entry[1:]) + "\n")
+        print(f"Slim file list written to {list_output}")
+
+    failed = [bam for bam, out in outputs.items() if out is None]
+    if failed:
+        sys.exit(f"{len(failed)} BAM file(s) failed: {', '.join(failed)}")
+
+if __name__ == "__main__":
+    main()